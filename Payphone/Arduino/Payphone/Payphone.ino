@@ -63,6 +63,19 @@ Keypad keypad = Keypad( makeKeymap(keys), rowPins, colPins, rows, cols );
 #define RING_ON_TIME 400
 #define RING_OFF_TIME 200
 
+// framed protocol, see serialproto.py for the layout
+// we start with single characters and switch to frames when the host asks
+#define PROTOCOL_REQUEST 'P'
+#define PROTOCOL_VERSION 1
+#define FRAME_SOF 0x7E
+#define FRAME_HELLO 0x01
+#define FRAME_EVENTS 0x02
+#define FRAME_COMMAND 0x03
+#define FRAME_ACK 0x04
+#define FRAME_HEADER 6
+#define FRAME_MAX_PAYLOAD 64
+#define FRAME_RX_TIMEOUT 50
+
 
 int8_t incoming;
 volatile uint8_t newHookState = 0;
@@ -74,6 +87,21 @@ uint8_t ringingState = 0;
 uint32_t ringingTimmer = 0;
 uint8_t ringingStage = 0;
 
+uint8_t framed = 0;
+uint8_t txSeq = 0;
+// events seen this pass of loop(), sent together in one frame
+char eventBuf[FRAME_MAX_PAYLOAD];
+uint8_t eventCount = 0;
+// incoming frame being assembled
+uint8_t rxBuf[2 + FRAME_HEADER + FRAME_MAX_PAYLOAD + 2];
+uint8_t rxPos = 0;
+uint8_t rxNeeded = 0;
+uint32_t rxStarted = 0;
+// seq of the last COMMAND frame run, the host resends one whose ack it
+// missed and that must be acked again but not run twice
+uint8_t rxLastSeq = 0;
+uint8_t rxSeqValid = 0;
+
 
 void setup()
 {
@@ -96,41 +124,48 @@ void setup()
 
 void loop()
 {
-    if (Serial.available()) {
+    while (Serial.available()) {
         incoming = Serial.read();
-        switch (incoming) {
-            case RING_START:
-                ringStart();
-                break;
-            case RING_STOP:
-                ringStop();
-                break;
-            case ON_HOOK:
-            case OFF_HOOK:
-                Serial.print(digitalRead(HOOK) ? OFF_HOOK : ON_HOOK);
-            default:
-                break;
+        if (rxPos) {
+            frameByte(incoming);
+        } else if ((uint8_t)incoming == FRAME_SOF) {
+            rxBuf[0] = incoming;
+            rxPos = 1;
+            rxNeeded = 0;
+            rxStarted = millis();
+        } else if (incoming == PROTOCOL_REQUEST) {
+            framed = 1;
+            rxSeqValid = 0;
+            sendHello();
+        } else {
+            command(incoming);
         }
     }
+    // give up on a frame that stopped arriving part way
+    if (rxPos && (millis() - rxStarted) > FRAME_RX_TIMEOUT) {
+        rxPos = 0;
+    }
     
     char key = keypad.getKey();
 
     if (key != NO_KEY){
-      Serial.print(key);
+      sendEvent(key);
     }
  
     if (followState != newFollowState) {
         followState = newFollowState;   
         if (!followState)
-            Serial.print(FOLLOW_KEY);
+            sendEvent(FOLLOW_KEY);
     }
     
     if (hookState != newHookState && (millis() - hookTimeOut) > HOOK_TIMEOUT) {
         hookTimeOut = millis();
         hookState = newHookState;
-        Serial.print(hookState ? OFF_HOOK : ON_HOOK);
+        sendEvent(hookState ? OFF_HOOK : ON_HOOK);
     }
     
+    flushEvents();
+    
     if (ringingState) {
         switch (ringingState) {
             case 1:
@@ -155,6 +190,123 @@ void loop()
     }
 }
 
+void command(char c)
+{
+    switch (c) {
+        case RING_START:
+            ringStart();
+            break;
+        case RING_STOP:
+            ringStop();
+            break;
+        case ON_HOOK:
+        case OFF_HOOK:
+            sendEvent(digitalRead(HOOK) ? OFF_HOOK : ON_HOOK);
+        default:
+            break;
+    }
+}
+
+void sendEvent(char c)
+{
+    if (!framed) {
+        Serial.print(c);
+        return;
+    }
+    if (eventCount == FRAME_MAX_PAYLOAD)
+        flushEvents();
+    eventBuf[eventCount++] = c;
+}
+
+void flushEvents()
+{
+    if (eventCount) {
+        sendFrame(FRAME_EVENTS, (uint8_t *)eventBuf, eventCount);
+        eventCount = 0;
+    }
+}
+
+void sendHello()
+{
+    uint8_t payload[2] = {PROTOCOL_VERSION, (uint8_t)(VERSION * 10)};
+    sendFrame(FRAME_HELLO, payload, sizeof(payload));
+}
+
+// CRC-16/CCITT-FALSE, matches crc16() in serialproto.py
+uint16_t crc16(uint16_t crc, uint8_t b)
+{
+    crc ^= (uint16_t)b << 8;
+    for (uint8_t i = 0; i < 8; i++) {
+        crc = (crc & 0x8000) ? (crc << 1) ^ 0x1021 : crc << 1;
+    }
+    return crc;
+}
+
+void sendFrame(uint8_t type, uint8_t *payload, uint8_t len)
+{
+    uint8_t header[FRAME_HEADER + 1];
+    uint32_t now = millis();
+    uint16_t crc = 0xFFFF;
+    uint8_t i;
+    
+    header[0] = FRAME_HEADER + len;
+    header[1] = type;
+    header[2] = txSeq++;
+    for (i = 0; i < 4; i++) {
+        header[3 + i] = (now >> (8 * i)) & 0xFF;
+    }
+    for (i = 0; i < sizeof(header); i++) {
+        crc = crc16(crc, header[i]);
+    }
+    for (i = 0; i < len; i++) {
+        crc = crc16(crc, payload[i]);
+    }
+    
+    Serial.write(FRAME_SOF);
+    Serial.write(header, sizeof(header));
+    Serial.write(payload, len);
+    Serial.write(crc & 0xFF);
+    Serial.write(crc >> 8);
+}
+
+void frameByte(uint8_t b)
+{
+    rxBuf[rxPos++] = b;
+    if (rxPos == 2) {
+        if (b < FRAME_HEADER || b > FRAME_HEADER + FRAME_MAX_PAYLOAD) {
+            rxPos = 0;
+            return;
+        }
+        // SOF, length byte, body and crc
+        rxNeeded = 2 + b + 2;
+    }
+    if (rxPos < 2 || rxPos < rxNeeded)
+        return;
+    
+    uint8_t len = rxBuf[1];
+    uint16_t crc = 0xFFFF;
+    for (uint8_t i = 1; i < 2 + len; i++) {
+        crc = crc16(crc, rxBuf[i]);
+    }
+    rxPos = 0;
+    if (crc != (rxBuf[2 + len] | ((uint16_t)rxBuf[3 + len] << 8)))
+        return;
+    
+    if (rxBuf[2] == FRAME_COMMAND) {
+        uint8_t seq = rxBuf[3];
+        // newer than the last one run if it is up to half the seq space ahead
+        if (!rxSeqValid || (uint8_t)(seq - rxLastSeq - 1) < 128) {
+            rxLastSeq = seq;
+            rxSeqValid = 1;
+            for (uint8_t i = 2 + FRAME_HEADER; i < 2 + len; i++) {
+                command(rxBuf[i]);
+            }
+        }
+        // ack by the hosts seq, repeats too as the first ack went missing
+        sendFrame(FRAME_ACK, &rxBuf[3], 1);
+    }
+}
+
 void hook()
 {
         newHookState = digitalRead(HOOK);
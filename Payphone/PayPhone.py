@@ -29,7 +29,7 @@
 #
 
 import sys
-from time import time, sleep, gmtime, strftime
+from time import gmtime, strftime
 import os
 import signal
 import errno
@@ -41,13 +41,31 @@ import threading
 import socket
 import select
 import logging
+import logging.handlers
 import re
+import events
+import metrics
+import timers
+import serialproto
+import dialplan
+import siphealth
+import tones
+import logqueue
+import logfiles
+import pjlog
+import flightrecorder
+import settings
 if sys.platform == 'win32':
     pass
 else:
     from daemon import DaemonContext, pidlockfile
     import lockfile
-import pjsua as pj
+    import fcntl
+# the SIP stack, PAYPHONE_SIP_BACKEND=fake runs against the simulation in fakepj.py
+if os.environ.get('PAYPHONE_SIP_BACKEND', 'pjsua') == 'fake':
+    import fakepj as pj
+else:
+    import pjsua as pj
 
 """
     Big TODO list
@@ -61,6 +79,26 @@ import pjsua as pj
     
 """
 
+class CallSnapshot(object):
+    """ What pjsua last told us about a call, read with a single Call.info()
+        in the callback so the main thread and the log lines never go back
+        into the library and its locks. Not changed once made
+    """
+    __slots__ = ('call', 'callback', 'state', 'state_text', 'media_state', 'remote_uri',
+                 'last_code', 'last_reason', 'conf_slot')
+
+    def __init__(self, call, callback=None):
+        info = call.info()
+        self.call = call
+        self.callback = callback    # PayPhoneCallCallback that took it
+        self.state = info.state
+        self.state_text = info.state_text
+        self.media_state = info.media_state
+        self.remote_uri = info.remote_uri
+        self.last_code = info.last_code
+        self.last_reason = info.last_reason
+        self.conf_slot = info.conf_slot
+
 class PayPhoneAccountCallback(pj.AccountCallback):
     def __init__(self, phone):
         self._phone = phone
@@ -68,48 +106,1152 @@ class PayPhoneAccountCallback(pj.AccountCallback):
 
     # Notification on incoming call
     def on_incoming_call(self, call):
-        self._phone.logger.info("acCallback: Incoming call from {}".format(call.info().remote_uri))
-        self._phone.on_incoming_call(call)
-        
-    def wait(self):
-        self.sem = threading.Semaphore(0)
-        self._phone.logger.info("acCallback: Waiting")
-        self.sem.acquire()
+        snapshot = CallSnapshot(call)
+        self._phone._flight.record(self._phone._flightSip, 'INCOMING', snapshot.remote_uri[:64])
+        self._phone.logger.info("acCallback: Incoming call from {}".format(snapshot.remote_uri))
+        self._phone._post(events.INCOMING_CALL, snapshot)
 
     def on_reg_state(self):
-        if self.sem:
-            if self.account.info().reg_status >= 200:
-                self.sem.release()
-                self._phone.logger.info("acCallback: Account registration successful")
+        info = self.account.info()
+        self._phone._flight.record(self._phone._flightSip, 'REG_STATE', (info.reg_status, info.reg_reason[:64]))
+        self._phone._post(events.REG_STATE, (self, info.reg_status, bool(info.reg_active), info.reg_reason))
 
 class PayPhoneCallCallback(pj.CallCallback):
     def __init__(self, phone):
         self._phone = phone
         pj.CallCallback.__init__(self, self._phone.getCall())
 
-    # Notification when call state has changed
-    def on_state(self):
-        self._phone.logger.info("callCallback: Call with {} is {} last code = {} ({})".format(self.call.info().remote_uri,
-                                                                                self.call.info().state_text,
-                                                                                self.call.info().last_code,
-                                                                                self.call.info().last_reason))
-        
-        if self.call.info().state == pj.CallState.DISCONNECTED:
-            self._phone.callDisconnected()
+    # Notification when call state has changed
+    def on_state(self):
+        snapshot = CallSnapshot(self.call, self)
+        self._phone._flight.record(self._phone._flightSip, 'CALL_STATE', (snapshot.state_text, snapshot.last_code))
+        self._phone.logger.info("callCallback: Call with {} is {} last code = {} ({})".format(snapshot.remote_uri,
+                                                                                snapshot.state_text,
+                                                                                snapshot.last_code,
+                                                                                snapshot.last_reason))
+        self._phone._post(events.CALL_STATE, snapshot)
+
+    # Notification when call's media state has changed.
+    def on_media_state(self):
+        snapshot = CallSnapshot(self.call, self)
+        self._phone._flight.record(self._phone._flightSip, 'MEDIA_STATE', (snapshot.media_state, snapshot.conf_slot))
+        self._phone._post(events.MEDIA_STATE, snapshot)
+
+    def on_dtmf_digit(self, digits):
+        self._phone._flight.record(self._phone._flightSip, 'DTMF_IN', digits)
+        self._phone.logger.info("callCallback: Recived DTMF: {}".format(digits))
+
+class Handset():
+    """One phone: its serial link to a Payphone.ino board, its SIP account and
+       the call state machine between the two
+
+       All handsets in a process share PayPhone's pj.Lib, transport, event
+       queue and timers, events they post carry the handset as their source
+    """
+    _SerialFailCount = 0
+    _SerialFailCountLimit = 3
+    _serialRetryDelay = 1       # first restart delay, doubles on each failure
+    _serialHealthyTime = 10     # seconds a restarted thread must live to reset the fail count
+    _serialCheckTimer = None
+    _serialTimeout = 1     # serial port time out setting
+    _serialReader = "event"    # reader in use, poll on windows whatever the settings say
+    _serialWakeRead = None
+    _serialWakeWrite = None
+    _framed = False             # the board answered and is talking in frames
+    _commandRetryTime = 0.2     # seconds to wait for a command to be acked before resending
+    _commandRetryLimit = 3
+    _protocolRequest = None     # [deadline, tries] while waiting for the board to answer
+    _protocolRetryTime = 0.5    # seconds to wait for HELLO before asking again
+    _protocolRetryLimit = 5     # requests sent before staying with single characters
+    
+    _acc = None
+    _accCallback = None
+    _serverIndex = 0        # which of _servers the account is using
+    _regRetry = 30          # seconds a server that refused to register us is passed over
+    _call = None
+    _callInfo = None        # CallSnapshot of _call from its latest event
+    _callCb = None          # PayPhoneCallCallback of _call
+    
+    _dailDigits = "1234567890*#"
+    _ringStartCommand = "R"
+    _ringStopCommand = "r"
+    _onHookKey = "H"
+    _offHookKey = "h"
+    _followKey = "F"
+    _serialEvents = (events.DIGITS, events.HOOK, events.FOLLOW)
+    _dialTimer = None
+    _dialState = None
+    _registerTimer = None
+    _pendingDigits = None   # number waiting for registration
+    _ringTimer = None
+    _tone = None            # tone we are playing to the handset
+    _digits = None
+    _reregisterPending = False  # account settings were reloaded during a call
+    
+    _state = ""
+    RUNNING = "RUNNING"
+    ERROR = "ERROR"
+
+    def __init__(self, app, settings):
+        """ app is the PayPhone running us, settings the HandsetSettings for
+            this handset. Read them through self._settings each time, a
+            reload replaces them
+        """
+        self._app = app
+        name = self.name = settings.name
+        self._settings = settings
+        self.logger = logging.getLogger('PayPhone.{}'.format(name))
+        # subsystem names for the flight recorder, made once so recording is cheap
+        self._flight = app.flight
+        self._flightSerial = "serial:" + name
+        self._flightSip = "sip:" + name
+        self.flightMain = "main:" + name
+        self._timers = app._timers
+        self._engine = app._engine
+        
+        self._eventHandlers = {
+                               events.DIGITS: self._onDigits,
+                               events.HOOK: self._onHook,
+                               events.INCOMING_CALL: self._onIncomingCall,
+                               events.CALL_STATE: self._onCallState,
+                               events.MEDIA_STATE: self._onMediaState,
+                               events.SERIAL_STOPPED: self._onSerialStopped,
+                               events.REG_STATE: self._onRegState,
+                              }
+        
+        self.fHookState = threading.Event()
+        self.fRingState = threading.Event()
+        self.fFollowSate = threading.Event()
+        self.fDialing = threading.Event()
+        self.fOutgoing = threading.Event()
+        
+        # incoming serial bytes are split into runs of digits and single keys
+        self._serialTokens = re.compile("[{}]+|.".format(re.escape(self._dailDigits)), re.S)
+        self._serialKeyHandlers = {
+                                   self._onHookKey: self._serialOnHook,
+                                   self._offHookKey: self._serialOffHook,
+                                   self._followKey: self._serialFollow,
+                                  }
+        
+        # framed protocol state, only touched from the serial thread
+        self._decoder = serialproto.FrameDecoder()
+        self._boardClock = serialproto.BoardClock()     # times frames from the board by their timestamp
+        self._txSeq = 0
+        self._rxSeq = None
+        self._unacked = {}          # seq: [frame, resend deadline, tries]
+        
+        # serial link counters, written by the serial thread, safe to read from anywhere
+        self.serialStats = {
+                            'frames_lost': 0,           # board frames missing from the sequence
+                            'commands_failed': 0,       # framed commands never acked
+                            'tx_bytes': 0,
+                            'tx_batches': 0,            # write() calls
+                            'tx_commands': 0,           # commands taken off qSerialOut
+                            'tx_batch_max': 0,          # most commands sent in one write()
+                            'tx_queued_seconds': 0.0,   # summed time commands sat on qSerialOut
+                            'tx_queued_max_seconds': 0.0,
+                            'tx_timeouts': 0,           # writes that missed write_timeout
+                            'rx_bytes': 0,
+                            'reconnects': 0,            # serial thread restarts after a failure
+                           }
+        
+        # call counters, only written from the main thread
+        self.callStats = {
+                          'incoming': 0,
+                          'outgoing': 0,
+                          'answered': 0,            # incoming calls picked up
+                          'rejected_busy': 0,       # incoming while already on a call
+                          'unanswered': 0,          # gave up after ring_timeout
+                          'failed': 0,              # make_call raised
+                         }
+        self.dtmfDigits = 0
+        self.callConnected = False  # the current call is CONFIRMED
+        # last registration result, None until the first one arrives
+        self.regStatus = None
+        self.regActive = False
+        # the settings the SIP account was made with, these only change
+        # when it is made again
+        self._accountSettings = settings
+        # (registrar, outbound proxy) in order of preference
+        self._servers = settings.servers
+        self.server = self._servers[0][0]
+        self.serverSwitches = 0
+        self._regFailedUntil = {}   # server index: monotonic time to try it again
+        # seconds from PayPhone.run() to the first serial event and the first
+        # successful registration, missing until they happen
+        self.startup = {}
+        
+        # seconds from an event entering the system to us acting on it
+        self.latency = {
+                        'hook_to_answer': metrics.Histogram('hook_to_answer', "off hook to answer(200)"),
+                        'key_to_dtmf': metrics.Histogram('key_to_dtmf', "key press to dial_dtmf()"),
+                        'digit_to_invite': metrics.Histogram('digit_to_invite', "last digit to make_call()"),
+                        'invite_to_ring': metrics.Histogram('invite_to_ring', "on_incoming_call to ring command written"),
+                        'board_to_host': metrics.Histogram('board_to_host',
+                                                           "hook or key event frame sent by the board to read by us, "
+                                                           "beyond the fastest frame"),
+                       }
+        self._rxStamp = None        # when the serial bytes being processed were read
+        self._eventStamp = None     # stamp of the event being handled
+        self._lastDigitStamp = None
+        self._dialPlan = dialplan.DialPlan(settings.dial_plan)
+        if settings.dial_plan:
+            self.logger.info("Dial plan {}".format(", ".join(settings.dial_plan)))
+        self.logger.debug("Dial timeout {}s, ring timeout {}s".format(settings.dial_timeout, settings.ring_timeout))
+
+    def reload(self, settings):
+        """ Apply new HandsetSettings, runs on the main thread. Returns
+            (applied, failed) lists of descriptions, settings that fail keep
+            their old values
+        """
+        old = self._settings
+        applied = []
+        failed = []
+        serial = [name for name in settings.changed(old) if name in settings.SERIAL]
+        if serial and settings.port != old.port and not os.path.exists(settings.port):
+            failed.append("{} {}: no such port {}".format(self.name, ", ".join(serial), settings.port))
+            settings = settings.replace(**dict((name, getattr(old, name)) for name in settings.SERIAL))
+            serial = []
+        changed = settings.changed(old)
+        if not changed:
+            return applied, failed
+        
+        if serial:
+            self.reopenSerial(settings)
+            applied.append("{} {}, serial port reopened".format(self.name, ", ".join(serial)))
+        else:
+            # everything else is read from the settings as it is used
+            self._settings = settings
+        if 'dial_plan' in changed:
+            # a number part dialed carries on with the old plan
+            self._dialPlan = dialplan.DialPlan(settings.dial_plan)
+        
+        phone = [name for name in changed if name not in settings.SERIAL + settings.ACCOUNT]
+        if phone:
+            applied.append("{} {}".format(self.name, ", ".join(phone)))
+        
+        # show which changed, never what the secret is
+        account = [name for name in changed if name in settings.ACCOUNT]
+        if account:
+            if self._call:
+                self._reregisterPending = True
+                applied.append("{} {}, registering again after the call".format(self.name, ", ".join(account)))
+            else:
+                self._reregister()
+                applied.append("{} {}, registering again".format(self.name, ", ".join(account)))
+        return applied, failed
+
+    def _reregister(self):
+        """ Start again with a new account on the first server
+        """
+        self._reregisterPending = False
+        self._accountSettings = self._settings
+        self._servers = self._settings.servers
+        self._regFailedUntil = {}
+        self.logger.info("Registering again with {}".format(self._servers[0][0]))
+        self._recreateAccount(0)
+
+    def _post(self, type, data=None, stamp=None):
+        self._app.qEvents.put(events.Event(type, data, self, stamp))
+
+    def handleEvent(self, event):
+        """ Act on one of our events, runs on the main thread
+        """
+        if event.type in self._serialEvents and 'first_serial_event' not in self.startup:
+            self._startupMilestone('first_serial_event', event.stamp)
+        handler = self._eventHandlers.get(event.type)
+        if handler:
+            self._eventStamp = event.stamp
+            handler(event.data)
+
+    def initAccount(self):
+        """ Register our SIP account on the shared library
+        """
+        registrar, proxy = self._servers[self._serverIndex]
+        self.server = registrar
+        acc_cfg = pj.AccountConfig(registrar,
+                                   self._accountSettings.username,
+                                   self._accountSettings.secret,
+                                   proxy="sip:{}".format(proxy) if proxy else "")
+
+        self._accCallback = PayPhoneAccountCallback(self)
+        self._acc = self._app._lib.create_account(acc_cfg, cb=self._accCallback)
+
+    def _startupMilestone(self, name, stamp):
+        self.startup[name] = stamp - self._app.startStamp
+        self.logger.info("Startup: {} after {:.3f}s".format(name, self.startup[name]))
+
+    def healthServers(self):
+        """ Where each of our servers is checked, the proxy if it has one
+        """
+        return [proxy or registrar for registrar, proxy in self._servers]
+
+    def checkServer(self):
+        """ Move the account to the first server that is up and has not just
+            refused to register us, waits for the current call to end
+        """
+        if len(self._servers) < 2 or self._call or self._acc is None:
+            return
+        health = self._app.sipHealth
+        now = timers.monotonic()
+        for index, checkAt in enumerate(self.healthServers()):
+            if health and not health.isUp(checkAt):
+                continue
+            if now < self._regFailedUntil.get(index, 0):
+                continue
+            if index != self._serverIndex:
+                self._switchServer(index)
+            return
+
+    def _switchServer(self, index):
+        self.logger.warn("Moving SIP account from {} to {}".format(self._servers[self._serverIndex][0],
+                                                                   self._servers[index][0]))
+        self.serverSwitches += 1
+        self._flight.record(self.flightMain, 'SWITCH_SERVER', self._servers[index][0])
+        self._recreateAccount(index)
+
+    def _recreateAccount(self, index):
+        lck = self._app._lib.auto_lock()
+        try:
+            self.deleteAccount()
+            self._serverIndex = index
+            self.regStatus = None
+            self.regActive = False
+            self.initAccount()
+        except pj.Error, e:
+            self.logger.error("Failed to set up the SIP account again: {}".format(e))
+        del lck
+
+    def deleteAccount(self):
+        if self._acc:
+            self._acc.delete()
+            self._acc = None
+
+    def selectFds(self):
+        """ File descriptors the select engine should wait on for us
+        """
+        fds = [self._serialWakeRead]
+        if self._serial.isOpen():
+            fds.append(self._serial.fileno())
+        return fds
+
+    def selectTimeout(self):
+        """ Seconds the select engine can wait before serviceSerial() has
+            something to resend, None if nothing is waiting
+        """
+        return self._SerialRetryTimeout()
+
+    def serviceSerial(self, readable):
+        """ Select engine, handle the port after select() returned readable
+        """
+        if self._serialWakeRead in readable:
+            self._serialDrainWakeup()
+        if self._serial.isOpen():
+            try:
+                if self._serial.fileno() in readable:
+                    self._SerialReadIncoming()
+                self._SerialWriteOutgoing()
+            except IOError:
+                self.logger.exception("IOError on serial port")
+                self._serial.close()
+                self._post(events.SERIAL_STOPPED)
+
+    def requeryHook(self):
+        """ Ask the board to tell us the current hook state
+        """
+        self._queueSerialOut(self._onHookKey)
+
+    def initSerial(self):
+        """ Setup the serial port and start the thread
+        """
+        self.logger.info("Serial port init")
+
+        # serial port base on config file, thread handles opening and closing
+        settings = self._settings
+        self._serial = serial.Serial()
+        self._serial.port = settings.port
+        self._serial.baudrate = settings.baudrate
+        self._serial.timeout = self._serialTimeout
+        if settings.write_timeout is not None:
+            # a wedged port raises SerialTimeoutException rather than blocking the thread
+            self._serial.writeTimeout = settings.write_timeout
+        
+        # select() can not wait on a serial port under windows so fall back to polling there
+        self._serialReader = settings.reader
+        if sys.platform == 'win32':
+            self._serialReader = 'poll'
+        
+        # setup queue
+        self.qSerialOut = Queue.Queue()
+        
+        # setup thread
+        self.tSerialStop = threading.Event()
+        
+        # wakeup pipe so the event reader notices qSerialOut and tSerialStop straight away
+        if self._serialReader == 'event' or self._engine == self._app.SELECT:
+            self._serialWakeRead, self._serialWakeWrite = os.pipe()
+            for fd in (self._serialWakeRead, self._serialWakeWrite):
+                flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+                fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        
+        self._startSerail()
+    
+    def _startSerail(self):
+        if self._engine == self._app.SELECT:
+            # no thread, the main loop services the port
+            self._serialOpen()
+            return
+        
+        self.tSerial = threading.Thread(name='tSerial-{}'.format(self.name), target=self._SerialThread)
+        self.tSerial.daemon = False
+    
+        try:
+            self.tSerial.start()
+        except:
+            self.logger.exception("Failed to Start the Serial thread")
+
+    def stopSerial(self):
+        """ Ask the serial thread to stop and wait for it
+        """
+        self.tSerialStop.set()
+        if self._engine == self._app.SELECT:
+            self._serial.close()
+            return
+        self._serialWakeup()
+        self.tSerial.join()
+
+    def reopenSerial(self, settings):
+        """ Stop the serial link and start it again with new settings
+        """
+        self._timers.cancel(self._serialCheckTimer)
+        self.stopSerial()
+        for fd in (self._serialWakeRead, self._serialWakeWrite):
+            if fd is not None:
+                os.close(fd)
+        self._serialWakeRead = self._serialWakeWrite = None
+        self._settings = settings
+        self.initSerial()
+        self.requeryHook()
+
+    def _serialRunning(self):
+        if self._engine == self._app.SELECT:
+            return self._serial.isOpen()
+        return self.tSerial.is_alive()
+
+    def _serialWakeup(self):
+        """ Poke the serial thread out of select(), safe to call from any thread
+        """
+        if self._serialWakeWrite is None:
+            return
+        try:
+            os.write(self._serialWakeWrite, 'w')
+        except OSError, e:
+            # pipe full means a wakeup is already pending
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def _serialDrainWakeup(self):
+        """ Empty the wakeup pipe once the serial thread is awake
+        """
+        try:
+            while os.read(self._serialWakeRead, 512):
+                pass
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def _queueSerialOut(self, msg, latency=None):
+        """ Queue a command for the serial port
+            latency is an optional (Histogram, stamp) to observe once the
+            command has been written
+            returns
+                True if the command was queued
+                False if qSerialOut is full
+        """
+        try:
+            self.qSerialOut.put_nowait((msg, timers.monotonic(), latency))
+        except Queue.Full:
+            self.logger.warn("Failed to put {} on qSerialOut at its Full".format(msg))
+            return False
+        self._serialWakeup()
+        return True
+
+    def _SerialThread(self):
+        """ Serial Thread
+        """
+        self.logger.info("tSerial: Serial thread started ({} reader)".format(self._serialReader))
+ 
+        try:
+            while (not self.tSerialStop.is_set()):
+                # open the port
+                self._serialOpen()
+                
+                # main serial processing loop
+                if self._serialReader == 'event':
+                    self._SerialEventLoop()
+                else:
+                    self._SerialPollLoop()
+                
+                # port closed for some reason (or tSerialStop), if tSerialStop is not set we will try reopening
+        except IOError, e:
+            self._flight.record(self._flightSerial, 'IO_ERROR', str(e)[:64])
+            self.logger.exception("tSerail: IOError on serial port")
+        
+        # close the port
+        self.logger.info("tSerial: Closing serial port")
+        self._serial.close()
+        
+        self.logger.info("tSerial: Thread stoping")
+        self._flight.record(self._flightSerial, 'STOPPED')
+        if not self.tSerialStop.is_set():
+            # let the main thread know so it can restart us
+            self._post(events.SERIAL_STOPPED)
+        return
+    
+    def _serialOpen(self):
+        """ Open the port and clear out anything stale
+        """
+        try:
+            self._serial.open()
+            self.logger.info("tSerial: Opened the serial port")
+        except serial.SerialException:
+            self.logger.exception("tSerial: Failed to open port {} Exiting".format(self._serial.port))
+            self._serial.close()
+            self._app.die()
+        
+        if self._engine != self._app.SELECT:
+            # give anything stale a moment to arrive, the select engine opens
+            # the port on the main thread so flushes straight away instead
+            self.tSerialStop.wait(0.1)
+        
+        # we clear out any stale serial messages that might be in the buffer
+        self._serial.flushInput()
+        
+        # boards start out speaking single characters, ask for frames
+        self._framed = False
+        self._rxSeq = None
+        self._unacked.clear()
+        self._decoder.reset()
+        self._boardClock.reset()
+        self._protocolRequest = None
+        if self._settings.protocol == 'auto':
+            self._serial.write(serialproto.PROTOCOL_REQUEST)
+            self._protocolRequest = [timers.monotonic() + self._protocolRetryTime, 1]
+    
+    def _SerialEventLoop(self):
+        """ Block in select() on the serial port and the wakeup pipe, RX and TX
+            are handled as soon as they are ready
+        """
+        fds = [self._serial.fileno(), self._serialWakeRead]
+        while self._serial.isOpen() and not self.tSerialStop.is_set():
+            try:
+                # only wake without a reason when a command or the protocol request needs resending
+                readable = select.select(fds, [], [], self._SerialRetryTimeout())[0]
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise IOError(*e.args)
+            
+            if self._serialWakeRead in readable:
+                self._serialDrainWakeup()
+            
+            if fds[0] in readable:
+                self._SerialReadIncoming()
+            
+            # send anything queued, wakeup or not we may as well check
+            self._SerialWriteOutgoing()
+    
+    def _SerialPollLoop(self):
+        """ Legacy reader, poll inWaiting() and sleep between checks
+        """
+        while self._serial.isOpen() and not self.tSerialStop.is_set():
+            # extrem debug message
+            # self.logger.debug("tSerial: check serial port")
+            if self._serial.inWaiting():
+                self._SerialReadIncoming()
+            
+            # do we have anything to send
+            self._SerialWriteOutgoing()
+        
+            # sleep for a little
+            if self._serial.inWaiting():
+                self.tSerialStop.wait(0.01)
+            else:
+                self.tSerialStop.wait(0.1)
+    
+    def _SerialWriteOutgoing(self):
+        """ Send everything waiting on qSerialOut, plus any framed commands
+            due a resend, in a single write()
+        """
+        now = timers.monotonic()
+        msgs = []
+        latencies = []
+        while True:
+            try:
+                msg, queued, latency = self.qSerialOut.get_nowait()
+            except Queue.Empty:
+                break
+            msgs.append(msg)
+            if latency:
+                latencies.append(latency)
+            waited = now - queued
+            self.serialStats['tx_queued_seconds'] += waited
+            if waited > self.serialStats['tx_queued_max_seconds']:
+                self.serialStats['tx_queued_max_seconds'] = waited
+            self.qSerialOut.task_done()
+        
+        data = "".join(msgs)
+        if data and self._framed:
+            data = self._SerialFrameCommands(data)
+        if self._unacked:
+            data += self._SerialDueResends(now)
+        if self._protocolRequest:
+            data += self._SerialDueProtocolRequest(now)
+        if not data:
+            return
+        
+        try:
+            self._serial.write(data)
+        except serial.SerialTimeoutException:
+            self.serialStats['tx_timeouts'] += 1
+            self._flight.record(self._flightSerial, 'TX_TIMEOUT', len(data))
+            self.logger.warn("tSerial: write to {} timed out".format(self._serial.port))
+        except serial.SerialException, e:
+            self.logger.warn("tSerial: failed to write to the serial port {}: {}".format(self._serial.port, e))
+        else:
+            self._flight.record(self._flightSerial, 'TX', data[:64])
+            self.logger.debug("tSerial: TX:{!r}".format(data))
+            self.serialStats['tx_bytes'] += len(data)
+            written = timers.monotonic()
+            for histogram, stamp in latencies:
+                histogram.observe(written - stamp)
+        self.serialStats['tx_batches'] += 1
+        self.serialStats['tx_commands'] += len(msgs)
+        if len(msgs) > self.serialStats['tx_batch_max']:
+            self.serialStats['tx_batch_max'] = len(msgs)
+    
+    def _SerialFrameCommands(self, data):
+        """ Wrap commands in as few frames as will hold them and remember each
+            frame until it is acked
+        """
+        frames = []
+        for start in range(0, len(data), serialproto.MAX_PAYLOAD):
+            seq = self._txSeq
+            self._txSeq = (self._txSeq + 1) & 0xFF
+            frame = serialproto.encodeFrame(serialproto.COMMAND, seq, int(timers.monotonic() * 1000),
+                                            data[start:start + serialproto.MAX_PAYLOAD])
+            self._unacked[seq] = [frame, timers.monotonic() + self._commandRetryTime, 1]
+            frames.append(frame)
+        return "".join(frames)
+    
+    def _SerialDueResends(self, now):
+        """ Frames for unacked commands whose retry time has passed
+        """
+        resend = []
+        for seq, pending in self._unacked.items():
+            frame, deadline, tries = pending
+            if deadline > now:
+                continue
+            if tries >= self._commandRetryLimit:
+                self.logger.warn("tSerial: command {} never acked, giving up".format(seq))
+                self.serialStats['commands_failed'] += 1
+                del self._unacked[seq]
+                continue
+            self.logger.debug("tSerial: resending command {}".format(seq))
+            resend.append(frame)
+            pending[1] = now + self._commandRetryTime
+            pending[2] = tries + 1
+        return "".join(resend)
+    
+    def _SerialDueProtocolRequest(self, now):
+        """ PROTOCOL_REQUEST again if the board has not answered the last
+            one, it may have still been booting or dropped the byte
+        """
+        deadline, tries = self._protocolRequest
+        if deadline > now:
+            return ""
+        if tries >= self._protocolRetryLimit:
+            self.logger.info("tSerial: Board did not answer {} protocol requests, using single characters".format(tries))
+            self._protocolRequest = None
+            return ""
+        self.logger.debug("tSerial: asking for the framed protocol again")
+        self._protocolRequest = [now + self._protocolRetryTime, tries + 1]
+        return serialproto.PROTOCOL_REQUEST
+    
+    def _SerialRetryTimeout(self):
+        """ Seconds until an unacked command or the protocol request is due
+            to be resent, None if there are none
+        """
+        deadlines = [pending[1] for pending in self._unacked.values()]
+        if self._protocolRequest:
+            deadlines.append(self._protocolRequest[0])
+        if not deadlines:
+            return None
+        return max(0, min(deadlines) - timers.monotonic())
+    
+    def _SerialReadIncoming(self):
+        """ Read everything the port has buffered and act on it in one pass
+        """
+        # should not time out but we should check anyway
+        data = self._serial.read(self._serial.inWaiting() or 1)
+        if not data:
+            return
+        self._rxStamp = timers.monotonic()
+        self.serialStats['rx_bytes'] += len(data)
+        self._flight.record(self._flightSerial, 'RX', data[:64])
+        self.logger.debug("tSerial: RX:{!r}".format(data))
+        if self._settings.protocol == 'legacy':
+            self._SerialProcessIncoming(data)
+            return
+        
+        crcErrors = self._decoder.crcErrors
+        for item in self._decoder.feed(data):
+            if isinstance(item, serialproto.Frame):
+                self._SerialHandleFrame(item)
+            else:
+                # bytes outside a frame are from a board still on single characters
+                self._SerialProcessIncoming(item)
+        if self._decoder.crcErrors != crcErrors:
+            self.logger.warn("tSerial: dropped a corrupt frame, asking for the hook state")
+            self._queueSerialOut(self._onHookKey)
+    
+    def _SerialHandleFrame(self, frame):
+        if frame.type == serialproto.HELLO:
+            self._framed = True
+            self._protocolRequest = None
+            self._rxSeq = frame.seq
+            self._boardClock.reset()
+            self._boardClock.delay(frame.timestamp, self._rxStamp)
+            version = ord(frame.payload[0]) if frame.payload else None
+            self.logger.info("tSerial: Board is using framed protocol version {}".format(version))
+            return
+        
+        # every frame keeps the board clock in step, only events are timed
+        delay = self._boardClock.delay(frame.timestamp, self._rxStamp)
+        
+        if self._rxSeq is not None and frame.seq != (self._rxSeq + 1) & 0xFF:
+            lost = (frame.seq - self._rxSeq - 1) & 0xFF
+            self.serialStats['frames_lost'] += lost
+            self.logger.warn("tSerial: lost {} frame(s) from the board, asking for the hook state".format(lost))
+            self._queueSerialOut(self._onHookKey)
+        self._rxSeq = frame.seq
+        
+        if frame.type == serialproto.EVENTS:
+            self.latency['board_to_host'].observe(delay)
+            self._SerialProcessIncoming(frame.payload)
+        elif frame.type == serialproto.ACK:
+            for seq in frame.payload:
+                self._unacked.pop(ord(seq), None)
+    
+    def _SerialProcessIncoming(self, data):
+        """ Split a buffer from the port into runs of digits and single key
+            events, each run of digits is posted as one DIGITS event
+        """
+        for token in self._serialTokens.findall(data):
+            if token[0] in self._dailDigits:
+                self._post(events.DIGITS, token, self._rxStamp)
+            else:
+                handler = self._serialKeyHandlers.get(token)
+                if handler:
+                    handler()
+    
+    def _serialOnHook(self):
+        # set on Hook Flag
+        self.fHookState.set()
+        self.logger.info("tSerial: Phone on hook")
+        self._post(events.HOOK, True, self._rxStamp)
+    
+    def _serialOffHook(self):
+        # set off Hook Flag
+        self.fHookState.clear()
+        self.logger.info("tSerial: Phone off hook")
+        self._post(events.HOOK, False, self._rxStamp)
+    
+    def _serialFollow(self):
+        #set follow on call flag
+        self.fFollowSate.set()
+        self.logger.info("tSerial: Follow key Pressed")
+        self._post(events.FOLLOW, None, self._rxStamp)
+    
+    def getAccount(self):
+        return self._acc
+    
+    def getCall(self):
+        return self._call
+    
+    def sipBusy(self):
+        """ True while pjsua has something in hand for us that wants its
+            events handled promptly, a call or a registration not yet answered
+        """
+        return self._call is not None or (self._acc is not None and self.regStatus is None)
+    
+    def setCall(self, call):
+        self._call = call
+    
+    def _onDigits(self, digits):
+        if self._call:
+            # send dtmf
+            try:
+                self._call.dial_dtmf(digits)
+            except pj.Error, e:
+                # no media yet, keys pressed while the call is still ringing
+                self.logger.info("Could not send DTMF {}: {}".format(digits, e))
+                return
+            self.dtmfDigits += len(digits)
+            self.latency['key_to_dtmf'].observe(timers.monotonic() - self._eventStamp)
+            self.logger.info("Sent DTMF {}".format(digits))
+        elif self._pendingDigits:
+            self.logger.info("Ignoring {}, still waiting to dial {}".format(digits, self._pendingDigits))
+        elif not self.fHookState.is_set():
+            # put together dial number
+            self._lastDigitStamp = self._eventStamp
+            if not self.fDialing.is_set():
+                # start building a number to dial
+                self.logger.info("Starting Dail sequence")
+                self._stopTone()
+                self._digits = ""
+                self._dialState = self._dialPlan.start
+                self.fDialing.set()
+            settings = self._settings
+            for n, digit in enumerate(digits):
+                if digit == settings.dial_terminator:
+                    if self._digits:
+                        self._dialNow(digits[n + 1:])
+                    else:
+                        # nothing to dial yet
+                        self.fDialing.clear()
+                    return
+                self._digits += digit
+                self._dialState = self._dialPlan.feed(self._dialState, digit)
+                if self._dialPlan.result(self._dialState) == dialplan.COMPLETE:
+                    self._dialNow(digits[n + 1:])
+                    return
+            # not known to be complete, give them longer for the next digit
+            if self._dialTimer:
+                self._timers.reschedule(self._dialTimer, settings.dial_timeout)
+            else:
+                self._dialTimer = self._timers.schedule(settings.dial_timeout, self._makeCall)
+
+    def _dialNow(self, extra):
+        """ The number is complete, digits after it in the same run are dropped
+        """
+        if extra:
+            self.logger.info("Ignoring {} keyed after a complete number".format(extra))
+        self._makeCall()
+
+    def _onHook(self, onHook):
+        if onHook and self.fDialing.is_set():
+            self.logger.info("Dailing cancled")
+            self._timers.cancel(self._dialTimer)
+            self.fDialing.clear()
+            self._digits = None
+        if onHook and self._pendingDigits:
+            self.logger.info("Hung up before {} could be dialed".format(self._pendingDigits))
+            self._dropPendingCall()
+        if onHook:
+            self._stopTone()
+        self._checkCall(None if onHook else self._eventStamp)
+        if not onHook and not self._call and not self.fDialing.is_set():
+            self._startTone(tones.DIAL)
+
+    def _startTone(self, name):
+        """ Play a call progress tone while the handset is off hook, it
+            keeps playing until _stopTone()
+        """
+        if self._app.tones is None or self.fHookState.is_set() or not self._app.claimSound(self):
+            return
+        try:
+            self._app.tones.start(name)
+        except pj.Error, e:
+            self.logger.warn("Could not play {} tone: {}".format(name, e))
+            return
+        self._tone = name
+        self._flight.record(self.flightMain, 'TONE', name)
+        self.logger.debug("Playing {} tone".format(name))
+
+    def _stopTone(self):
+        if self._tone is None:
+            return
+        self._tone = None
+        try:
+            self._app.tones.stop()
+        except pj.Error, e:
+            self.logger.warn("Could not stop tone: {}".format(e))
+        if not self._call:
+            self._app.releaseSound(self)
+
+    def _failureTone(self, code):
+        """ What the caller hears when a call we made does not connect
+        """
+        if code in (486, 600):
+            return tones.BUSY
+        if code in (404, 410, 484, 604):
+            return tones.UNOBTAINABLE
+        return tones.CONGESTION
+
+    def _checkCall(self, offHookStamp=None):
+        """ Answer or hang up the current call based on the hook
+            offHookStamp is when the handset was lifted if that is why we were called
+        """
+        if not self._call:
+            return
+        # the snapshot can be a moment behind our own answer() or hangup(),
+        # pjsua refusing a repeat is harmless
+        state = self._callInfo.state
+        try:
+            if state == pj.CallState.EARLY and not self.fHookState.is_set() and not self.fOutgoing.is_set():
+                # answere the call
+                self._ringStop()
+                self._call.answer(200)
+                self._flight.record(self.flightMain, 'ANSWER', 200)
+                self.callStats['answered'] += 1
+                if offHookStamp is not None:
+                    self.latency['hook_to_answer'].observe(timers.monotonic() - offHookStamp)
+                self.logger.info("Call answered")
+            elif state == pj.CallState.CONFIRMED and self.fHookState.is_set():
+                # end call we hung up
+                self.fOutgoing.clear()
+                self._flight.record(self.flightMain, 'HANGUP', 'ended')
+                self._call.hangup()
+                self.logger.info("Call ended")
+            elif state != pj.CallState.DISCONNECTED and self.fHookState.is_set() and self.fOutgoing.is_set():
+                # hung up before our call was answered
+                self.fOutgoing.clear()
+                self._flight.record(self.flightMain, 'HANGUP', 'abandoned')
+                self._call.hangup()
+                self.logger.info("Call abandoned")
+        except pj.Error, e:
+            self.logger.info("Call already moved on from {}: {}".format(self._callInfo.state_text, e))
+
+    def _onIncomingCall(self, snapshot):
+        call = snapshot.call
+        self.callStats['incoming'] += 1
+        if self._call:
+            self.callStats['rejected_busy'] += 1
+            self.logger.info("Rejected Busy")
+            self._flight.record(self.flightMain, 'ANSWER', 486)
+            call.answer(486, "Busy")
+            return
+        
+        self._call = call
+        self._callInfo = snapshot
+        
+        self._callCb = PayPhoneCallCallback(self)
+        self._call.set_callback(self._callCb)
+
+        self._call.answer(180)
+        self._flight.record(self.flightMain, 'ANSWER', 180)
+        self._ringStart(self._eventStamp)
+
+    def _onCallState(self, snapshot):
+        # callbacks only have a weakref.proxy to the call so go by the callback
+        if snapshot.callback is not self._callCb:
+            # late news about a call we have already finished with
+            return
+        self._callInfo = snapshot
+        state = snapshot.state
+        wasConnected = self.callConnected
+        self.callConnected = state == pj.CallState.CONFIRMED
+        if state == pj.CallState.DISCONNECTED:
+            outgoing = self.fOutgoing.is_set()
+            self.callDisconnected()
+            if outgoing and not wasConnected:
+                self.logger.info("Call failed {} {}".format(snapshot.last_code, snapshot.last_reason))
+                self._startTone(self._failureTone(snapshot.last_code))
+        else:
+            if state == pj.CallState.EARLY and self.fOutgoing.is_set() and self._tone is None:
+                self._startTone(tones.RINGBACK)
+            elif state == pj.CallState.CONFIRMED:
+                self._stopTone()
+            self._checkCall()
+
+    def _onMediaState(self, snapshot):
+        if snapshot.callback is not self._callCb:
+            return
+        self._callInfo = snapshot
+        if snapshot.media_state == pj.MediaState.ACTIVE:
+            # early media replaces our ringback
+            self._stopTone()
+            # Connect the call to sound device
+            if not self._app.claimSound(self):
+                self.logger.warn("Sound device is in use by another handset, call has no audio")
+                return
+            call_slot = snapshot.conf_slot
+            try:
+                self._app._lib.conf_connect(call_slot, 0)
+                self._app._lib.conf_connect(0, call_slot)
+            except pj.Error, e:
+                # hung up while this event was waiting, the slot has gone
+                self.logger.info("Call ended before its media could be connected: {}".format(e))
+                self._app.releaseSound(self)
+                return
+            self.logger.info("Media is now active")
+        else:
+            self.logger.info("Media is inactive")
+
+    def _onRegState(self, data):
+        callback, status, active, reason = data
+        if callback is not self._accCallback:
+            # from an account we have since moved off
+            return
+        first = self.regStatus is None
+        # read by the metrics thread
+        self.regStatus = status
+        self.regActive = active
+        if status == 200 and active:
+            self._regFailedUntil.pop(self._serverIndex, None)
+            if 'registered' not in self.startup:
+                self._startupMilestone('registered', self._eventStamp)
+            self.logger.info("Account registration successful")
+            if self._pendingDigits:
+                self._digits = self._pendingDigits
+                self._dropPendingCall()
+                self._placeCall()
+        elif status >= 200:
+            self.logger.warn("Account registration with {} failed {} {}".format(self.server, status, reason))
+            if len(self._servers) > 1:
+                self._regFailedUntil[self._serverIndex] = timers.monotonic() + self._regRetry
+                self._timers.schedule(self._regRetry, self.checkServer)
+                self.checkServer()
+            # a held number keeps waiting if we moved to another server
+            if self._pendingDigits and self.regStatus is not None:
+                self._failPendingCall()
+        elif first:
+            self.logger.info("Account registering")
+
+    def _dropPendingCall(self):
+        self._timers.cancel(self._registerTimer)
+        self._registerTimer = None
+        self._pendingDigits = None
+
+    def _failPendingCall(self):
+        """ Registration failed or took too long, give up on the number
+        """
+        self.logger.warn("Could not dial {}, not registered".format(self._pendingDigits))
+        self.callStats['failed'] += 1
+        self._dropPendingCall()
+        self._startTone(tones.CONGESTION)
+
+    def isRegistered(self):
+        return self.regActive and self.regStatus == 200
+
+    def _onSerialStopped(self, data):
+        self._state = self.ERROR
+        self._timers.cancel(self._serialCheckTimer)
+        if self._SerialFailCount >= self._SerialFailCountLimit:
+            self.logger.error("Serial thread failed to recover after {} retries, Exiting".format(self._SerialFailCountLimit))
+            self._app.die()
+        # back off 1, 2, 4... seconds between restarts
+        delay = self._serialRetryDelay * 2 ** self._SerialFailCount
+        self._SerialFailCount += 1
+        self.logger.error("Serial thread stopped, wait {} before trying to re-establish".format(delay))
+        self._timers.schedule(delay, self._restartSerial)
+
+    def _restartSerial(self):
+        self.serialStats['reconnects'] += 1
+        self._startSerail()
+        self._serialCheckTimer = self._timers.schedule(self._serialHealthyTime, self._checkSerialRecovered)
+
+    def _checkSerialRecovered(self):
+        # a thread that died again will have posted another SERIAL_STOPPED
+        if self._serialRunning():
+            self.logger.info("Serial thread recovered")
+            self._state = self.RUNNING
+            self._SerialFailCount = 0
+            
+    def _ringStart(self, inviteStamp=None):
+        if not self.fRingState.is_set():
+            self.logger.info("Ringing Started")
+            latency = None
+            if inviteStamp is not None:
+                latency = (self.latency['invite_to_ring'], inviteStamp)
+            if self._queueSerialOut(self._ringStartCommand, latency):
+                self.fRingState.set()
+                if self._settings.ring_timeout:
+                    self._ringTimer = self._timers.schedule(self._settings.ring_timeout, self._onRingTimeout)
+
+    def _ringStop(self):
+        self._timers.cancel(self._ringTimer)
+        if self.fRingState.is_set():
+            self.logger.info("Ringing Stop")
+            if self._queueSerialOut(self._ringStopCommand):
+                self.fRingState.clear()
+
+    def _onRingTimeout(self):
+        """ Nobody picked up, stop the bell and turn the caller away
+        """
+        self.logger.info("No answer after {}s".format(self._settings.ring_timeout))
+        self._ringStop()
+        if self._call and not self.fOutgoing.is_set():
+            self.callStats['unanswered'] += 1
+            try:
+                self._flight.record(self.flightMain, 'HANGUP', 480)
+                self._call.hangup(480, "Temporarily Unavailable")
+            except pj.Error, e:
+                self.logger.warn("Failed to reject unanswered call: {}".format(e))
+
+    def callDisconnected(self):
+        self.logger.info("Current call disconnected")
+        self._stopTone()
+        if self.fRingState.is_set():
+            self._ringStop()
+        self.fOutgoing.clear()
+        self._call = None
+        self._callInfo = None
+        self._callCb = None
+        self.callConnected = False
+        self._app.releaseSound(self)
+        # a reload or server change may have been put off for the call
+        if self._reregisterPending:
+            self._reregister()
+        self.checkServer()
+
+    def _makeCall(self):
+        self._timers.cancel(self._dialTimer)
+        self._dialState = None
+        self.fDialing.clear()
+        if not self.isRegistered():
+            registerWait = self._settings.register_wait
+            if self.regStatus is None and registerWait:
+                # still registering for the first time, dial once that is done
+                self.logger.info("Not registered yet, holding {} for up to {}s".format(self._digits,
+                                                                                    registerWait))
+                self._pendingDigits = self._digits
+                self._registerTimer = self._timers.schedule(registerWait, self._failPendingCall)
+            else:
+                self.logger.warn("Could not dial {}, not registered".format(self._digits))
+                self.callStats['failed'] += 1
+                self._startTone(tones.CONGESTION)
+            self._digits = None
+            return
+        self._placeCall()
 
-    # Notification when call's media state has changed.
-    def on_media_state(self):
-        if self.call.info().media_state == pj.MediaState.ACTIVE:
-            # Connect the call to sound device
-            call_slot = self.call.info().conf_slot
-            pj.Lib.instance().conf_connect(call_slot, 0)
-            pj.Lib.instance().conf_connect(0, call_slot)
-            self._phone.logger.info("callCallback: Media is now active")
+    def _placeCall(self):
+        self.logger.info("Making call to {}".format(self._digits))
+        self._flight.record(self.flightMain, 'MAKE_CALL', self._digits)
+        self.fOutgoing.set()
+        uri = "sip:{}@{}".format(self._digits, self.server)
+        self._digits = None
+        self.callStats['outgoing'] += 1
+        lck = self._app._lib.auto_lock()
+        try:
+            self._callCb = PayPhoneCallCallback(self)
+            self._call = self._acc.make_call(uri, cb=self._callCb)
+            self._callInfo = CallSnapshot(self._call, self._callCb)
+        except pj.Error, e:
+            # nothing is in progress, left set fOutgoing would stop the next incoming call being answered
+            self.fOutgoing.clear()
+            self._call = None
+            self._callCb = None
+            self.callStats['failed'] += 1
+            self._flight.record(self.flightMain, 'CALL_FAILED', str(e)[:64])
+            self.logger.exception("Exception when making call {}".format(e))
+            self._startTone(tones.CONGESTION)
         else:
-            self._phone.logger.info("callCallback: Media is inactive")
-
-    def on_dtmf_digit(self, digits):
-        self._phone.logger.info("callCallback: Recived DTMF: {}".format(digits))
+            if self._lastDigitStamp is not None:
+                self.latency['digit_to_invite'].observe(timers.monotonic() - self._lastDigitStamp)
+        self._lastDigitStamp = None
+        del lck
 
 class PayPhone():
     _configFile = "./PayPhone.cfg"
@@ -119,36 +1261,40 @@ class PayPhone():
     _pidFileTimeout = 5
     _background = False
     
-    _SerialFailCount = 0
-    _SerialFailCountLimit = 3
-    _serialTimeout = 1     # serial port time out setting
-    
     _version = 0.01
     
     _lib = None
-    _acc = None
     _transport = None
-    _call = None
-    
-    _dailDigits = "1234567890*#"
-    _ringStartCommand = "R"
-    _ringStopCommand = "r"
-    _onHookKey = "H"
-    _offHookKey = "h"
-    _followKey = "F"
-    _dailingLastTime = None
-    _dailingTimeout = 1
-    _digits = None
+    _soundOwner = None      # handset currently wired to the sound device
+    _soundDevice = None     # (capture, playback) pjsua is set to, None for its default
     
     _state = ""
     RUNNING = "RUNNING"
     ERROR = "ERROR"
+    
+    _engine = "threaded"
+    THREADED = "threaded"   # serial threads, pjsua worker thread and main thread
+    SELECT = "select"       # everything on the main thread in one select() loop
+    
+    _metrics = None         # metrics.MetricsServer when [Metrics] is enabled
+    sipHealth = None        # siphealth.HealthMonitor when a handset has more than one server
+    tones = None            # tones.ToneSet unless [Media] tones is off
+    _logQueue = None        # logqueue.QueueHandler the loggers feed when [Debug] log_queue is on
+    _logWriter = None       # logqueue.QueueWriter, writes _logQueue out from tLogWriter
+    _pjLog = None           # pjlog.PjLogRouter pjsua calls with its log lines
+    _pjLevel = None         # level pjsua was started logging at, fixed until a restart
+    settings = None         # settings.Settings, replaced as a whole by a reload
+    _flightFile = "./PayPhone.flight"   # until the settings are loaded
 
     _ActionHelp = """
 start = Starts as a background daemon/service
 stop = Stops a daemon/service if running
 restart = Restarts the daemon/service
 status = Check if a PayPhone serveice is running
+dump = Ask a running daemon/service to write out its
+       latency report and flight recorder
+reload = Ask a running daemon/service to reread its
+         config files and apply what has changed
 If none of the above are given and no daemon/service
 is running then run in the current terminal
 """
@@ -167,16 +1313,28 @@ is running then run in the current terminal
                            signal.SIGTERM: self._cleanUp,
                            signal.SIGHUP: self.terminate,
                            signal.SIGUSR1: self._reloadProgramConfig,
+                           signal.SIGUSR2: self._requestLatencyReport,
                           }
+        # set by SIGUSR2, the report is written from the main loop
+        self._latencyReportWanted = False
+        self._flightDumpWanted = False
+        # set by SIGUSR1, as is the reload
+        self._reloadWanted = False
+        # off until _initFlightRecorder() has the configured size
+        self.flight = flightrecorder.FlightRecorder(0)
+        self.startStamp = timers.monotonic()    # run() resets it, startup is timed from here
 
         self.tMainStop = threading.Event()
-        self.qDial = Queue.Queue()
         
-        self.fHookState = threading.Event()
-        self.fRingState = threading.Event()
-        self.fFollowSate = threading.Event()
-        self.fDialing = threading.Event()
-        self.fOutgoing = threading.Event()
+        # everything the main thread reacts to arrives on here
+        self.qEvents = events.EventQueue()
+        # deadlines the main thread acts on, uses the monotonic clock
+        self._timers = timers.TimerScheduler(logger=logging.getLogger('PayPhone'))
+        self._eventHandlers = {
+                               events.SIP_HEALTH: self._onSipHealth,
+                              }
+        
+        self.handsets = []
     
         # setup initial Logging
         logging.getLogger().setLevel(logging.NOTSET)
@@ -223,7 +1381,7 @@ is running then run in the current terminal
         parser = argparse.ArgumentParser(description='PayPhone',
                                          formatter_class=argparse.RawTextHelpFormatter)
         parser.add_argument('action', nargs = '?',
-                            choices=('start', 'stop', 'restart', 'status'),
+                            choices=('start', 'stop', 'restart', 'status', 'dump', 'reload'),
                             help =self._ActionHelp)
         #parser.add_argument('-u', '--noupdate',
         #                    help='disable checking for update',
@@ -234,6 +1392,12 @@ is running then run in the current terminal
         parser.add_argument('-l', '--log',
                             help='Override the console debug logging level, DEBUG, INFO, WARNING, ERROR, CRITICAL'
                             )
+        parser.add_argument('-e', '--engine',
+                            choices=(self.THREADED, self.SELECT),
+                            default=self.THREADED,
+                            help='threaded = separate serial and pjsua threads (default)\n'
+                                 'select = run serial, pjsua and timers from one select loop'
+                            )
                             
         self.args = parser.parse_args()
     
@@ -293,6 +1457,12 @@ is running then run in the current terminal
             elif self.args.action == 'status':
                 self._dstatus()
                 return False
+            elif self.args.action == 'dump':
+                self._dsignal(signal.SIGUSR2, "write its latency report and flight recorder")
+                return False
+            elif self.args.action == 'reload':
+                self._dsignal(signal.SIGUSR1, "reload its config")
+                return False
                     
     def _dstart(self):
         """Kick off a daemon process
@@ -342,6 +1512,24 @@ is running then run in the current terminal
                 self.logger.debug("Stopped pid {}".format(pid))
                 return True
 
+    def _dsignal(self, signal_number, what):
+        """ Send a signal to a running process base on PID file
+        """
+        if self._isPidfileStale(self._pidFile):
+            self._pidFile.break_lock()
+            self.logger.debug("Removed Stale Lock")
+        pid = self._pidFile.read_pid()
+        if pid is None:
+            print("PayPhone.py is not running")
+            return False
+        try:
+            os.kill(pid, signal_number)
+        except OSError, exc:
+            self.logger.warn("Failed to signal {}: {}: Try sudo".format(pid, exc))
+            return False
+        print("Asked PayPhone.py (PID {}) to {}".format(pid, what))
+        return True
+
     def _dstatus(self):
         """ Test the PID file to see if we are running some where
             Return
@@ -371,36 +1559,54 @@ is running then run in the current terminal
            we are running in the foreground or as a daemon/service
         """
         
+        self.startStamp = timers.monotonic()
         try:
             self._readConfig()          # read in the config file
+            self._initFlightRecorder()  # in memory trail of recent events
             self._initLogging()         # setup the logging options
-            self._initSerialThread()    # start the serial port thread
-            self.tMainStop.wait(1)
+            self._initEngine()          # threaded or single select loop
+            self._initHandsets()        # one per phone in the config
+            self._initMetrics()         # optional Prometheus endpoint
+            self._initSipHealth()       # probes for SIP server failover
+            for handset in self.handsets:
+                handset.initSerial()    # start the serial port threads
 
             # start up the pjsip stuff
             try:
                 self._lib = pj.Lib()
-                mediaConfig = pj.MediaConfig()
-                if not sys.platform == 'darwin':
-                    mediaConfig.clock_rate = 44100
+                profile = self.settings.media.profile
+                mediaConfig = profile.apply(pj.MediaConfig())
                 
-                logConfig = pj.LogConfig(level=3,
-                                         console_level = 3,
-                                         callback=self.pjlog_cb)
+                pjLevel = self._initPjLog()
+                logConfig = pj.LogConfig(level=pjLevel,
+                                         console_level = pjLevel,
+                                         callback=self._pjLog)
                 self._lib.init(log_cfg = logConfig, media_cfg = mediaConfig)
+                codecs = profile.applyCodecs(self._lib, self.logger)
+                self.logger.info("Media {}".format(profile.describe()))
+                self.logger.info("Media {}".format(profile.effective(mediaConfig)))
+                self.logger.info("Codecs offered {}".format(", ".join(codecs)))
+                self._initTones(mediaConfig.clock_rate)
                 
                 self._transport = self._lib.create_transport(pj.TransportType.UDP)
 
-                self._lib.start()
+                # the select engine runs pjsua's events itself
+                self._lib.start(with_thread=(self._engine == self.THREADED))
                 self.logger.info("PJSIP Library started")
+                if self.tones:
+                    try:
+                        self.tones.create()
+                    except (pj.Error, IOError, OSError), e:
+                        # calls still work in silence
+                        self.logger.error("Failed to set up tones: {}".format(e))
+                        self.tones.destroy()
+                        self.tones = None
   
-                acc_cfg = pj.AccountConfig(self.config.get('SIP', 'server'),
-                                           self.config.get('SIP', 'username'),
-                                           self.config.get('SIP', 'secret'))
-
-                self._accCallback = PayPhoneAccountCallback(self)
-                self._acc = self._lib.create_account(acc_cfg, cb=self._accCallback)
-                self._accCallback.wait();
+                # every handset registers its own account over the one
+                # transport, that carries on in the background while the
+                # main loop runs and the handsets report back with REG_STATE
+                for handset in self.handsets:
+                    handset.initAccount()
             
 #                if sys.platform == 'darwin':
 #                    self._lib.set_snd_dev(1, 3)
@@ -409,75 +1615,16 @@ is running then run in the current terminal
                 self.logger.exception("Failed to setup PJSIP with exception: {}".format(e))
                 self.die()
 
-            try:
-                self.qSerialOut.put_nowait(self._onHookKey)
-            except Queue.Full:
-                self.logger.warn("Failed to put {} on qSerialOut at its Full".format(char))
+            for handset in self.handsets:
+                handset.requeryHook()
             
             self._state = self.RUNNING
 
             # main thread looks after the server status for us
-            while not self.tMainStop.is_set():
-                # check threads are running
-                if not self.tSerial.is_alive():
-                    self.logger.error("Serial thread stopped, wait 1 before trying to re-establish ")
-                    self._state = self.ERROR
-                    self.tMainStop.wait(1)
-                    self._startSerail()
-                    self.tMainStop.wait(1)
-                    if self.tSerial.is_alive():
-                        self._state = self.RUNNING
-                    else:
-                        self._SerialFailCount += 1
-                        if self._SerialFailCount > self._SerialFailCountLimit:
-                            self.logger.error("Serial thread failed to recover after {} retries, Exiting".format(self._SerialFailCountLimit))
-                            self.die()
-
-                if self._call:
-                    #in a call
-                    if self._call.info().state == 3 and not self.fHookState.is_set() and not self.fOutgoing.is_set():
-                        # answere the call
-                        self._ringStop()
-                        self._call.answer(200)
-                        self.logger.info("Call answered")
-                    elif self._call.info().state == 5 and self.fHookState.is_set():
-                        # end call we hung up
-                        self._call.hangup()
-                        self.fOutgoing.clear()
-                        self.logger.info("Call ended")
-
-                if not self.qDial.empty():
-                    try:
-                        digit = self.qDial.get_nowait()
-                    except Queue.Empty:
-                        pass
-                    else:
-                        if self._call:
-                            # send dtmf
-                            self._call.dial_dtmf(digit)
-                            self.logger.info("Sent DTMF {}".format(digit))
-                        elif not self.fHookState.is_set():
-                            # put together dial number
-                            self._dailingLastTime = time()
-                            if self.fDialing.is_set():
-                                # append a digit
-                                self._digits += digit
-                            else:
-                                # start building a number to dial
-                                self.logger.info("Starting Dail sequence")
-                                self._digits = digit
-                                self.fDialing.set()
-                        self.qDial.task_done()
-                            
-                if self.fDialing.is_set():
-                    if self.fHookState.is_set():
-                        self.logger.info("Dailing cancled")
-                        self.fDialing.clear()
-                        self._digits = None
-                    if (time() - self._dailingLastTime) > self._dailingTimeout:
-                        #dialing timed out lets make a call
-                        self._makeCall()
-                self.tMainStop.wait(0.5)
+            if self._engine == self.SELECT:
+                self._selectLoop()
+            else:
+                self._threadedLoop()
 
         except KeyboardInterrupt:
             self.logger.info("Keyboard Interrupt - Exiting")
@@ -485,30 +1632,383 @@ is running then run in the current terminal
             sys.exit()
         self.logger.debug("Exiting")
 
+    def _threadedLoop(self):
+        """ Main loop for the threaded engine, serial and pjsua have their own
+            threads which post to qEvents
+        """
+        while not self.tMainStop.is_set():
+            if self._latencyReportWanted:
+                self._writeLatencyReport()
+            if self._flightDumpWanted:
+                self._dumpFlightRecorder("SIGUSR2")
+            if self._reloadWanted:
+                self._reloadConfig()
+            try:
+                event = self.qEvents.get(self._timers.timeout())
+            except Queue.Empty:
+                # a timer is due or a signal interrupted us
+                pass
+            else:
+                self._dispatchEvent(event)
+            
+            self._timers.runDue()
+
+    def _selectLoop(self):
+        """ Main loop for the select engine, one select() covers the serial
+            ports, qEvents and the serial wakeup pipes then pjsua is given a
+            turn to handle its events so its callbacks run on this thread
+        """
+        while not self.tMainStop.is_set():
+            if self._latencyReportWanted:
+                self._writeLatencyReport()
+            if self._flightDumpWanted:
+                self._dumpFlightRecorder("SIGUSR2")
+            if self._reloadWanted:
+                self._reloadConfig()
+            # pjsua has no fd to wait on, without its worker thread nothing
+            # reads its sockets or runs its timers unless handle_events() is
+            # called, so it is polled. Quickly during a call or registration,
+            # when idle only often enough to pick up an incoming call
+            sip = self.settings.sip
+            if any(handset.sipBusy() for handset in self.handsets):
+                timeout = sip.poll_interval
+            else:
+                timeout = sip.idle_poll_interval
+            deadlines = [self._timers.timeout()]
+            
+            fds = [self.qEvents.fileno()]
+            for handset in self.handsets:
+                fds.extend(handset.selectFds())
+                deadlines.append(handset.selectTimeout())
+            deadlines = [deadline for deadline in deadlines if deadline is not None]
+            if deadlines:
+                timeout = min(timeout, min(deadlines))
+            try:
+                readable = select.select(fds, [], [], timeout)[0]
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            
+            for handset in self.handsets:
+                handset.serviceSerial(readable)
+            
+            self._lib.handle_events(0)
+            
+            while True:
+                try:
+                    event = self.qEvents.get(0)
+                except Queue.Empty:
+                    break
+                self._dispatchEvent(event)
+            
+            self._timers.runDue()
+
+    def _initEngine(self):
+        """ Check the requested engine can run here
+        """
+        self._engine = self.args.engine
+        if self._engine == self.SELECT and sys.platform == 'win32':
+            self.logger.warn("select engine is not supported on windows, using threaded")
+            self._engine = self.THREADED
+        self.logger.info("Using {} engine".format(self._engine))
+
+    def _initHandsets(self):
+        """ Build a Handset for each [Handset <name>] section, these take
+            their defaults from [Serial], [SIP] and [Phone]. With no handset
+            sections [Serial] and [SIP] describe a single handset
+        """
+        for handsetSettings in self.settings.handsets:
+            self.handsets.append(Handset(self, handsetSettings))
+        
+        self.logger.info("Running {} handset(s): {}".format(len(self.handsets),
+                                                          ", ".join(handset.name for handset in self.handsets)))
+
+    def _initMetrics(self):
+        """ Start serving metricsText() if [Metrics] enabled is set
+        """
+        settings = self.settings.metrics
+        if not settings.enabled:
+            return
+        self._metrics = metrics.MetricsServer(self.metricsText, self.logger,
+                                              settings.address, settings.port, settings.socket)
+        try:
+            self._metrics.start()
+        except (socket.error, OSError), e:
+            # the phone still works without its metrics
+            self.logger.error("Failed to start the metrics server: {}".format(e))
+            self._metrics = None
+
+    def _initFlightRecorder(self):
+        """ Size the flight recorder from [Debug], 0 turns it off
+        """
+        self.flight = flightrecorder.FlightRecorder(self.settings.debug.flight_recorder_size)
+
+    def _initTones(self, rate):
+        """ Synthesise the call progress tones at the bridge's clock rate
+        """
+        if not self.settings.media.tones:
+            return
+        started = timers.monotonic()
+        self.tones = tones.ToneSet(self._lib, self.logger, rate, self.settings.media.tone_dir)
+        self.logger.debug("Tones synthesised in {:.1f}ms".format((timers.monotonic() - started) * 1000))
+
+    def _initSipHealth(self):
+        """ Start checking SIP servers for every handset that has a choice of them
+        """
+        servers = set()
+        for handset in self.handsets:
+            if len(handset.healthServers()) > 1:
+                servers.update(handset.healthServers())
+        if not servers:
+            return
+        settings = self.settings.sip
+        self.sipHealth = siphealth.HealthMonitor(sorted(servers),
+                                                 lambda server, up: self.qEvents.post(events.SIP_HEALTH,
+                                                                                      (server, up)),
+                                                 self.logger, settings.health_interval, settings.health_timeout,
+                                                 settings.health_fall, settings.health_rise)
+        self.sipHealth.start()
+
+    def metricsText(self):
+        """ Prometheus text page, runs on the metrics thread so only reads
+            counters the other threads keep up to date
+        """
+        page = metrics.Exposition()
+        page.add("payphone_info", "gauge", "Version and engine of the running daemon",
+                 [({'version': self._version, 'engine': self._engine}, 1)])
+        page.add("payphone_running", "gauge", "1 once startup has finished",
+                 [({}, self._state == self.RUNNING)])
+        page.add("payphone_event_queue_depth", "gauge", "Events waiting for the main thread",
+                 [({}, len(self.qEvents))])
+        page.add("payphone_flight_records_total", "counter", "Events written to the flight recorder",
+                 [({}, self.flight.total())])
+        if self._pjLog:
+            page.add("payphone_pjsip_log_lines_total", "counter", "Log lines pjsip passed up to Python",
+                     [({}, self._pjLog.lines)])
+            page.add("payphone_pjsip_log_dropped_total", "counter", "pjsip log lines over a sender's rate limit",
+                     [({'sender': sender}, state.dropped) for sender, state in sorted(self._pjLog.senders.items())])
+        if self._logQueue:
+            page.add("payphone_log_queue_depth", "gauge", "Log records waiting for tLogWriter",
+                     [({}, self._logQueue.depth())])
+            page.add("payphone_log_queue_max_depth", "gauge", "Most log records ever waiting at once",
+                     [({}, self._logQueue.maxDepth)])
+            page.add("payphone_log_records_queued_total", "counter", "Log records put on the queue",
+                     [({}, self._logQueue.queued)])
+            page.add("payphone_log_records_dropped_total", "counter", "Log records lost to a full queue",
+                     [({'level': level}, count) for level, count in sorted(self._logQueue.dropped.items())])
+            if self._logWriter:
+                page.add("payphone_log_batches_total", "counter", "Batches tLogWriter has written out",
+                         [({}, self._logWriter.batches)])
+        if isinstance(getattr(self, '_fh', None), logfiles.RotatingLogFile):
+            page.add("payphone_log_rotations_total", "counter", "Times the log file was moved aside",
+                     [({}, self._fh.rotations)])
+            page.add("payphone_log_compressed_total", "counter", "Old log files gzipped by tLogCompress",
+                     [({}, self._fh.compressed)])
+        
+        handsets = [({'handset': handset.name}, handset) for handset in self.handsets]
+        page.add("payphone_serial_queue_depth", "gauge", "Commands waiting on qSerialOut",
+                 [(labels, len(handset.qSerialOut.queue) if hasattr(handset, 'qSerialOut') else 0)
+                  for labels, handset in handsets])
+        page.add("payphone_serial_up", "gauge", "1 while the serial link is running",
+                 [(labels, hasattr(handset, '_serial') and handset._state != handset.ERROR)
+                  for labels, handset in handsets])
+        for key, name, help in (('rx_bytes', 'payphone_serial_rx_bytes_total', "Bytes read from the board"),
+                                ('tx_bytes', 'payphone_serial_tx_bytes_total', "Bytes written to the board"),
+                                ('tx_batches', 'payphone_serial_tx_writes_total', "write() calls to the port"),
+                                ('tx_commands', 'payphone_serial_tx_commands_total', "Commands taken off qSerialOut"),
+                                ('tx_timeouts', 'payphone_serial_tx_timeouts_total', "Writes that missed write_timeout"),
+                                ('frames_lost', 'payphone_serial_frames_lost_total', "Board frames missing from the sequence"),
+                                ('commands_failed', 'payphone_serial_commands_failed_total', "Framed commands never acked"),
+                                ('reconnects', 'payphone_serial_reconnects_total', "Serial thread restarts after a failure")):
+            page.add(name, "counter", help,
+                     [(labels, handset.serialStats[key]) for labels, handset in handsets])
+        page.add("payphone_serial_crc_errors_total", "counter", "Frames dropped for a bad CRC",
+                 [(labels, handset._decoder.crcErrors) for labels, handset in handsets])
+        
+        page.add("payphone_sip_registered", "gauge", "1 while the account is registered",
+                 [(labels, handset.isRegistered()) for labels, handset in handsets])
+        page.add("payphone_sip_registration_status", "gauge", "Last registration status code, 0 before the first",
+                 [(labels, handset.regStatus or 0) for labels, handset in handsets])
+        page.add("payphone_startup_seconds", "gauge", "Seconds from start to each startup milestone",
+                 [(dict(labels, milestone=milestone), seconds)
+                  for labels, handset in handsets
+                  for milestone, seconds in sorted(handset.startup.items())])
+        page.add("payphone_sip_server_active", "gauge", "1 for the server each handset is registering with",
+                 [(dict(labels, server=registrar), index == handset._serverIndex)
+                  for labels, handset in handsets
+                  for index, (registrar, proxy) in enumerate(handset._servers)])
+        page.add("payphone_sip_server_switches_total", "counter", "Times the account moved to another server",
+                 [(labels, handset.serverSwitches) for labels, handset in handsets])
+        if self.sipHealth:
+            servers = [({'server': server}, health) for server, health in sorted(self.sipHealth.servers.items())]
+            page.add("payphone_sip_server_up", "gauge", "1 while the server answers OPTIONS, missing until known",
+                     [(labels, health.up) for labels, health in servers if health.up is not None])
+            page.add("payphone_sip_server_rtt_seconds", "gauge", "Smoothed OPTIONS round trip time",
+                     [(labels, health.rtt) for labels, health in servers if health.rtt is not None])
+            page.add("payphone_sip_server_probes_total", "counter", "OPTIONS requests sent",
+                     [(labels, health.probes) for labels, health in servers])
+            page.add("payphone_sip_server_probes_answered_total", "counter", "OPTIONS requests answered",
+                     [(labels, health.answered) for labels, health in servers])
+        page.add("payphone_call_active", "gauge", "1 while the handset has a call",
+                 [(labels, handset._call is not None) for labels, handset in handsets])
+        page.add("payphone_call_connected", "gauge", "1 while the call is answered at both ends",
+                 [(labels, handset.callConnected) for labels, handset in handsets])
+        page.add("payphone_calls_total", "counter", "Calls by direction and outcome",
+                 [(dict(labels, kind=kind), count)
+                  for labels, handset in handsets
+                  for kind, count in sorted(handset.callStats.items())])
+        
+        page.add("payphone_dtmf_digits_total", "counter", "Digits sent as DTMF during calls",
+                 [(labels, handset.dtmfDigits) for labels, handset in handsets])
+        
+        page.addHistogram("payphone_latency_seconds", "Event entering the system to the action it caused",
+                          [(dict(labels, path=path), handset.latency[path])
+                           for labels, handset in handsets
+                           for path in sorted(handset.latency)])
+        return page.text()
+
+    def claimSound(self, handset):
+        """ Give handset the sound device for its call
+            returns
+                True if the handset now owns the sound device
+                False if another handset is using it
+            pjsua has a single sound device so only one handset can have
+            audio at a time, it is switched to the handsets sound_device
+        """
+        if self._soundOwner not in (None, handset):
+            return False
+        soundDevice = handset._settings.sound_device
+        if soundDevice and soundDevice != self._soundDevice:
+            self._lib.set_snd_dev(*soundDevice)
+            self._soundDevice = soundDevice
+        self._soundOwner = handset
+        return True
+
+    def releaseSound(self, handset):
+        if self._soundOwner is handset:
+            self._soundOwner = None
+
     def _readConfig(self):
         """Read the server config file from disk
         """
         self.logger.info("Reading config files")
-        self.config = ConfigParser.SafeConfigParser()
-        
-        # load defaults
         try:
-            self.config.readfp(open(self._configFile))
-            self.config.read(self._configSecretFile)
-    
+            config = self._loadConfig()
         except:
             self.logger.error("Could Not Load Settings File")
             self.die()
-                
-        if not self.config.sections():
-            self.logger.critical("No Config Loaded, Exiting")
+        
+        try:
+            self.settings = settings.load(config)
+        except ValueError, e:
+            self.logger.critical("Bad config, Exiting: {}".format(e))
             self.die()
 
-    def _reloadProgramConfig(self):
-        """ Reload the config file from disk
+    def _loadConfig(self):
+        config = ConfigParser.SafeConfigParser()
+        config.readfp(open(self._configFile))
+        config.read(self._configSecretFile)
+        return config
+
+    def _reloadProgramConfig(self, signal_number=None, stack_frame=None):
+        """ SIGUSR1 handler, flag the reload for the main loop which can
+            safely stop and start threads
         """
-        # TODO: do we want to be able reload config on SIGUSR1?
-        pass
+        self._reloadWanted = True
+
+    def _reloadConfig(self):
+        """ Reread the config files and apply only what has changed, the
+            rest of the running phone is left alone. Anything that can not
+            change without pjsua starting again is reported as needing a
+            restart and takes effect on the next one
+        """
+        self._reloadWanted = False
+        self.logger.info("Reloading config files")
+        try:
+            new = settings.load(self._loadConfig())
+        except Exception, e:
+            self.logger.error("Config reload failed, keeping the running config: {}".format(e))
+            return
+        
+        old = self.settings
+        changed = ["{}.{}".format(group, name) for group in ('debug', 'sip', 'metrics', 'media')
+                   for name in getattr(new, group).changed(getattr(old, group))]
+        if len(new.handsets) != len(old.handsets):
+            changed.append("handsets")
+        else:
+            changed.extend("{} {}".format(handset.name, name) for handset, running in zip(new.handsets, old.handsets)
+                           for name in handset.changed(running))
+        self.flight.record("main", 'RELOAD', len(changed))
+        if not changed:
+            self.logger.info("Config reloaded, nothing has changed")
+            return
+        # one reference, readers see the old settings or the new
+        self.settings = new
+        applied = []
+        failed = []
+        restart = []
+        
+        # flight_file and latency_file are read each time they are written
+        debug = [name for name in new.debug.changed(old.debug) if name not in ('flight_file', 'latency_file')]
+        if 'flight_recorder_size' in debug:
+            debug.remove('flight_recorder_size')
+            restart.append("debug.flight_recorder_size")
+        if [name for name in debug if not name.startswith('pjsip_')]:
+            self._stopLogging()
+            self._initLogging()
+            applied.append("logging")
+        if debug:
+            pjLevel = self._configurePjLog()
+            applied.append("pjsip log limits")
+            if pjLevel != self._pjLevel:
+                restart.append("pjsip logging at level {} rather than {}".format(pjLevel, self._pjLevel))
+        
+        if [handset.name for handset in new.handsets] != [handset.name for handset in self.handsets]:
+            restart.append("handsets {}".format(", ".join(handset.name for handset in new.handsets)))
+            new = new.replace(handsets=tuple(handset._settings for handset in self.handsets))
+        else:
+            for handset, handsetSettings in zip(self.handsets, new.handsets):
+                done, notDone = handset.reload(handsetSettings)
+                applied.extend(done)
+                failed.extend(notDone)
+            # a handset keeps the settings it could not apply
+            new = new.replace(handsets=tuple(handset._settings for handset in self.handsets))
+        self.settings = new
+        
+        # the poll intervals are read by the select loop each time round
+        if ([name for name in new.sip.changed(old.sip) if name.startswith('health_')] or
+                [handset.healthServers() for handset in new.handsets] !=
+                [handset.healthServers() for handset in old.handsets]):
+            if self.sipHealth:
+                self.sipHealth.stop()
+                self.sipHealth = None
+            self._initSipHealth()
+            applied.append("SIP health checks")
+        
+        if new.metrics != old.metrics:
+            if self._metrics:
+                self._metrics.stop()
+                self._metrics = None
+            self._initMetrics()
+            applied.append("metrics server")
+        
+        if new.media != old.media:
+            changes = sorted(new.media.profile.changed(old.media.profile))
+            if new.media.changed(old.media) == ['profile'] and changes == ['codecs']:
+                codecs = new.media.profile.applyCodecs(self._lib, self.logger)
+                applied.append("codecs offered {}".format(", ".join(codecs)))
+            else:
+                restart.append("media " + ", ".join(changes + [name for name in new.media.changed(old.media)
+                                                             if name != 'profile']))
+        
+        self.logger.info("Config reloaded, {} setting(s) changed: {}".format(len(changed), ", ".join(changed)))
+        for change in applied:
+            self.logger.info("Reload applied {}".format(change))
+        for change in failed:
+            self.logger.error("Reload could not apply {}".format(change))
+        if restart:
+            self.logger.warn("Reload needs a restart for {}".format("; ".join(restart)))
 
     def _initLogging(self):
         """ now we have the config file loaded and the command line args setup
@@ -517,218 +2017,196 @@ is running then run in the current terminal
         self.logger.info("Setting up Loggers. Console output may stop here")
 
         # disable logging if no options are enabled
+        debug = self.settings.debug
         if (self.args.debug == False and
-            self.config.getboolean('Debug', 'console_debug') == False and
-            self.config.getboolean('Debug', 'file_debug') == False):
+            debug.console_debug == False and
+            debug.file_debug == False and
+            debug.syslog_debug == False):
             self.logger.debug("Disabling loggers")
             # disable debug output
             self.logger.setLevel(100)
             return
         # set console level
-        if (self.args.debug or self.config.getboolean('Debug', 'console_debug')):
+        if (self.args.debug or debug.console_debug):
             self.logger.debug("Setting Console debug level")
+            numeric_level = debug.console_level
             if (self.args.log):
-                logLevel = self.args.log
-            else:
-                logLevel = self.config.get('Debug', 'console_level')
-        
-            numeric_level = getattr(logging, logLevel.upper(), None)
-            if not isinstance(numeric_level, int):
-                raise ValueError('Invalid console log level: %s' % loglevel)
+                numeric_level = getattr(logging, self.args.log.upper(), None)
+                if not isinstance(numeric_level, int):
+                    raise ValueError('Invalid console log level: %s' % self.args.log)
             self._ch.setLevel(numeric_level)
         else:
             self._ch.setLevel(100)
-            
+
         # add file logging if enabled
-        # TODO: look at rotating log files
-        # http://docs.python.org/2/library/logging.handlers.html#logging.handlers.TimedRotatingFileHandler
-        if (self.config.getboolean('Debug', 'file_debug')):
+        if debug.file_debug:
             self.logger.debug("Setting file debugger")
-            self._fh = logging.FileHandler(self.config.get('Debug', 'log_file'))
+            # queued, tLogWriter flushes once per batch
+            self._fh = logfiles.RotatingLogFile(debug.log_file,
+                                                maxBytes=debug.log_rotate_bytes,
+                                                interval=debug.log_rotate_interval,
+                                                backupCount=debug.log_backup_count,
+                                                compress=debug.log_compress,
+                                                batched=debug.log_queue)
             self._fh.setFormatter(self._formatter)
-            logLevel = self.config.get('Debug', 'file_level')
-            numeric_level = getattr(logging, logLevel.upper(), None)
-            if not isinstance(numeric_level, int):
-                raise ValueError('Invalid console log level: %s' % loglevel)
-            self._fh.setLevel(numeric_level)
+            self._fh.setLevel(debug.file_level)
             self.logger.addHandler(self._fh)
             self.logger.info("File Logging started")
-                
-    def _initSerialThread(self):
-        """ Setup the serial port and start the thread
+
+        # add syslog if enabled
+        if debug.syslog_debug:
+            try:
+                self._sh = logging.handlers.SysLogHandler(debug.syslog_address, debug.syslog_facility)
+            except socket.error, e:
+                self.logger.error("Failed to open syslog {}: {}".format(debug.syslog_address, e))
+            else:
+                self._sh.setFormatter(logging.Formatter('PayPhone[%(process)d]: %(name)s - %(levelname)s - %(message)s'))
+                self._sh.setLevel(debug.syslog_level)
+                self.logger.addHandler(self._sh)
+                self.logger.info("Syslog Logging started")
+
+        if debug.log_queue:
+            self._initLogQueue()
+
+    def _initLogQueue(self):
+        """ Move the handlers behind a queue so logging never waits on the
+            console, SD card or syslog, tLogWriter writes them out in batches
         """
-        self.logger.info("Serial port init")
+        debug = self.settings.debug
+        handlers = [handler for handler in self.logger.handlers if handler.level < 100]
+        self._logQueue = logqueue.QueueHandler(debug.log_queue_size, debug.log_queue_drop)
+        self._logWriter = logqueue.QueueWriter(self._logQueue, handlers,
+                                               debug.log_queue_batch, debug.log_queue_flush_interval)
+        # records no handler wants are not worth queueing
+        self._logQueue.setLevel(self._logWriter.level())
+        self._logWriter.start()
+        for handler in list(self.logger.handlers):
+            self.logger.removeHandler(handler)
+        self.logger.addHandler(self._logQueue)
+        self.logger.debug("Logging through a queue of {}, dropping the {} record when full".format(
+                          debug.log_queue_size, debug.log_queue_drop))
 
-        # serial port base on config file, thread handles opening and closing
-        self._serial = serial.Serial()
-        self._serial.port = self.config.get('Serial', 'port')
-        self._serial.baud = self.config.get('Serial', 'baudrate')
-        self._serial.timeout = self._serialTimeout
-        
-        # setup queue
-        self.qSerialOut = Queue.Queue()
-        
-        # setup thread
-        self.tSerialStop = threading.Event()
-        
-        self._startSerail()
-    
-    def _startSerail(self):
-        self.tSerial = threading.Thread(name='tSerial', target=self._SerialThread)
-        self.tSerial.daemon = False
-    
-        try:
-            self.tSerial.start()
-        except:
-            self.logger.exception("Failed to Start the Serial thread")
+    def _stopLogQueue(self):
+        """ Write out what is queued and log directly again from here on
+        """
+        if self._logWriter is None:
+            return
+        self.logger.removeHandler(self._logQueue)
+        for handler in self._logWriter.handlers:
+            self.logger.addHandler(handler)
+        self._logWriter.stop()
+        self._logWriter = None
 
-    def _SerialThread(self):
-        """ Serial Thread
+    def _stopLogging(self):
+        """ Close every handler _initLogging() set up, the console handler
+            stays for it to set up again
         """
-        self.logger.info("tSerial: Serial thread started")
- 
-        self.tSerialStop.wait(1)
-        try:
-            while (not self.tSerialStop.is_set()):
-                # open the port
-                try:
-                    self._serial.open()
-                    self.logger.info("tSerial: Opened the serial port")
-                except serial.SerialException:
-                    self.logger.exception("tSerial: Failed to open port {} Exiting".format(self._serial.port))
-                    self._serial.close()
-                    self.die()
-                
-                self.tSerialStop.wait(0.1)
-                
-                # we clear out any stale serial messages that might be in the buffer
-                self._serial.flushInput()
-                
-                # main serial processing loop
-                while self._serial.isOpen() and not self.tSerialStop.is_set():
-                    # extrem debug message
-                    # self.logger.debug("tSerial: check serial port")
-                    if self._serial.inWaiting():
-                        self._SerialReadIncoming()
-                    
-                    # do we have anything to send
-                    if not self.qSerialOut.empty():
-                        self.logger.debug("tSerial: got something to send")
-                        try:
-                            msg = self.qSerialOut.get_nowait()
-                            self._serial.write(msg)
-                        except Queue.Empty:
-                            self.logger.debug("tSerial: failed to get item from queue")
-                        except serial.SerialException, e:
-                            self.logger.warn("tSerial: failed to write to the serial port {}: {}".format(self._serial.port, e))
-                        else:
-                             self.logger.debug("tSerial: TX:{}".format(msg))
-                             self.qSerialOut.task_done()
-                
-                    # sleep for a little
-                    if self._serial.inWaiting():
-                        self.tSerialStop.wait(0.01)
-                    else:
-                        self.tSerialStop.wait(0.1)
-                
-                # port closed for some reason (or tSerialStop), if tSerialStop is not set we will try reopening
-        except IOError:
-            self.logger.exception("tSerail: IOError on serial port")
+        self._stopLogQueue()
+        for handler in list(self.logger.handlers):
+            if handler is not self._ch:
+                self.logger.removeHandler(handler)
+                handler.close()
+        # the queue only hands back the handlers it was writing to
+        if self._ch not in self.logger.handlers:
+            self.logger.addHandler(self._ch)
+        self._fh = None
+        self._sh = None
+        self.logger.setLevel(logging.NOTSET)
+
+    def _initPjLog(self):
+        """ Route pjsip's log lines to the PayPhone.pjsip logger, returns
+            the level pjsua should log at so anything we would throw away
+            is dropped before it leaves C
+        """
+        self._pjLog = pjlog.PjLogRouter(logging.getLogger('PayPhone.pjsip'))
+        self._pjLevel = self._configurePjLog()
+        return self._pjLevel
+
+    def _configurePjLog(self):
+        """ Set the pjsip logger level and the router's limits from [Debug],
+            returns the level pjsua would need to log at for them
+        """
+        debug = self.settings.debug
+        pjLogger = logging.getLogger('PayPhone.pjsip')
+        # stays off with the rest of logging
+        pjLogger.setLevel(max(debug.pjsip_log_level, self.logger.level))
         
-        # close the port
-        self.logger.info("tSerial: Closing serial port")
-        self._serial.close()
+        # the lowest level anything would still be written at
+        wanted = pjLogger.getEffectiveLevel()
+        if self.logger.handlers:
+            wanted = max(wanted, min(handler.level for handler in self.logger.handlers))
+        pjLevel = max(0, min(debug.pjsip_level, pjlog.pjLevelFor(wanted)))
         
-        self.logger.info("tSerial: Thread stoping")
-        return
+        self._pjLog.setLimits(debug.pjsip_rate, debug.pjsip_burst, debug.pjsip_sample)
+        self.logger.debug("pjsip logging at level {} of {}, {} lines a second per sender".format(
+                          pjLevel, debug.pjsip_level, debug.pjsip_rate or "unlimited"))
+        return pjLevel
     
-    def _SerialReadIncoming(self):
-        char = self._serial.read()  # should not time out but we should check anyway
-        self.logger.debug("tSerial: RX:{}".format(char))
-    
-        if char in self._dailDigits:
-            # posible handle mutiple reads before putting on the queue? (check inWaiting)
-            try:
-                self.qDial.put_nowait(char);
-            except Queue.Full:
-                self.logger.warn("tSerial: Failed to put {} on qDial at its Full".format(char))
-            return
-        if char == self._onHookKey:
-            # set on Hook Flag
-            self.fHookState.set()
-            self.logger.info("tSerial: Phone on hook")
-        if char == self._offHookKey:
-            # set off Hook Flag
-            self.fHookState.clear()
-            self.logger.info("tSerial: Phone off hook")
-        if char == self._followKey:
-            #set follow on call flag
-            self.fFollowSate.set()
-            self.logger.info("tSerial: Follow key Pressed")
-    
-    def pjlog_cb(self, level, str, len):
-        self.logger.info(str)
-    
-    def getAccount(self):
-        return self._acc
-    
-    def getCall(self):
-        return self._call
-    
-    def setCall(self, call):
-        self._call = call
-    
-    def on_incoming_call(self, call):
-        if self._call:
-            self.logger.info("Rejected Busy")
-            call.answer(486, "Busy")
-            return
-        
-        self._call = call
-        
-        call_cb = PayPhoneCallCallback(self)
-        self._call.set_callback(call_cb)
+    def _dispatchEvent(self, event):
+        """ Hand an event from qEvents to its handler, runs on the main thread
+        """
+        self.flight.record(event.source.flightMain if event.source else "main", event.type,
+                           flightrecorder.compact(event.data))
+        try:
+            if event.source is not None:
+                event.source.handleEvent(event)
+                return
+            handler = self._eventHandlers.get(event.type)
+            if handler:
+                handler(event.data)
+        except Exception:
+            # one bad event must not take the main loop down
+            self.logger.exception("Failed to handle {} event".format(event.type))
 
-        self._call.answer(180)
-        self._ringStart()
-            
-    def _ringStart(self):
-        if not self.fRingState.is_set():
-            self.logger.info("Ringing Started")
-            try:
-                self.qSerialOut.put_nowait(self._ringStartCommand);
-                self.fRingState.set()
-            except Queue.Full:
-                self.logger.warn("Failed to put {} on qSerialOut at its Full".format(char))
+    def _onSipHealth(self, data):
+        server, up = data
+        for handset in self.handsets:
+            if server in handset.healthServers():
+                handset.checkServer()
 
-    def _ringStop(self):
-        if self.fRingState.is_set():
-            self.logger.info("Ringing Stop")
-            try:
-                self.qSerialOut.put_nowait(self._ringStopCommand);
-                self.fRingState.clear()
-            except Queue.Full:
-                self.logger.warn("Failed to put {} on qSerialOut at its Full".format(char))
+    def _requestLatencyReport(self, signal_number=None, stack_frame=None):
+        """ SIGUSR2 handler, the queues and histograms use locks the
+            interrupted code may hold so only flag it for the main loop
+        """
+        self._latencyReportWanted = True
+        self._flightDumpWanted = True
 
-    def callDisconnected(self):
-        self.logger.info("Current call disconnected")
-        if self.fRingState.is_set():
-            self._ringStop()
-        self.fOutgoing.clear()
-        self._call = None
+    def latencyReport(self):
+        """ Text summary of every handsets latency histograms
+        """
+        lines = ["PayPhone latency report {}".format(strftime("%Y-%m-%d %H:%M:%S", gmtime()))]
+        for handset in self.handsets:
+            lines.append("[{}]".format(handset.name))
+            for milestone, seconds in sorted(handset.startup.items()):
+                lines.append("  startup {:<24} {:8.1f} ms".format(milestone, seconds * 1000))
+            for name in sorted(handset.latency):
+                lines.append("  " + handset.latency[name].report())
+        return "\n".join(lines) + "\n"
 
-    def _makeCall(self):
-        self.logger.info("Making call to {}".format(self._digits))
-        self.fDialing.clear()
-        self.fOutgoing.set()
-        uri = "sip:{}@{}".format(self._digits, self.config.get('SIP', 'server'))
-        self._digits = None
-        lck = self._lib.auto_lock()
+    def _writeLatencyReport(self):
+        self._latencyReportWanted = False
+        report = self.latencyReport()
+        path = self.settings.debug.latency_file
         try:
-            self._call = self._acc.make_call(uri, cb=PayPhoneCallCallback(self))
-        except pj.Error, e:
-            self.logger.exception("Exception when making call {}".format(e))
-        del lck
+            with open(path, 'w') as f:
+                f.write(report)
+        except IOError, e:
+            self.logger.warn("Could not write latency report to {}: {}".format(path, e))
+        self.logger.info("Latency report:\n{}".format(report))
+
+    def _dumpFlightRecorder(self, reason):
+        """ Write the flight recorder to [Debug] flight_file
+        """
+        self._flightDumpWanted = False
+        path = self._flightFile
+        if self.settings is not None:
+            path = self.settings.debug.flight_file
+        try:
+            count = self.flight.dump(path, reason)
+        except IOError, e:
+            self.logger.warn("Could not write flight recorder to {}: {}".format(path, e))
+        else:
+            self.logger.info("Flight recorder wrote {} records to {}".format(count, path))
 
 # Run Stuff
 ################################################################################
@@ -773,24 +2251,40 @@ is running then run in the current terminal
         """
         # first stop the main thread from try to restart stuff
         self.tMainStop.set()
+        self.qEvents.post(events.STOP)
         # now stop the other threads
-        try:
-            self.tSerialStop.set()
-            self.tSerial.join()
-        except:
-            pass
+        for handset in self.handsets:
+            try:
+                handset.stopSerial()
+            except:
+                pass
+        
+        if self._metrics:
+            self._metrics.stop()
+            self._metrics = None
+        if self.sipHealth:
+            self.sipHealth.stop()
+            self.sipHealth = None
         
         # remove pjsip stuff
+        if self.tones:
+            try:
+                self.tones.destroy()
+            except pj.Error:
+                pass
+            self.tones = None
         try:
-            self.hangup_all()
+            self._lib.hangup_all()
             self._transport = None
-            self._acc.delete()
-            self._acc = None
+            for handset in self.handsets:
+                handset.deleteAccount()
             self._lib.destroy()
             self._lib = None
         except:
             pass
 
+        self._stopLogQueue()
+
         if not self._background:
             if not sys.platform == 'win32':
                 try:
@@ -819,6 +2313,8 @@ is running then run in the current terminal
             Try cleaning up what we can and exit
         """
         self.logger.critical("DIE")
+        if self.flight.total():
+            self._dumpFlightRecorder("die")
         self._cleanUp()
 
         sys.exit(1)
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Nottingham Hackspace payphone client
+# Call state machine benchmark
+#
+# Drives simulated incoming and outgoing calls through a Handset using the
+# fakepj SIP backend, no serial port, network or PBX needed. Every cycle is
+# checked so this doubles as a regression run of the call logic
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2014 Matt Lloyd
+#
+
+import sys
+import os
+import argparse
+import ConfigParser
+import Queue
+from time import time
+
+os.environ['PAYPHONE_SIP_BACKEND'] = 'fake'
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+import fakepj
+import settings
+import PayPhone
+
+
+def loadSettings(name, options):
+    """Settings as the phone would load them from a config with one
+       [Handset name] section holding options
+    """
+    config = ConfigParser.SafeConfigParser()
+    section = "{} {}".format(settings.HANDSET_PREFIX, name)
+    config.add_section(section)
+    for option, value in options.items():
+        config.set(section, option, value)
+    return settings.load(config)
+
+
+class CallStorm():
+    def __init__(self, engine, options=None):
+        """ options are handset settings on top of the benchmark's own
+        """
+        self.phone = PayPhone.PayPhone()
+        self.phone.logger.setLevel(100)
+        self.phone._engine = engine
+        self.phone._state = self.phone.RUNNING
+        handset = {'port': 'none',
+                   'server': 'fake',
+                   'username': '668',
+                   'secret': '',
+                   'dial_timeout': '0',
+                   'ring_timeout': '0'}
+        handset.update(options or {})
+        self.phone.settings = loadSettings('storm', handset)
+        self.handset = PayPhone.Handset(self.phone, self.phone.settings.handsets[0])
+        self.phone.handsets.append(self.handset)
+        # ring commands go nowhere
+        self.handset.qSerialOut = Queue.Queue()
+        self.handset._serialWakeWrite = None
+        self.handset.fHookState.set()
+
+        self.lib = self.phone._lib = fakepj.Lib()
+        self.lib.init(log_cfg=fakepj.LogConfig(level=0))
+        self.lib.start(with_thread=(engine == PayPhone.PayPhone.THREADED))
+        self.handset.initAccount()
+        self.settle(lambda: self.handset.regStatus == 200)
+
+    def close(self):
+        self.lib.destroy()
+
+    def settle(self, done, limit=5):
+        """Run the main loop until done() or nothing happens for a while
+        """
+        deadline = time() + limit
+        while not done():
+            if time() > deadline:
+                raise AssertionError("stuck, call is {!r}".format(self.handset.getCall()))
+            if self.phone._engine == PayPhone.PayPhone.SELECT:
+                self.lib.handle_events(0)
+            try:
+                event = self.phone.qEvents.get(0 if self.phone._engine == PayPhone.PayPhone.SELECT else 0.01)
+            except Queue.Empty:
+                pass
+            else:
+                self.phone._dispatchEvent(event)
+            self.phone._timers.runDue()
+        while True:
+            try:
+                self.handset.qSerialOut.get_nowait()
+            except Queue.Empty:
+                break
+
+    def hook(self, offHook):
+        if offHook:
+            self.handset._serialOffHook()
+        else:
+            self.handset._serialOnHook()
+
+    def incomingCall(self):
+        """Ring, lift, talk, hang up
+        """
+        handset = self.handset
+        self.lib.incoming(handset.getAccount())
+        self.settle(lambda: handset.fRingState.is_set())
+        self.hook(True)
+        self.settle(lambda: handset.callConnected and self.lib.connections)
+        self.hook(False)
+        self.settle(lambda: handset.getCall() is None)
+
+    def outgoingCall(self):
+        """Lift, dial, key some DTMF, hang up
+        """
+        handset = self.handset
+        self.hook(True)
+        handset._post(PayPhone.events.DIGITS, "668")
+        self.settle(lambda: handset.callConnected and self.lib.connections)
+        handset._post(PayPhone.events.DIGITS, "123")
+        self.settle(lambda: handset.dtmfDigits % 3 == 0 and not len(self.phone.qEvents))
+        self.hook(False)
+        self.settle(lambda: handset.getCall() is None)
+
+    def abandonedCall(self):
+        """Lift, dial and hang up while it is still ringing
+        """
+        handset = self.handset
+        fakepj.settings.answer_delay = -1
+        try:
+            self.hook(True)
+            handset._post(PayPhone.events.DIGITS, "668")
+            self.settle(lambda: handset.getCall() is not None)
+            self.hook(False)
+            self.settle(lambda: handset.getCall() is None)
+        finally:
+            fakepj.settings.answer_delay = 0
+
+
+def run(engine, cycles):
+    storm = CallStorm(engine)
+    try:
+        for name, cycle in (('incoming', storm.incomingCall),
+                            ('outgoing', storm.outgoingCall),
+                            ('abandoned', storm.abandonedCall)):
+            infoBefore = storm.lib.stats['call_info']
+            start = time()
+            for n in xrange(cycles):
+                cycle()
+            elapsed = time() - start
+            print("{:<8} {:<9}: {:>6} calls {:8.3f}s {:>8.0f} calls/s {:>5.1f} Call.info() per call".format(
+                  engine, name, cycles, elapsed, cycles / elapsed,
+                  float(storm.lib.stats['call_info'] - infoBefore) / cycles))
+        stats = storm.handset.callStats
+        expected = {'incoming': cycles, 'answered': cycles, 'outgoing': 2 * cycles, 'failed': 0}
+        for key, value in expected.items():
+            if stats[key] != value:
+                raise AssertionError("{} is {} expected {}".format(key, stats[key], value))
+        if storm.handset.dtmfDigits != 3 * cycles:
+            raise AssertionError("sent {} DTMF digits expected {}".format(storm.handset.dtmfDigits, 3 * cycles))
+    finally:
+        storm.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='PayPhone call state machine benchmark')
+    parser.add_argument('-c', '--cycles', type=int, default=2000,
+                        help='calls of each kind')
+    parser.add_argument('-e', '--engine', choices=('threaded', 'select', 'both'), default='both')
+    args = parser.parse_args()
+
+    for engine in ('threaded', 'select') if args.engine == 'both' else (args.engine,):
+        run(engine, args.cycles)
@@ -0,0 +1,329 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Nottingham Hackspace payphone client
+# End to end benchmark suite
+#
+# Runs PayPhone.py against the Payphone.ino emulator and reads the results
+# back from its metrics endpoint, results are written as JSON
+#
+#   python e2e.py --server pbx.example.org --username 668 --secret ... \
+#                 --extension 600 --output results.json
+#
+# PayPhone must be able to register, the keys test also needs --extension to
+# answer (an echo test is ideal) and is skipped when it does not. With
+# --fake-sip PayPhone runs on the simulated SIP stack in fakepj.py instead
+# and no PBX is needed
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2014 Matt Lloyd
+#
+
+import sys
+import os
+import re
+import json
+import socket
+import shutil
+import signal
+import argparse
+import platform
+import tempfile
+import subprocess
+import urllib2
+from time import sleep, strftime, gmtime
+
+_here = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(_here, '..'))
+import timers
+import emulator
+
+_sample = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(\{[^}]*\})?\s+(\S+)$')
+_label = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"')
+
+
+def freePort():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def cpuSeconds(pid):
+    """utime + stime of a process from /proc
+    """
+    with open("/proc/{}/stat".format(pid)) as f:
+        # skip past the command name, it may contain spaces
+        fields = f.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / float(os.sysconf('SC_CLK_TCK'))
+
+
+class Daemon():
+    """PayPhone.py running in a scratch directory with a generated config
+    """
+    def __init__(self, args, port):
+        self._args = args
+        self.metricsPort = freePort()
+        self.dir = tempfile.mkdtemp(prefix='payphone-e2e-')
+        config = open(os.path.join(_here, '..', 'PayPhone.cfg')).read()
+        replacements = [(r'(?m)^port = /dev/ttyAMA0$', 'port = {}'.format(port)),
+                        (r'(?m)^protocol = auto$', 'protocol = {}'.format(args.protocol)),
+                        (r'(?m)^dial_timeout = .*$', 'dial_timeout = {}'.format(args.dial_timeout)),
+                        (r'(?m)^enabled = False$', 'enabled = True'),
+                        (r'(?m)^port = 9110$', 'port = {}'.format(self.metricsPort)),
+                        (r'(?m)^server = .*$', 'server = {}'.format(args.server)),
+                        (r'(?m)^username = .*$', 'username = {}'.format(args.username))]
+        for pattern, replacement in replacements:
+            config = re.sub(pattern, replacement, config, count=1)
+        with open(os.path.join(self.dir, 'PayPhone.cfg'), 'w') as f:
+            f.write(config)
+        with open(os.path.join(self.dir, 'Secret.cfg'), 'w') as f:
+            f.write("[SIP]\nsecret = {}\n".format(args.secret))
+
+    def start(self):
+        env = dict(os.environ)
+        if self._args.fake_sip is not None:
+            env['PAYPHONE_SIP_BACKEND'] = 'fake'
+            env['PAYPHONE_FAKE_SIP'] = self._args.fake_sip
+        self.started = timers.monotonic()
+        self.process = subprocess.Popen([sys.executable, os.path.join(_here, '..', 'PayPhone.py'),
+                                         '--engine', self._args.engine],
+                                        cwd=self.dir, env=env)
+
+    def stop(self):
+        if self.process.poll() is None:
+            self.process.send_signal(signal.SIGTERM)
+            for n in range(50):
+                if self.process.poll() is not None:
+                    break
+                sleep(0.1)
+            else:
+                self.process.kill()
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def scrape(self):
+        """{(name, frozenset(labels)): value} from the metrics endpoint, None
+           while it is not answering
+        """
+        try:
+            page = urllib2.urlopen("http://127.0.0.1:{}/metrics".format(self.metricsPort), timeout=1).read()
+        except (urllib2.URLError, socket.error):
+            return None
+        samples = {}
+        for line in page.splitlines():
+            match = _sample.match(line)
+            if match:
+                labels = frozenset(_label.findall(match.group(2) or ""))
+                samples[(match.group(1), labels)] = float(match.group(3))
+        return samples
+
+    def value(self, name, default=0, **labels):
+        samples = self.scrape() or {}
+        return samples.get((name, frozenset(labels.items())), default)
+
+    def waitFor(self, test, timeout, interval=0.005):
+        """Poll the metrics until test(samples) is true, returns the monotonic
+           time it was first seen or None on timeout
+        """
+        deadline = timers.monotonic() + timeout
+        while timers.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError("PayPhone exited with {}".format(self.process.returncode))
+            samples = self.scrape()
+            if samples is not None and test(samples):
+                return timers.monotonic()
+            sleep(interval)
+        return None
+
+
+def summarise(values):
+    if not values:
+        return {'count': 0}
+    values = sorted(values)
+    return {
+            'count': len(values),
+            'mean': sum(values) / len(values),
+            'min': values[0],
+            'p50': values[len(values) // 2],
+            'p90': values[min(len(values) - 1, int(len(values) * 0.9))],
+            'max': values[-1],
+           }
+
+
+def benchStartup(daemon, board, args):
+    running = daemon.waitFor(lambda s: s.get(('payphone_running', frozenset())) == 1, args.startup_timeout)
+    if running is None:
+        raise RuntimeError("PayPhone did not finish starting in {}s".format(args.startup_timeout))
+    results = {'startup_seconds': running - daemon.started}
+    # the daemons own view, timed from run() so interpreter start up is not counted
+    for milestone in ('first_serial_event', 'registered'):
+        key = ('payphone_startup_seconds', frozenset({'handset': args.username, 'milestone': milestone}.items()))
+        if daemon.waitFor(lambda s: key in s, args.startup_timeout) is not None:
+            results[milestone + '_seconds'] = daemon.scrape().get(key)
+    return results
+
+
+def benchIdle(daemon, board, args):
+    # let startup work settle before measuring
+    sleep(1)
+    before = cpuSeconds(daemon.process.pid)
+    started = timers.monotonic()
+    sleep(args.idle_seconds)
+    used = cpuSeconds(daemon.process.pid) - before
+    elapsed = timers.monotonic() - started
+    return {
+            'window_seconds': elapsed,
+            'cpu_seconds': used,
+            'cpu_seconds_per_idle_hour': used / elapsed * 3600,
+           }
+
+
+def benchHook(daemon, board, args):
+    """Off hook, key the extension and time until make_call() and, if the far
+       end answers, until hanging up ends the call
+    """
+    handset = {'handset': args.username}
+    dialSeconds = []
+    hangupSeconds = []
+    for n in range(args.calls):
+        outgoing = daemon.value('payphone_calls_total', kind='outgoing', **handset)
+        board.setHook(True)
+        board.press(args.extension)
+        keyed = timers.monotonic()
+        dialed = daemon.waitFor(lambda s: s.get(('payphone_calls_total',
+                                                 frozenset(dict(handset, kind='outgoing').items()))) > outgoing,
+                                args.dial_timeout + 5)
+        if dialed is not None:
+            dialSeconds.append(dialed - keyed)
+            active = daemon.waitFor(lambda s: s.get(('payphone_call_connected', frozenset(handset.items()))) == 1, 5)
+            if active is not None:
+                board.setHook(False)
+                hungUp = timers.monotonic()
+                ended = daemon.waitFor(lambda s: s.get(('payphone_call_active', frozenset(handset.items()))) == 0, 5)
+                if ended is not None:
+                    hangupSeconds.append(ended - hungUp)
+        board.setHook(False)
+        sleep(args.settle)
+    return {
+            'dial_timeout': args.dial_timeout,
+            'last_key_to_make_call_seconds': summarise(dialSeconds),
+            'on_hook_to_call_ended_seconds': summarise(hangupSeconds),
+           }
+
+
+def benchKeys(daemon, board, args):
+    """Press keys as fast as the serial link takes them during a call and
+       time until every one has been sent as DTMF
+    """
+    handset = {'handset': args.username}
+    board.setHook(True)
+    board.press(args.extension)
+    active = daemon.waitFor(lambda s: s.get(('payphone_call_connected', frozenset(handset.items()))) == 1,
+                            args.dial_timeout + 10)
+    if active is None:
+        board.setHook(False)
+        return {'skipped': "extension {} did not answer".format(args.extension)}
+    sent = daemon.value('payphone_dtmf_digits_total', **handset)
+    keys = ("1234567890*#" * (args.keys // 12 + 1))[:args.keys]
+    started = timers.monotonic()
+    board.press(keys, args.key_interval)
+    done = daemon.waitFor(lambda s: s.get(('payphone_dtmf_digits_total', frozenset(handset.items()))) >= sent + len(keys),
+                          30)
+    board.setHook(False)
+    sleep(args.settle)
+    if done is None:
+        return {'keys': len(keys), 'error': "not every key was sent as DTMF"}
+    return {
+            'keys': len(keys),
+            'key_interval': args.key_interval,
+            'seconds': done - started,
+            'keys_per_second': len(keys) / (done - started),
+           }
+
+
+def daemonLatency(daemon):
+    """The daemons own latency histograms as count and mean per path
+    """
+    samples = daemon.scrape() or {}
+    paths = {}
+    for (name, labels), value in samples.items():
+        labels = dict(labels)
+        if name in ('payphone_latency_seconds_count', 'payphone_latency_seconds_sum'):
+            field = 'count' if name.endswith('_count') else 'sum'
+            paths.setdefault(labels['path'], {})[field] = value
+    for path in paths.values():
+        if path.get('count'):
+            path['mean'] = path['sum'] / path['count']
+    return paths
+
+
+BENCHMARKS = [
+              ('startup', benchStartup),
+              ('idle', benchIdle),
+              ('hook', benchHook),
+              ('keys', benchKeys),
+             ]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='PayPhone end to end benchmarks')
+    parser.add_argument('--server', default="fake", help='SIP server PayPhone registers with')
+    parser.add_argument('--username', default="668")
+    parser.add_argument('--secret', default="")
+    parser.add_argument('--extension', default="600", help='number to call, should answer')
+    parser.add_argument('--fake-sip', nargs='?', const="", metavar='SETTINGS',
+                        help='use the fakepj SIP stack, optionally with PAYPHONE_FAKE_SIP settings')
+    parser.add_argument('-e', '--engine', choices=('threaded', 'select'), default='threaded')
+    parser.add_argument('-p', '--protocol', choices=('auto', 'legacy'), default='auto')
+    parser.add_argument('--legacy-board', action='store_true',
+                        help='emulate firmware that only speaks single characters')
+    parser.add_argument('--dial-timeout', type=float, default=0.5)
+    parser.add_argument('--startup-timeout', type=float, default=30)
+    parser.add_argument('--idle-seconds', type=float, default=60,
+                        help='idle window, CPU is scaled up to an hour')
+    parser.add_argument('--calls', type=int, default=10)
+    parser.add_argument('--keys', type=int, default=200)
+    parser.add_argument('--key-interval', type=float, default=0,
+                        help='seconds between key presses, 0 sends them back to back')
+    parser.add_argument('--settle', type=float, default=0.5,
+                        help='pause between calls')
+    parser.add_argument('-o', '--output', default='-', help='JSON results file, - for stdout')
+    args = parser.parse_args()
+
+    board = emulator.Emulator(framed=not args.legacy_board)
+    board.start()
+    daemon = Daemon(args, board.port)
+    results = {
+               'suite': 'payphone-e2e',
+               'started': strftime("%Y-%m-%dT%H:%M:%SZ", gmtime()),
+               'host': platform.node(),
+               'machine': platform.machine(),
+               'python': platform.python_version(),
+               'engine': args.engine,
+               'protocol': args.protocol,
+               'board': 'legacy' if args.legacy_board else 'framed',
+               'sip': 'fake' if args.fake_sip is not None else args.server,
+               'results': {},
+              }
+    daemon.start()
+    try:
+        for name, bench in BENCHMARKS:
+            try:
+                results['results'][name] = bench(daemon, board, args)
+            except RuntimeError, e:
+                results['results'][name] = {'error': str(e)}
+                break
+        results['daemon_latency_seconds'] = daemonLatency(daemon)
+        results['board_framed'] = board.framed
+    finally:
+        daemon.stop()
+        board.stop()
+
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if args.output == '-':
+        print(text)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(text + "\n")
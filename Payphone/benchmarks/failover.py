@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Nottingham Hackspace payphone client
+# SIP server failover benchmark
+#
+# A handset with two sipstub.py servers on 127.0.0.1, the first is made to
+# fail and later recover. Times how long the account takes to move to the
+# second server and back, and checks calls go to the server in use. SIP
+# itself runs on fakepj, the stubs answer the OPTIONS health checks
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2014 Matt Lloyd
+#
+
+import sys
+import os
+import argparse
+from time import time
+
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+import callstorm
+import sipstub
+import siphealth
+import PayPhone
+
+
+def timeUntil(storm, done, limit):
+    started = time()
+    storm.settle(done, limit)
+    return time() - started
+
+
+def callServer(storm):
+    """Dial out and return the server the call went to
+    """
+    handset = storm.handset
+    storm.hook(True)
+    handset._post(PayPhone.events.DIGITS, "668")
+    storm.settle(lambda: handset.callConnected)
+    server = handset._callInfo.remote_uri.split('@', 1)[1]
+    storm.hook(False)
+    storm.settle(lambda: handset.getCall() is None)
+    return server
+
+
+def run(engine, args):
+    primary = sipstub.SipStub()
+    secondary = sipstub.SipStub()
+    primary.start()
+    secondary.start()
+    servers = ["127.0.0.1:{}".format(primary.port), "127.0.0.1:{}".format(secondary.port)]
+    storm = callstorm.CallStorm(engine, {'server': ",".join(servers)})
+    phone = storm.phone
+    handset = storm.handset
+    phone.sipHealth = siphealth.HealthMonitor(handset.healthServers(),
+                                              lambda server, up: phone.qEvents.post(PayPhone.events.SIP_HEALTH,
+                                                                                    (server, up)),
+                                              phone.logger, args.interval, args.timeout, args.fall, args.rise)
+    phone.sipHealth.start()
+    limit = (args.fall + args.rise + 2) * args.interval + 5
+    try:
+        storm.settle(lambda: all(health.up for health in phone.sipHealth.servers.values()), limit)
+        for failure in ('silent', 'closed'):
+            if failure == 'silent':
+                primary.silent = True
+            else:
+                primary.stop()
+            failover = timeUntil(storm, lambda: handset.server == servers[1] and handset.isRegistered(), limit)
+            during = callServer(storm)
+
+            if failure == 'silent':
+                primary.silent = False
+            else:
+                primary.start()
+            failback = timeUntil(storm, lambda: handset.server == servers[0] and handset.isRegistered(), limit)
+            after = callServer(storm)
+            if (during, after) != (servers[1], servers[0]):
+                raise AssertionError("calls went to {} and {}".format(during, after))
+            print("{:<8} primary {:<6}: failover {:6.2f}s  failback {:6.2f}s".format(engine, failure,
+                                                                                   failover, failback))
+        for server in servers:
+            health = phone.sipHealth.servers[server]
+            print("{:<8} {:<16} rtt {:6.3f}ms  {}/{} probes answered".format(engine, server, health.rtt * 1000,
+                                                                          health.answered, health.probes))
+        if handset.serverSwitches != 4:
+            raise AssertionError("{} server switches expected 4".format(handset.serverSwitches))
+    finally:
+        phone.sipHealth.stop()
+        storm.close()
+        primary.stop()
+        secondary.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='PayPhone SIP failover benchmark')
+    parser.add_argument('-e', '--engine', choices=('threaded', 'select', 'both'), default='both')
+    parser.add_argument('--interval', type=float, default=0.5, help='seconds between health checks')
+    parser.add_argument('--timeout', type=float, default=0.25)
+    parser.add_argument('--fall', type=int, default=2)
+    parser.add_argument('--rise', type=int, default=3)
+    args = parser.parse_args()
+
+    for engine in ('threaded', 'select') if args.engine == 'both' else (args.engine,):
+        run(engine, args)
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Nottingham Hackspace payphone client
+# Logging cost benchmark
+#
+# Logs serial sized DEBUG lines from a few threads into a file whose
+# flushes stall like a busy SD card, once writing directly and once
+# through the log queue, and reports how long each logging call held up
+# the thread that made it
+#
+#   python logcost.py --records 20000 --stall 0.05 --every 50
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2014 Matt Lloyd
+#
+
+import sys
+import os
+import time
+import argparse
+import logging
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+import timers
+import metrics
+import logqueue
+import logfiles
+
+LOG_BUCKETS = (0.00001, 0.00002, 0.00005, 0.0001, 0.0002, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1)
+
+
+class StallingFile():
+    """File that sleeps on every every'th flush, as an SD card does when it
+       erases a block
+    """
+    def __init__(self, path, stall, every):
+        self._file = open(path, 'a')
+        self._stall = stall
+        self._every = every
+        self.flushes = 0
+
+    def write(self, data):
+        self._file.write(data)
+
+    def flush(self):
+        self.flushes += 1
+        self._file.flush()
+        if self.flushes % self._every == 0:
+            time.sleep(self._stall)
+
+    def close(self):
+        self._file.close()
+
+
+def run(queued, args, path):
+    logger = logging.getLogger('logcost.{}'.format('queued' if queued else 'direct'))
+    logger.propagate = False
+    logger.setLevel(logging.DEBUG)
+    handler = logfiles.RotatingLogFile(path, batched=queued, delay=True)
+    handler.stream = StallingFile(path, args.stall, args.every)
+    handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+    queue = writer = None
+    if queued:
+        queue = logqueue.QueueHandler(args.size, args.drop)
+        writer = logqueue.QueueWriter(queue, [handler])
+        writer.start()
+        logger.addHandler(queue)
+    else:
+        logger.addHandler(handler)
+
+    histogram = metrics.Histogram('queued' if queued else 'direct', buckets=LOG_BUCKETS)
+
+    def hot():
+        for n in xrange(args.records // args.threads):
+            started = timers.monotonic()
+            logger.debug("tSerial: RX:{!r}".format("h1234567890*#H"))
+            histogram.observe(timers.monotonic() - started)
+            if args.gap:
+                time.sleep(args.gap)
+
+    threads = [threading.Thread(target=hot) for n in xrange(args.threads)]
+    started = timers.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = timers.monotonic() - started
+    if writer:
+        writer.stop(60)
+    logger.removeHandler(queue or handler)
+    flushes = handler.stream.flushes
+    handler.close()
+    print("{} in {:.2f}s, {} flushes".format(histogram.report(), elapsed, flushes))
+    if queue:
+        print("{:<16} max depth {}, dropped {}".format('', queue.maxDepth, queue.droppedTotal()))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='PayPhone logging cost benchmark')
+    parser.add_argument('-n', '--records', type=int, default=20000)
+    parser.add_argument('-t', '--threads', type=int, default=3, help='logging threads, serial, pjsua and main')
+    parser.add_argument('--gap', type=float, default=0.0001, help='seconds between records on each thread')
+    parser.add_argument('--stall', type=float, default=0.05, help='seconds a stalled flush takes')
+    parser.add_argument('--every', type=int, default=50, help='one flush in this many stalls')
+    parser.add_argument('--size', type=int, default=10000, help='log_queue_size')
+    parser.add_argument('--drop', default=logqueue.DROP_NEWEST, choices=logqueue.DROP_POLICIES)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='payphone-logcost-')
+    try:
+        for queued in (False, True):
+            run(queued, args, os.path.join(directory, 'log'))
+    finally:
+        for name in os.listdir(directory):
+            os.remove(os.path.join(directory, name))
+        os.rmdir(directory)
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Nottingham Hackspace payphone client
+# Media profile CPU benchmark
+#
+# For each profile pjsua calls itself over 127.0.0.1 with the null sound
+# device, both ends of the call are wired into the conference bridge and
+# the CPU the process uses is measured while the call runs. Each profile
+# runs in its own process as pjsua can only be set up once per process
+#
+#   python mediacpu.py --seconds 30 --config ../PayPhone.cfg \
+#                      -p "mine:clock_rate=8000;codecs=PCMU"
+#
+# Profiles are [Media] settings separated by ; as codecs uses commas. Run
+# it on the Pi itself, with PAYPHONE_SIP_BACKEND=fake only the plumbing is
+# exercised and the numbers mean nothing
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2014 Matt Lloyd
+#
+
+import sys
+import os
+import json
+import logging
+import argparse
+import threading
+import subprocess
+import ConfigParser
+
+_here = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(_here, '..'))
+import timers
+import media
+
+PROFILES = [
+            ('legacy', "clock_rate=44100"),
+            ('narrowband', "clock_rate=8000;codecs=PCMA,PCMU"),
+            ('narrowband-snd48k', "clock_rate=8000;snd_clock_rate=48000;codecs=PCMA,PCMU"),
+            ('wideband', "clock_rate=16000;codecs=G722"),
+            ('lan-low-latency', "clock_rate=8000;codecs=PCMA,PCMU;preset=lan-low-latency"),
+            ('wifi-robust', "clock_rate=8000;codecs=PCMA,PCMU;preset=wifi-robust"),
+           ]
+
+
+def parseSettings(text):
+    options = {}
+    for item in text.split(';'):
+        if item.strip():
+            name, value = item.split('=', 1)
+            options[name.strip()] = value.strip()
+    return options
+
+
+def measure(settings, seconds):
+    """Run a looped call with the profile, returns the results dict
+    """
+    if os.environ.get('PAYPHONE_SIP_BACKEND') == 'fake':
+        import fakepj as pj
+    else:
+        import pjsua as pj
+
+    logger = logging.getLogger('mediacpu')
+    profile = media.MediaProfile(parseSettings(settings))
+    lib = pj.Lib()
+    mediaConfig = profile.apply(pj.MediaConfig())
+    # keep encoding during silence so every frame costs what speech would
+    mediaConfig.no_vad = True
+    lib.init(log_cfg=pj.LogConfig(level=0, console_level=0), media_cfg=mediaConfig)
+    codecs = profile.applyCodecs(lib, logger)
+    lib.set_null_snd_dev()
+    transport = lib.create_transport(pj.TransportType.UDP, pj.TransportConfig(0, "127.0.0.1"))
+    lib.start()
+
+    active = []
+    ready = threading.Event()
+
+    class LoopCall(pj.CallCallback):
+        def on_media_state(self):
+            info = self.call.info()
+            if info.media_state == pj.MediaState.ACTIVE:
+                lib.conf_connect(info.conf_slot, 0)
+                lib.conf_connect(0, info.conf_slot)
+                active.append(info.conf_slot)
+                if len(active) == 2:
+                    ready.set()
+
+    class LoopAccount(pj.AccountCallback):
+        def on_incoming_call(self, call):
+            self.incoming = call
+            call.set_callback(LoopCall(call))
+            call.answer(200)
+
+    try:
+        account = lib.create_account_for_transport(transport, cb=LoopAccount())
+        info = transport.info()
+        call = account.make_call("sip:{}:{}".format(info.host, info.port), cb=LoopCall())
+        ready.wait(10)
+        if not ready.is_set():
+            raise RuntimeError("looped call did not get media on both ends")
+        before = os.times()
+        started = timers.monotonic()
+        ready.clear()
+        ready.wait(seconds)
+        after = os.times()
+        elapsed = timers.monotonic() - started
+        call.hangup()
+    finally:
+        lib.destroy()
+    cpu = (after[0] - before[0]) + (after[1] - before[1])
+    return {
+            'settings': settings,
+            'profile': profile.describe(),
+            'effective': profile.effective(mediaConfig),
+            'codecs_offered': codecs,
+            'seconds': elapsed,
+            'cpu_seconds': cpu,
+            'cpu_percent': cpu / elapsed * 100,
+           }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='PayPhone media profile CPU benchmark')
+    parser.add_argument('-p', '--profile', action='append', default=[], metavar='NAME:SETTINGS',
+                        help='profile to run, may be repeated, the built in set is used if none are given')
+    parser.add_argument('-c', '--config', help='also run the [Media] section of this config')
+    parser.add_argument('-s', '--seconds', type=float, default=20, help='how long to measure each call')
+    parser.add_argument('-o', '--output', default='-', help='JSON results file, - for stdout')
+    parser.add_argument('--child', metavar='SETTINGS', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        print(json.dumps(measure(args.child, args.seconds)))
+        sys.exit()
+
+    profiles = [profile.split(':', 1) for profile in args.profile] or list(PROFILES)
+    if args.config:
+        config = ConfigParser.SafeConfigParser()
+        config.read(args.config)
+        if config.has_section('Media'):
+            profiles.append(('config', ";".join("{}={}".format(name, value)
+                                                for name, value in config.items('Media'))))
+
+    results = {}
+    for name, settings in profiles:
+        child = subprocess.Popen([sys.executable, os.path.realpath(__file__), '--child', settings,
+                                  '--seconds', str(args.seconds)], stdout=subprocess.PIPE)
+        output = child.communicate()[0]
+        if child.returncode:
+            results[name] = {'settings': settings, 'error': "exited with {}".format(child.returncode)}
+            continue
+        results[name] = json.loads(output.strip().splitlines()[-1])
+        sys.stderr.write("{:<20} {:6.2f}% CPU  {}\n".format(name, results[name]['cpu_percent'],
+                                                            results[name]['profile']))
+
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if args.output == '-':
+        print(text)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(text + "\n")
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Nottingham Hackspace payphone client
+# Serial ingestion throughput benchmark
+#
+# Feeds bursts of keypad and hook bytes through Handset._SerialReadIncoming
+# using an in memory port, no hardware or SIP server needed
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2014 Matt Lloyd
+#
+
+import sys
+import os
+import argparse
+import ConfigParser
+import random
+from time import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+import settings
+import PayPhone
+
+
+class BurstPort():
+    """Stands in for serial.Serial, hands out at most chunk bytes per read
+    """
+    def __init__(self, chunk):
+        self._chunk = chunk
+        self._buffer = ""
+
+    def feed(self, data):
+        self._buffer += data
+
+    def inWaiting(self):
+        return min(len(self._buffer), self._chunk)
+
+    def read(self, size=1):
+        data = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return data
+
+
+def makeBurst(size, hookRatio):
+    keys = "1234567890*#"
+    burst = []
+    for n in xrange(size):
+        if random.random() < hookRatio:
+            burst.append(random.choice("hHF"))
+        else:
+            burst.append(random.choice(keys))
+    return "".join(burst)
+
+
+def run(phone, handset, chunk, burst, bursts):
+    port = BurstPort(chunk)
+    handset._serial = port
+    wakeups = 0
+    start = time()
+    for n in xrange(bursts):
+        port.feed(burst)
+        while port.inWaiting():
+            handset._SerialReadIncoming()
+            wakeups += 1
+        # the main loop would normally be emptying this
+        while len(phone.qEvents):
+            phone.qEvents.get(0)
+    elapsed = time() - start
+    total = len(burst) * bursts
+    print("chunk {:>6}: {:>9} bytes {:>8} wakeups {:8.3f}s {:>12.0f} bytes/s".format(chunk,
+                                                                                   total,
+                                                                                   wakeups,
+                                                                                   elapsed,
+                                                                                   total / elapsed))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='PayPhone serial ingestion benchmark')
+    parser.add_argument('-s', '--size', type=int, default=4096,
+                        help='bytes per burst')
+    parser.add_argument('-b', '--bursts', type=int, default=200,
+                        help='number of bursts to feed')
+    parser.add_argument('-r', '--hook-ratio', type=float, default=0.01,
+                        help='fraction of bytes that are hook or follow events')
+    parser.add_argument('-l', '--log', action='store_true',
+                        help='leave INFO logging enabled, as when console_debug is on')
+    args = parser.parse_args()
+
+    random.seed(0)
+    phone = PayPhone.PayPhone()
+    # a handset needs a port and a SIP server even though neither is used
+    config = ConfigParser.SafeConfigParser()
+    config.add_section('Handset bench')
+    config.set('Handset bench', 'port', 'none')
+    config.set('Handset bench', 'server', 'bench')
+    config.set('Handset bench', 'username', 'bench')
+    phone.settings = settings.load(config)
+    handset = PayPhone.Handset(phone, phone.settings.handsets[0])
+    if not args.log:
+        phone.logger.setLevel(100)
+
+    burst = makeBurst(args.size, args.hook_ratio)
+    # chunk 1 is one byte per wakeup, the cost before reads were batched
+    for chunk in (1, 64, args.size):
+        run(phone, handset, chunk, burst, args.bursts)
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Nottingham Hackspace payphone client
+# Stand in SIP server
+#
+# Answers every request on a UDP port with 200 OK, enough for the OPTIONS
+# health checks and REGISTER. Can go silent or close its port to look like
+# a PBX that has hung or gone away
+#
+#   python sipstub.py --port 5070
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2014 Matt Lloyd
+#
+
+import sys
+import socket
+import select
+import argparse
+import threading
+
+_copied = ('via', 'v', 'from', 'f', 'to', 't', 'call-id', 'i', 'cseq')
+
+
+def answer(request, status=200, reason="OK"):
+    """Response to a SIP request, None if it is not one
+    """
+    lines = request.split("\r\n")
+    parts = lines[0].split()
+    if len(parts) != 3 or not parts[2].startswith("SIP/"):
+        return None
+    response = ["SIP/2.0 {} {}".format(status, reason)]
+    for line in lines[1:]:
+        if not line:
+            break
+        name = line.split(':', 1)[0].strip().lower()
+        if name in _copied:
+            if name in ('to', 't') and ';tag=' not in line:
+                line += ";tag=stub"
+            response.append(line)
+    if parts[0] == 'REGISTER':
+        response.append("Expires: 300")
+    response += ["Server: PayPhone sipstub", "Content-Length: 0", "", ""]
+    return "\r\n".join(response)
+
+
+class SipStub():
+    """A SIP server on 127.0.0.1 that answers everything, run from its own thread
+    """
+    def __init__(self, port=0, host='127.0.0.1'):
+        self._host = host
+        self.port = port
+        self.silent = False     # still take requests but never answer
+        self.requests = {}      # method: count
+        self._sock = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind((self._host, self.port))
+        self.port = self._sock.getsockname()[1]
+        self._stop.clear()
+        self._thread = threading.Thread(name='tSipStub', target=self._run, args=(self._sock,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Close the port, requests now get ICMP port unreachable
+        """
+        self._stop.set()
+        if self._thread:
+            self._thread.join(1)
+            self._thread = None
+        if self._sock:
+            self._sock.close()
+            self._sock = None
+
+    def _run(self, sock):
+        while not self._stop.is_set():
+            if not select.select([sock], [], [], 0.1)[0]:
+                continue
+            try:
+                data, peer = sock.recvfrom(65535)
+            except socket.error:
+                continue
+            method = data.split(' ', 1)[0]
+            self.requests[method] = self.requests.get(method, 0) + 1
+            response = answer(data)
+            if response and not self.silent:
+                sock.sendto(response, peer)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='SIP server stand in that answers everything')
+    parser.add_argument('-p', '--port', type=int, default=5060)
+    parser.add_argument('--host', default='127.0.0.1')
+    args = parser.parse_args()
+
+    stub = SipStub(args.port, args.host)
+    stub.start()
+    print("Answering SIP on {}:{}".format(args.host, stub.port))
+    sys.stdout.flush()
+    try:
+        while True:
+            stub._stop.wait(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stub.stop()
@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Nottingham Hackspace payphone client
+# Dial plan, decides when a number being dialed is complete
+#
+# Auth: Matt Lloyd
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2014 Matt Lloyd
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+"""
+    Patterns use the usual PBX notation, one character per key
+        0-9 * #     that key
+        X           any digit 0-9
+        Z           any digit 1-9
+        N           any digit 2-9
+        [1-5,8]     any key listed, ranges allowed
+        .           one or more further digits, the number is never
+                    unambiguously complete so waits for the timeout
+
+    Patterns are compiled into a trie of these tokens, patterns starting
+    the same way share nodes. A number being dialed can sit on more than one
+    node at once, 6XX and 66X both match 66, so the set of nodes is the
+    state and the step from one state to the next for each key is worked
+    out the first time it is needed and cached. Each key is then a single
+    dict lookup however many patterns there are.
+"""
+
+# what a number dialed so far amounts to
+NOMATCH = "NOMATCH"         # no pattern starts like this
+PARTIAL = "PARTIAL"         # needs more digits
+AMBIGUOUS = "AMBIGUOUS"     # a complete number that could also go on
+COMPLETE = "COMPLETE"       # a complete number that can not go on, dial now
+
+KEYS = "0123456789*#"
+_classes = {
+            'X': "0123456789",
+            'Z': "123456789",
+            'N': "23456789",
+           }
+
+
+class _Node(object):
+    __slots__ = ('children', 'terminal')
+
+    def __init__(self):
+        self.children = {}      # token: (keys, _Node)
+        self.terminal = False
+
+
+def _tokens(pattern):
+    """Split a pattern into (token, keys) pairs
+    """
+    pos = 0
+    while pos < len(pattern):
+        char = pattern[pos]
+        if char in KEYS:
+            yield char, frozenset(char)
+            pos += 1
+        elif char.upper() in _classes:
+            yield char.upper(), frozenset(_classes[char.upper()])
+            pos += 1
+        elif char == '.':
+            yield char, frozenset(_classes['X'])
+            pos += 1
+        elif char == '[':
+            end = pattern.find(']', pos)
+            if end < 0:
+                raise ValueError("Unclosed [ in dial pattern {}".format(pattern))
+            keys = set()
+            for part in pattern[pos + 1:end].split(','):
+                if len(part) == 3 and part[1] == '-' and part[0] in KEYS and part[2] in KEYS:
+                    keys.update(str(digit) for digit in range(int(part[0]), int(part[2]) + 1))
+                elif part and all(key in KEYS for key in part):
+                    keys.update(part)
+                else:
+                    raise ValueError("Bad class [{}] in dial pattern {}".format(pattern[pos + 1:end], pattern))
+            if not keys:
+                raise ValueError("Empty class in dial pattern {}".format(pattern))
+            yield "[{}]".format("".join(sorted(keys))), frozenset(keys)
+            pos = end + 1
+        else:
+            raise ValueError("Unknown character {!r} in dial pattern {}".format(char, pattern))
+
+
+class DialPlan():
+    """Compiled set of dial patterns
+
+       state = plan.start
+       state = plan.feed(state, digit)
+       plan.result(state) is one of NOMATCH, PARTIAL, AMBIGUOUS or COMPLETE
+    """
+    def __init__(self, patterns):
+        self.patterns = tuple(pattern.strip() for pattern in patterns if pattern.strip())
+        self._root = _Node()
+        for pattern in self.patterns:
+            self._add(pattern)
+        self.start = frozenset([self._root])
+        self._steps = {}        # (state, key): state
+        self._results = {}      # state: result
+
+    def __len__(self):
+        return len(self.patterns)
+
+    def __repr__(self):
+        return "DialPlan({!r})".format(self.patterns)
+
+    def __eq__(self, other):
+        return isinstance(other, DialPlan) and self.patterns == other.patterns
+
+    def __ne__(self, other):
+        return not self == other
+
+    def _add(self, pattern):
+        node = self._root
+        for token, keys in _tokens(pattern):
+            if token == '.':
+                # one or more digits, a terminal node that loops back on itself
+                child = node.children.get(token, (keys, None))[1]
+                if child is None:
+                    child = _Node()
+                    child.children[token] = (keys, child)
+                    node.children[token] = (keys, child)
+                node = child
+                node.terminal = True
+                continue
+            if token not in node.children:
+                node.children[token] = (keys, _Node())
+            node = node.children[token][1]
+        node.terminal = True
+
+    def feed(self, state, key):
+        """The state after key is pressed in state
+        """
+        step = self._steps.get((state, key))
+        if step is None:
+            step = frozenset(child
+                             for node in state
+                             for keys, child in node.children.itervalues()
+                             if key in keys)
+            self._steps[(state, key)] = step
+        return step
+
+    def result(self, state):
+        result = self._results.get(state)
+        if result is None:
+            if not state:
+                result = NOMATCH
+            elif not any(node.terminal for node in state):
+                result = PARTIAL
+            elif any(node.children for node in state):
+                result = AMBIGUOUS
+            else:
+                result = COMPLETE
+            self._results[state] = result
+        return result
+
+    def match(self, number):
+        """Result for a whole number, mostly for checking a plan by hand
+        """
+        state = self.start
+        for key in number:
+            state = self.feed(state, key)
+        return self.result(state)
+
+
+def parse(text):
+    """DialPlan from a comma or whitespace separated list of patterns, the
+       commas inside [] are left alone
+    """
+    patterns = []
+    current = ""
+    depth = 0
+    for char in text:
+        if char == '[':
+            depth += 1
+        elif char == ']':
+            depth -= 1
+        if depth == 0 and (char == ',' or char.isspace()):
+            patterns.append(current)
+            current = ""
+        else:
+            current += char
+    patterns.append(current)
+    return DialPlan(patterns)
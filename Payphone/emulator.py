@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Nottingham Hackspace payphone client
+# Payphone.ino emulator on a pseudo terminal
+#
+# Auth: Matt Lloyd
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2014 Matt Lloyd
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+"""
+    Stands in for a Payphone.ino board so PayPhone can be run and
+    benchmarked without the hardware. The emulator opens a pseudo terminal
+    and PayPhone uses its slave side as [Serial] port, for a stable path
+    give --link and point port at that.
+
+        python emulator.py --link /tmp/payphone-tty [--framed] [--script scenario.txt]
+
+    Like the firmware it answers hook queries, follows ring commands and
+    switches to the framed protocol when asked if --framed is given.
+
+    Scenario scripts, also accepted on stdin, have one step per line
+        offhook                 lift the handset
+        onhook                  hang it up
+        follow                  press the follow on key
+        press 668 [interval]    key in digits, interval seconds apart
+        wait 0.5                sleep
+        expect R [timeout]      wait for a command from PayPhone, R ring
+                                start and r ring stop, fails the script
+                                if it does not arrive in time
+    Blank lines and lines starting with # are ignored
+"""
+
+import sys
+import os
+import errno
+import select
+import threading
+import pty
+import tty
+import argparse
+import collections
+import timers
+import serialproto
+
+RING_START = 'R'
+RING_STOP = 'r'
+ON_HOOK = 'H'
+OFF_HOOK = 'h'
+FOLLOW_KEY = 'F'
+DIGITS = "1234567890*#"
+FIRMWARE_VERSION = 1
+
+
+class ScenarioError(Exception):
+    pass
+
+
+class Emulator():
+    """The firmware end of the serial link on a pseudo terminal
+
+       Key presses and hook changes are written as the board would, commands
+       PayPhone sends are recorded with the monotonic time they arrived
+    """
+    def __init__(self, framed=False, link=None):
+        self._allowFramed = framed
+        self._link = link
+        self.framed = False
+        self.offHook = False
+        self.ringing = False
+        self.commands = collections.deque(maxlen=10000)    # (monotonic time, command)
+        self._cond = threading.Condition()
+        self._writeLock = threading.RLock()    # keeps frame seqs in write order
+        self._decoder = serialproto.FrameDecoder()
+        self._txSeq = 0
+        self._rxSeq = None      # last COMMAND seq run, resends are acked but not run
+        self._clockStart = timers.monotonic()
+        self.tEmulatorStop = threading.Event()
+        self._master, self._slave = pty.openpty()
+        tty.setraw(self._master)
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+        if self._link:
+            if os.path.lexists(self._link):
+                os.unlink(self._link)
+            os.symlink(self.port, self._link)
+
+    def start(self):
+        self.tEmulator = threading.Thread(name='tEmulator', target=self._reader)
+        self.tEmulator.daemon = True
+        self.tEmulator.start()
+
+    def stop(self):
+        self.tEmulatorStop.set()
+        self.tEmulator.join(1)
+        for fd in (self._master, self._slave):
+            os.close(fd)
+        if self._link and os.path.islink(self._link):
+            os.unlink(self._link)
+
+    # things a person does to the phone
+    def setHook(self, offHook):
+        self.offHook = offHook
+        self._sendEvents(OFF_HOOK if offHook else ON_HOOK)
+
+    def pressFollow(self):
+        self._sendEvents(FOLLOW_KEY)
+
+    def press(self, keys, interval=0):
+        """Key in digits, all in one write when interval is 0
+        """
+        for key in keys:
+            if key not in DIGITS:
+                raise ValueError("No {!r} key on the keypad".format(key))
+        if not interval:
+            self._sendEvents(keys)
+            return
+        for key in keys:
+            self._sendEvents(key)
+            self.tEmulatorStop.wait(interval)
+
+    def expect(self, command, timeout=5, since=None):
+        """Wait for a command written after since, a monotonic time that
+           defaults to now. Returns when it arrived or None on timeout
+        """
+        if since is None:
+            since = timers.monotonic()
+        deadline = timers.monotonic() + timeout
+        with self._cond:
+            while True:
+                for arrived, seen in self.commands:
+                    if seen == command and arrived >= since:
+                        return arrived
+                remaining = deadline - timers.monotonic()
+                if remaining <= 0:
+                    return None
+                self._cond.wait(remaining)
+
+    # the board
+    def _millis(self):
+        return int((timers.monotonic() - self._clockStart) * 1000)
+
+    def _write(self, data):
+        with self._writeLock:
+            while data:
+                written = os.write(self._master, data)
+                data = data[written:]
+
+    def _sendEvents(self, events):
+        if not self.framed:
+            self._write(events)
+            return
+        with self._writeLock:
+            for start in range(0, len(events), serialproto.MAX_PAYLOAD):
+                self._sendFrame(serialproto.EVENTS, events[start:start + serialproto.MAX_PAYLOAD])
+
+    def _sendFrame(self, type, payload):
+        with self._writeLock:
+            self._write(serialproto.encodeFrame(type, self._txSeq, self._millis(), payload))
+            self._txSeq = (self._txSeq + 1) & 0xFF
+
+    def _reader(self):
+        while not self.tEmulatorStop.is_set():
+            try:
+                readable = select.select([self._master], [], [], 0.1)[0]
+                if not readable:
+                    continue
+                data = os.read(self._master, 4096)
+            except (OSError, select.error), e:
+                if e.args[0] in (errno.EINTR, errno.EAGAIN):
+                    continue
+                # PayPhone closing its end shows up as EIO
+                if e.args[0] == errno.EIO:
+                    self.tEmulatorStop.wait(0.1)
+                    continue
+                raise
+            self._received(data)
+
+    def _received(self, data):
+        now = timers.monotonic()
+        for item in self._decoder.feed(data):
+            if isinstance(item, serialproto.Frame):
+                if item.type == serialproto.COMMAND:
+                    if self._rxSeq is None or (item.seq - self._rxSeq - 1) & 0xFF < 128:
+                        self._rxSeq = item.seq
+                        for command in item.payload:
+                            self._command(command, now)
+                    self._sendFrame(serialproto.ACK, chr(item.seq))
+                continue
+            for command in item:
+                if command == serialproto.PROTOCOL_REQUEST:
+                    if self._allowFramed:
+                        self.framed = True
+                        self._rxSeq = None
+                        self._sendFrame(serialproto.HELLO,
+                                        chr(serialproto.PROTOCOL_VERSION) + chr(FIRMWARE_VERSION))
+                else:
+                    self._command(command, now)
+
+    def _command(self, command, now):
+        if command == RING_START:
+            self.ringing = True
+        elif command == RING_STOP:
+            self.ringing = False
+        elif command in (ON_HOOK, OFF_HOOK):
+            self._sendEvents(OFF_HOOK if self.offHook else ON_HOOK)
+        with self._cond:
+            self.commands.append((now, command))
+            self._cond.notify_all()
+
+
+def runScenario(emulator, lines, out=sys.stdout):
+    """Run scenario steps against the emulator, raises ScenarioError when
+       an expect is not met
+    """
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        words = line.split()
+        step, args = words[0].lower(), words[1:]
+        started = timers.monotonic()
+        if step == 'offhook':
+            emulator.setHook(True)
+        elif step == 'onhook':
+            emulator.setHook(False)
+        elif step == 'follow':
+            emulator.pressFollow()
+        elif step == 'press':
+            emulator.press(args[0], float(args[1]) if len(args) > 1 else 0)
+        elif step == 'wait':
+            emulator.tEmulatorStop.wait(float(args[0]))
+        elif step == 'expect':
+            arrived = emulator.expect(args[0], float(args[1]) if len(args) > 1 else 5, started)
+            if arrived is None:
+                raise ScenarioError("line {}: no {!r} from PayPhone".format(number, args[0]))
+            out.write("{} after {:.1f}ms\n".format(args[0], (arrived - started) * 1000))
+        else:
+            raise ScenarioError("line {}: unknown step {!r}".format(number, step))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Payphone.ino emulator on a pseudo terminal')
+    parser.add_argument('-f', '--framed', action='store_true',
+                        help='answer the protocol request and use frames like current firmware')
+    parser.add_argument('-l', '--link',
+                        help='symlink to the pseudo terminal, use this as [Serial] port')
+    parser.add_argument('-s', '--script',
+                        help='scenario to run, steps are read from stdin if not given')
+    args = parser.parse_args()
+
+    emulator = Emulator(args.framed, args.link)
+    emulator.start()
+    print("Emulating Payphone.ino on {}".format(args.link or emulator.port))
+    sys.stdout.flush()
+    try:
+        if args.script:
+            with open(args.script) as f:
+                runScenario(emulator, f)
+        else:
+            for line in iter(sys.stdin.readline, ''):
+                try:
+                    runScenario(emulator, [line])
+                except (ScenarioError, ValueError, IndexError), e:
+                    print(e)
+    except ScenarioError, e:
+        print(e)
+        sys.exit(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        emulator.stop()
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Nottingham Hackspace payphone client
+# Events and the queue the main thread blocks on
+#
+# Auth: Matt Lloyd
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2014 Matt Lloyd
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+import sys
+import os
+import errno
+import select
+import threading
+import collections
+import Queue
+import timers
+if sys.platform == 'win32':
+    pass
+else:
+    import fcntl
+
+# Event types, data carried by each is noted alongside
+DIGITS = "DIGITS"                   # string of one or more dialed digits
+HOOK = "HOOK"                       # True on hook, False off hook
+FOLLOW = "FOLLOW"                   # None
+INCOMING_CALL = "INCOMING_CALL"     # PayPhone.CallSnapshot
+CALL_STATE = "CALL_STATE"           # PayPhone.CallSnapshot
+MEDIA_STATE = "MEDIA_STATE"         # PayPhone.CallSnapshot
+SERIAL_STOPPED = "SERIAL_STOPPED"   # None
+REG_STATE = "REG_STATE"             # (PayPhoneAccountCallback, reg_status, reg_active, reg_reason)
+SIP_HEALTH = "SIP_HEALTH"           # (server, up)
+STOP = "STOP"                       # None
+
+
+class Event(object):
+    """Something the main thread needs to react to, source is the handset
+       that posted it or None for process wide events. stamp is the
+       monotonic time the event entered the system, used for latency
+    """
+    __slots__ = ('type', 'data', 'source', 'stamp')
+
+    def __init__(self, type, data=None, source=None, stamp=None):
+        self.type = type
+        self.data = data
+        self.source = source
+        self.stamp = timers.monotonic() if stamp is None else stamp
+
+    def __repr__(self):
+        return "Event({}, {!r}, {!r})".format(self.type, self.data, self.source)
+
+
+class EventQueue():
+    """FIFO of Events shared by all producers, consumed by the main thread
+
+       put() is safe from any thread including pjsua callbacks.
+       get() waits in select() on a pipe rather than on a lock so signal
+       handlers still run promptly in the main thread under python 2
+    """
+    def __init__(self):
+        self._events = collections.deque()
+        self._lock = threading.Lock()
+        self._pending = False
+        if sys.platform == 'win32':
+            # no select() on pipes, fall back to a threading.Event
+            self._wakeRead = self._wakeWrite = None
+            self._ready = threading.Event()
+        else:
+            self._wakeRead, self._wakeWrite = os.pipe()
+            for fd in (self._wakeRead, self._wakeWrite):
+                flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+                fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+    def __len__(self):
+        return len(self._events)
+
+    def qsize(self):
+        return len(self._events)
+
+    def fileno(self):
+        """Descriptor that is readable while events are waiting, for callers
+           running their own select(). Not available on windows
+        """
+        return self._wakeRead
+
+    def post(self, type, data=None, source=None):
+        """Shortcut for put(Event(type, data, source))
+        """
+        self.put(Event(type, data, source))
+
+    def put(self, event):
+        """Add an Event and wake the consumer
+        """
+        with self._lock:
+            self._events.append(event)
+            if self._pending:
+                return
+            self._pending = True
+        self._wakeup()
+
+    def get(self, timeout=None):
+        """Return the next Event, waiting up to timeout seconds, None waits forever
+           raises Queue.Empty on timeout or if a signal interrupted the wait
+        """
+        while True:
+            with self._lock:
+                if self._events:
+                    return self._events.popleft()
+                self._drainWakeup()
+            if not self._waitWakeup(timeout):
+                raise Queue.Empty
+
+    def _wakeup(self):
+        if self._wakeWrite is None:
+            self._ready.set()
+            return
+        try:
+            os.write(self._wakeWrite, 'e')
+        except OSError, e:
+            # pipe full means a wakeup is already pending
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def _drainWakeup(self):
+        # called with self._lock held
+        self._pending = False
+        if self._wakeRead is None:
+            self._ready.clear()
+            return
+        try:
+            while os.read(self._wakeRead, 512):
+                pass
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def _waitWakeup(self, timeout):
+        if self._wakeRead is None:
+            return self._ready.wait(timeout)
+        try:
+            readable = select.select([self._wakeRead], [], [], timeout)[0]
+        except select.error, e:
+            if e.args[0] == errno.EINTR:
+                return False
+            raise
+        return bool(readable)
@@ -0,0 +1,768 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Nottingham Hackspace payphone client
+# In process stand in for the pjsua module
+#
+# Auth: Matt Lloyd
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2014 Matt Lloyd
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+"""
+    The SIP backend PayPhone uses is whatever module is imported as pj, the
+    classes and methods below are the part of the pjsua API it relies on.
+    Running with
+
+        PAYPHONE_SIP_BACKEND=fake python PayPhone.py
+
+    swaps the real pjsua for this module: no network, no sound device and no
+    PBX. Registration, incoming and outgoing calls, their state changes and
+    DTMF are simulated and callbacks arrive from a "pjsua" thread, or from
+    handle_events() when the library is started without one, just as they
+    would from the real library.
+
+    How the far end behaves is set with PAYPHONE_FAKE_SIP, a comma separated
+    list of setting=value, for example
+
+        PAYPHONE_FAKE_SIP="answer_delay=0.5,remote_hangup=10"
+
+    or by changing fakepj.settings before calls are made, see Settings.
+    Lib.incoming() and Lib.remoteHangup() let tests drive the far end.
+"""
+
+import os
+import time
+import Queue
+import heapq
+import weakref
+import itertools
+import threading
+import events
+import timers
+
+
+class Settings(object):
+    """How the simulated network and far end behave, delays are in seconds
+    """
+    reg_delay = 0.0         # REGISTER to its response
+    reg_status = 200        # registration response code
+    ring_delay = 0.0        # outgoing INVITE to 180 Ringing
+    answer_delay = 0.0      # 180 Ringing to 200 OK, negative never answers
+    reject_code = 0         # answer outgoing calls with this code instead, 0 to accept
+    confirm_delay = 0.0     # our 200 OK to the call being confirmed
+    media_delay = 0.0       # confirmed to media active
+    remote_hangup = -1.0    # confirmed calls are hung up by the far end after this, negative never
+    incoming_interval = 0.0 # an incoming call to each account this often, 0 never
+    caller = "sip:100@fake"
+
+    def __init__(self, text=""):
+        for item in text.split(','):
+            if not item.strip():
+                continue
+            name, value = item.split('=', 1)
+            name = name.strip()
+            default = getattr(Settings, name, None)
+            if default is None or name.startswith('_'):
+                raise ValueError("Unknown fake SIP setting {}".format(name))
+            setattr(self, name, type(default)(value.strip()))
+
+settings = Settings(os.environ.get('PAYPHONE_FAKE_SIP', ""))
+
+
+class Error(Exception):
+    def __init__(self, op_name, obj_name, err_code, err_msg):
+        Exception.__init__(self, op_name, obj_name, err_code, err_msg)
+        self.op_name = op_name
+        self.obj_name = obj_name
+        self.err_code = err_code
+        self.err_msg = err_msg
+
+    def __str__(self):
+        return "Object: {}, operation={}(), error={}".format(self.obj_name, self.op_name, self.err_msg)
+
+
+class TransportType:
+    UNSPECIFIED = 0
+    UDP = 1
+    TCP = 2
+    TLS = 3
+    IPV6 = 128
+
+
+class CallRole:
+    CALLER = 0
+    CALLEE = 1
+
+
+class CallState:
+    NULL = 0
+    CALLING = 1
+    INCOMING = 2
+    EARLY = 3
+    CONNECTING = 4
+    CONFIRMED = 5
+    DISCONNECTED = 6
+
+_stateText = {
+              CallState.NULL: "NULL",
+              CallState.CALLING: "CALLING",
+              CallState.INCOMING: "INCOMING",
+              CallState.EARLY: "EARLY",
+              CallState.CONNECTING: "CONNECTING",
+              CallState.CONFIRMED: "CONFIRMED",
+              CallState.DISCONNECTED: "DISCONNCTD",
+             }
+
+
+class MediaState:
+    NULL = 0
+    ACTIVE = 1
+    LOCAL_HOLD = 2
+    REMOTE_HOLD = 3
+    ERROR = 4
+
+
+class LogConfig:
+    def __init__(self, level=5, filename="", callback=None, console_level=5):
+        self.msg_logging = True
+        self.level = level
+        self.console_level = console_level
+        self.decor = 0
+        self.filename = filename
+        self.callback = callback
+
+
+class UAConfig:
+    def __init__(self):
+        self.max_calls = 4
+        self.nameserver = []
+        self.stun_domain = ""
+        self.stun_host = ""
+        self.user_agent = "pjsip python"
+
+
+class MediaConfig:
+    def __init__(self):
+        self.clock_rate = 16000
+        self.snd_clock_rate = 0
+        self.channel_count = 1
+        self.audio_frame_ptime = 20
+        self.max_media_ports = 254
+        self.quality = 6
+        self.ptime = 0
+        self.no_vad = False
+        self.ilbc_mode = 30
+        self.tx_drop_pct = 0
+        self.rx_drop_pct = 0
+        self.ec_options = 0
+        self.ec_tail_len = 256
+        self.jb_min = -1
+        self.jb_max = -1
+
+
+class TransportConfig:
+    def __init__(self, port=0, bound_addr="", public_addr=""):
+        self.port = port
+        self.bound_addr = bound_addr
+        self.public_addr = public_addr
+
+
+class CodecInfo:
+    def __init__(self, name, priority):
+        self.name = name
+        self.priority = priority
+        parts = name.split('/')
+        self.clock_rate = int(parts[1])
+        self.channel_count = int(parts[2])
+        self.avg_bps = 64000
+        self.frm_ptime = 20
+        self.ptime = 20
+        self.pt = 0
+        self.vad_enabled = False
+        self.plc_enabled = True
+
+
+class TransportInfo:
+    def __init__(self, type, host, port):
+        self.type = type
+        self.description = "UDP"
+        self.is_reliable = False
+        self.is_secure = False
+        self.is_datagram = True
+        self.host = host
+        self.port = port
+
+
+class AuthCred:
+    def __init__(self, realm, username, passwd, scheme="Digest", passwd_type=0):
+        self.realm = realm
+        self.username = username
+        self.passwd = passwd
+        self.scheme = scheme
+        self.passwd_type = passwd_type
+
+
+class AccountConfig:
+    def __init__(self, domain="", username="", password="", display="", registrar="", proxy=""):
+        self.id = ""
+        self.reg_uri = ""
+        self.reg_timeout = 300
+        self.proxy = []
+        self.auth_cred = []
+        if username:
+            self.id = "sip:{}@{}".format(username, domain)
+            if display:
+                self.id = '"{}" <{}>'.format(display, self.id)
+        if domain:
+            self.reg_uri = registrar or "sip:{}".format(domain)
+        if proxy:
+            self.proxy = [proxy]
+        if username:
+            self.auth_cred = [AuthCred("*", username, password)]
+
+
+class AccountInfo:
+    def __init__(self):
+        self.is_default = False
+        self.uri = ""
+        self.reg_active = False
+        self.reg_expires = -1
+        self.reg_status = 0
+        self.reg_reason = ""
+        self.online_status = False
+        self.online_text = ""
+
+
+class CallInfo:
+    def __init__(self):
+        self.role = CallRole.CALLER
+        self.account = None
+        self.uri = ""
+        self.contact = ""
+        self.remote_uri = ""
+        self.remote_contact = ""
+        self.sip_call_id = ""
+        self.state = CallState.NULL
+        self.state_text = ""
+        self.last_code = 0
+        self.last_reason = ""
+        self.media_state = MediaState.NULL
+        self.media_dir = 0
+        self.conf_slot = -1
+        self.call_time = 0
+        self.total_time = 0
+
+
+class AccountCallback:
+    account = None
+
+    def __init__(self, account=None):
+        self._set_account(account)
+
+    def _set_account(self, account):
+        # pjsua only gives callbacks a proxy
+        self.account = weakref.proxy(account) if account else None
+
+    def on_reg_state(self):
+        pass
+
+    def on_incoming_call(self, call):
+        call.hangup()
+
+    def on_incoming_subscribe(self, buddy, from_uri, contact_uri, pres_obj):
+        return (200, None)
+
+    def on_pager(self, from_uri, contact, mime_type, body):
+        pass
+
+
+class CallCallback:
+    call = None
+
+    def __init__(self, call=None):
+        self._set_call(call)
+
+    def _set_call(self, call):
+        self.call = weakref.proxy(call) if call else None
+
+    def on_state(self):
+        pass
+
+    def on_media_state(self):
+        pass
+
+    def on_dtmf_digit(self, digits):
+        pass
+
+    def on_transfer_request(self, dst, code):
+        return code
+
+    def on_transfer_status(self, code, reason, final, cont):
+        return cont
+
+
+class Transport:
+    def __init__(self, lib, type, cfg, port):
+        self._lib = lib
+        self.type = type
+        self.cfg = cfg
+        self._info = TransportInfo(type, cfg.bound_addr or "127.0.0.1", port)
+
+    def is_valid(self):
+        return self._lib is not None
+
+    def info(self):
+        return self._info
+
+
+class Account:
+    def __init__(self, lib, cfg, cb=None):
+        self._lib = lib
+        self._cfg = cfg
+        self._cb = None
+        self._info = AccountInfo()
+        self._info.uri = cfg.id
+        self._valid = True
+        self._transport = None      # set on create_account_for_transport() accounts
+        self.set_callback(cb)
+
+    def __repr__(self):
+        return "<Account {}>".format(self._cfg.id)
+
+    def is_valid(self):
+        return self._valid
+
+    def _check(self, op):
+        if not self._valid:
+            raise Error(op, self, 171140, "Invalid account")
+
+    def info(self):
+        self._check("info")
+        self._lib.stats['account_info'] += 1
+        info = AccountInfo()
+        info.__dict__.update(self._info.__dict__)
+        return info
+
+    def set_callback(self, cb):
+        self._cb = cb or AccountCallback(self)
+        self._cb._set_account(self)
+
+    def set_registration(self, renew):
+        self._check("set_registration")
+        self._lib._register(self, renew)
+
+    def modify(self, cfg):
+        self._check("modify")
+        self._cfg = cfg
+        self._info.uri = cfg.id
+        self._lib._register(self, True)
+
+    def make_call(self, dst_uri, cb=None, hdr_list=None):
+        self._check("make_call")
+        if not dst_uri.startswith(("sip:", "sips:", "tel:")):
+            raise Error("make_call", self, 171039, "Invalid URI")
+        with self._lib._lock:
+            return self._lib._newCall(self, CallRole.CALLER, dst_uri, cb)
+
+    def delete(self):
+        if self._valid:
+            self._valid = False
+            self._lib._accounts.remove(self)
+
+
+class Call:
+    def __init__(self, lib, account, role, remote_uri, cb=None):
+        self._lib = lib
+        self._account = account
+        self._cb = None
+        self._info = CallInfo()
+        self._info.role = role
+        self._info.account = account
+        self._info.uri = account._cfg.id
+        self._info.remote_uri = remote_uri
+        self._info.sip_call_id = "fake-{}".format(next(lib._callIds))
+        self.dtmf = []          # digits sent with dial_dtmf()
+        self.set_callback(cb)
+
+    def __repr__(self):
+        return "<Call {} {}>".format(self._info.sip_call_id, _stateText[self._info.state])
+
+    def is_valid(self):
+        return self._info.state != CallState.DISCONNECTED
+
+    def _check(self, op):
+        if not self.is_valid():
+            raise Error(op, self, 171140, "INVITE session already terminated")
+
+    def info(self):
+        self._lib.stats['call_info'] += 1
+        info = CallInfo()
+        info.__dict__.update(self._info.__dict__)
+        return info
+
+    def set_callback(self, cb):
+        self._cb = cb or CallCallback(self)
+        self._cb._set_call(self)
+
+    def answer(self, code=200, reason="", hdr_list=None):
+        with self._lib._lock:
+            self._check("answer")
+            if self._info.role != CallRole.CALLEE or self._info.state not in (CallState.INCOMING, CallState.EARLY):
+                raise Error("answer", self, 70013, "Invalid operation")
+            if code < 200:
+                self._lib._setState(self, CallState.EARLY, code, reason or "Ringing")
+            elif code < 300:
+                self._lib._setState(self, CallState.CONNECTING, code, reason or "OK")
+                self._lib._schedule(settings.confirm_delay, self._lib._confirm, self)
+            else:
+                self._lib._disconnect(self, code, reason or "Rejected")
+
+    def hangup(self, code=603, reason="", hdr_list=None):
+        # pjsua holds its lock here, so a remote event can not slip in between
+        with self._lib._lock:
+            self._check("hangup")
+            if self._info.state == CallState.CONFIRMED:
+                code, reason = 200, "Normal call clearing"
+            self._lib._disconnect(self, code, reason or "Decline")
+
+    def dial_dtmf(self, digits):
+        self._check("dial_dtmf")
+        if self._info.media_state != MediaState.ACTIVE:
+            raise Error("dial_dtmf", self, 70013, "Media is not active")
+        self.dtmf.append(digits)
+
+
+# what a stock pjsua build offers
+_defaultCodecs = {
+                  "speex/16000/1": 130,
+                  "speex/8000/1": 129,
+                  "speex/32000/1": 128,
+                  "iLBC/8000/1": 128,
+                  "GSM/8000/1": 128,
+                  "PCMU/8000/1": 128,
+                  "PCMA/8000/1": 128,
+                  "G722/16000/1": 128,
+                  "L16/44100/1": 0,
+                  "L16/44100/2": 0,
+                 }
+
+
+class _LibMutex:
+    def __init__(self, lock):
+        self._lock = lock
+        self._lock.acquire()
+
+    def __del__(self):
+        self._lock.release()
+
+
+class Lib:
+    """The simulated library, one per process like the real one
+    """
+    _instance = None
+
+    def __init__(self):
+        if Lib._instance:
+            raise Error("__init__", None, -1, "Library instance already exist")
+        Lib._instance = self
+        self._lock = threading.RLock()      # held while callbacks run, as pjsua does
+        self._queueLock = threading.Lock()
+        self._queue = []                    # (due, seq, callable, args)
+        self._seq = itertools.count()
+        self._callIds = itertools.count(1)
+        self._wake = events.EventQueue()
+        self._accounts = []
+        self._calls = []
+        self._slots = itertools.count(1)    # slot 0 is the sound device
+        self._ports = itertools.count(5060)
+        self._transports = []
+        self._running = False
+        self._thread = None
+        self.connections = set()            # (src, dst) conference bridge links
+        self.codecs = dict(_defaultCodecs)  # name: priority
+        self.sound = (0, 0)
+        self.players = {}
+        self.stats = {
+                      'call_info': 0,       # Call.info() calls
+                      'account_info': 0,
+                      'events': 0,          # simulated callbacks run
+                     }
+        self.log_cfg = self.media_cfg = self.ua_cfg = None
+
+    @staticmethod
+    def instance():
+        return Lib._instance
+
+    def init(self, ua_cfg=None, log_cfg=None, media_cfg=None):
+        self.ua_cfg = ua_cfg or UAConfig()
+        self.log_cfg = log_cfg or LogConfig()
+        self.media_cfg = media_cfg or MediaConfig()
+        self._log(3, "fakepj initialised, clock rate {}".format(self.media_cfg.clock_rate))
+
+    def start(self, with_thread=True):
+        self._running = True
+        if with_thread:
+            self._thread = threading.Thread(name='pjsua', target=self._worker)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def destroy(self):
+        self._running = False
+        self._wake.post(None)
+        if self._thread and self._thread is not threading.current_thread():
+            self._thread.join(1)
+        Lib._instance = None
+
+    def handle_events(self, timeout=50):
+        """Run simulated events that are due, waiting up to timeout ms for
+           one. Returns how many ran
+        """
+        return self._runDue(timeout / 1000.0)
+
+    def create_transport(self, type, cfg=None):
+        cfg = cfg or TransportConfig()
+        transport = Transport(self, type, cfg, cfg.port or next(self._ports))
+        self._transports.append(transport)
+        return transport
+
+    def create_account_for_transport(self, transport, set_default=True, cb=None):
+        """Local account, not registered, calls to the transport's address
+           arrive on it
+        """
+        info = transport.info()
+        cfg = AccountConfig()
+        cfg.id = "sip:{}:{}".format(info.host, info.port)
+        account = Account(self, cfg, cb)
+        account._transport = transport
+        self._accounts.append(account)
+        return account
+
+    def create_account(self, acc_config, set_default=True, cb=None):
+        account = Account(self, acc_config, cb)
+        self._accounts.append(account)
+        self._register(account, True)
+        if settings.incoming_interval > 0:
+            self._schedule(settings.incoming_interval, self._autoIncoming, account)
+        return account
+
+    def hangup_all(self):
+        for call in list(self._calls):
+            if call.is_valid():
+                call.hangup()
+
+    def auto_lock(self):
+        return _LibMutex(self._lock)
+
+    def conf_connect(self, src_slot, dst_slot):
+        self._checkSlot("conf_connect", src_slot)
+        self._checkSlot("conf_connect", dst_slot)
+        self.connections.add((src_slot, dst_slot))
+
+    def conf_disconnect(self, src_slot, dst_slot):
+        self.connections.discard((src_slot, dst_slot))
+
+    def set_snd_dev(self, capture_dev, playback_dev):
+        self.sound = (capture_dev, playback_dev)
+
+    def get_snd_dev(self):
+        return self.sound
+
+    def set_null_snd_dev(self):
+        self.sound = (-1, -1)
+
+    def enum_codecs(self):
+        return [CodecInfo(name, priority)
+                for name, priority in sorted(self.codecs.items(), key=lambda item: (-item[1], item[0]))]
+
+    def set_codec_priority(self, name, priority):
+        if name not in self.codecs:
+            raise Error("set_codec_priority", self, 70012, "Codec not found")
+        self.codecs[name] = priority
+
+    def create_player(self, filename, loop=False):
+        player = len(self.players) + 1
+        self.players[player] = (filename, loop, next(self._slots))
+        return player
+
+    def player_get_slot(self, player_id):
+        return self.players[player_id][2]
+
+    def player_set_pos(self, player_id, pos):
+        if player_id not in self.players:
+            raise Error("player_set_pos", self, 70004, "Invalid player")
+
+    def player_destroy(self, player_id):
+        filename, loop, slot = self.players.pop(player_id)
+        self.connections = set(link for link in self.connections if slot not in link)
+
+    # things the far end does
+    def incoming(self, account, remote_uri=None):
+        """A call arrives for account, returns the Call
+        """
+        call = Call(self, account, CallRole.CALLEE, remote_uri or settings.caller)
+        call._info.state = CallState.INCOMING
+        call._info.state_text = _stateText[CallState.INCOMING]
+        self._calls.append(call)
+        self._schedule(0, self._fire, account._cb.on_incoming_call, call)
+        return call
+
+    def remoteHangup(self, call, code=200, reason="Normal call clearing"):
+        self._schedule(0, self._disconnect, call, code, reason)
+
+    # simulation
+    def _log(self, level, msg, sender="pjsua_core.c"):
+        # pjsua only formats lines up to level and only calls back for those up to console_level
+        cfg = self.log_cfg
+        if cfg and cfg.callback and level <= cfg.level and level <= cfg.console_level:
+            now = time.time()
+            line = "{}.{:03d} {:>14} {}\n".format(time.strftime("%H:%M:%S", time.localtime(now)),
+                                                int(now % 1 * 1000), sender, msg)
+            cfg.callback(level, line, len(line))
+
+    def _schedule(self, delay, callback, *args):
+        with self._queueLock:
+            heapq.heappush(self._queue, (timers.monotonic() + max(0, delay), next(self._seq), callback, args))
+        self._wake.post(None)
+
+    def _runDue(self, timeout):
+        deadline = timers.monotonic() + timeout
+        while True:
+            now = timers.monotonic()
+            due = []
+            with self._queueLock:
+                while self._queue and self._queue[0][0] <= now:
+                    due.append(heapq.heappop(self._queue))
+                wait = deadline - now
+                if self._queue:
+                    wait = min(wait, self._queue[0][0] - now)
+            if due:
+                with self._lock:
+                    for entry in due:
+                        entry[2](*entry[3])
+                return len(due)
+            if wait <= 0:
+                return 0
+            try:
+                self._wake.get(wait)
+            except Queue.Empty:
+                pass
+            if not self._running:
+                return 0
+
+    def _worker(self):
+        while self._running:
+            self._runDue(0.5)
+
+    def _fire(self, callback, *args):
+        self.stats['events'] += 1
+        callback(*args)
+
+    def _register(self, account, renew):
+        def done():
+            if not account.is_valid():
+                return
+            info = account._info
+            info.reg_status = settings.reg_status if renew else 200
+            info.reg_reason = "OK" if info.reg_status == 200 else "Failed"
+            info.reg_active = renew and info.reg_status == 200
+            info.reg_expires = account._cfg.reg_timeout if info.reg_active else -1
+            info.online_status = info.reg_active
+            self._log(3 if info.reg_status == 200 else 2,
+                      "{}: registration {} ({})".format(account._cfg.id, info.reg_reason, info.reg_status),
+                      "pjsua_acc.c")
+            self._fire(account._cb.on_reg_state)
+        self._schedule(settings.reg_delay, done)
+
+    def _autoIncoming(self, account):
+        if not account.is_valid():
+            return
+        self.incoming(account)
+        self._schedule(settings.incoming_interval, self._autoIncoming, account)
+
+    def _newCall(self, account, role, uri, cb):
+        call = Call(self, account, role, uri, cb)
+        self._calls.append(call)
+        self._setState(call, CallState.CALLING, 0, "")
+        self._schedule(settings.ring_delay, self._remoteRinging, call)
+        # a call to one of our own transports also arrives as an incoming call
+        for local in self._accounts:
+            if local._transport and uri.split(';')[0] == local._cfg.id:
+                self.incoming(local, account._cfg.id)
+        return call
+
+    def _remoteRinging(self, call):
+        if not call.is_valid():
+            return
+        if settings.reject_code:
+            self._disconnect(call, settings.reject_code, "Rejected")
+            return
+        self._setState(call, CallState.EARLY, 180, "Ringing")
+        if settings.answer_delay >= 0:
+            self._schedule(settings.answer_delay, self._remoteAnswer, call)
+
+    def _remoteAnswer(self, call):
+        if call.is_valid() and call._info.state == CallState.EARLY:
+            self._setState(call, CallState.CONNECTING, 200, "OK")
+            self._confirm(call)
+
+    def _confirm(self, call):
+        if not call.is_valid():
+            return
+        self._setState(call, CallState.CONFIRMED, 200, "OK")
+        self._schedule(settings.media_delay, self._mediaActive, call)
+        if settings.remote_hangup >= 0:
+            self._schedule(settings.remote_hangup, self._disconnect, call, 200, "Normal call clearing")
+
+    def _mediaActive(self, call):
+        if not call.is_valid():
+            return
+        call._info.media_state = MediaState.ACTIVE
+        call._info.conf_slot = next(self._slots)
+        self._log(4, "..Media updated, stream #0: PCMA (sendrecv)", "pjsua_media.c")
+        self._schedule(0, self._fire, call._cb.on_media_state)
+
+    def _setState(self, call, state, code, reason):
+        self._log(3, ".Call {} state changed to {}".format(id(call) & 0xFFFF, _stateText[state]), "pjsua_call.c")
+        call._info.state = state
+        call._info.state_text = _stateText[state]
+        call._info.last_code = code
+        call._info.last_reason = reason
+        self._schedule(0, self._fire, call._cb.on_state)
+
+    def _disconnect(self, call, code, reason):
+        if not call.is_valid():
+            return
+        slot = call._info.conf_slot
+        self.connections = set(link for link in self.connections if slot not in link)
+        call._info.media_state = MediaState.NULL
+        call._info.conf_slot = -1
+        self._setState(call, CallState.DISCONNECTED, code, reason)
+        self._calls.remove(call)
+
+    def _checkSlot(self, op, slot):
+        live = set([0])
+        live.update(call._info.conf_slot for call in self._calls)
+        live.update(player[2] for player in self.players.values())
+        if slot not in live:
+            raise Error(op, self, 70004, "Invalid conference port")
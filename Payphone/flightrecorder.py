@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Nottingham Hackspace payphone client
+# Flight recorder, the last few thousand things that happened kept in memory
+#
+# Auth: Matt Lloyd
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2014 Matt Lloyd
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+"""
+    Debug logging to the SD card wears it out, so this keeps a DEBUG trail
+    in memory instead. Every record is a (sequence, monotonic stamp,
+    subsystem, code, payload) tuple written into a list sized once at
+    startup, the oldest record is overwritten when it wraps. Taking a
+    sequence number from itertools.count is atomic under the GIL so any
+    thread can record without a lock, a record costs a few microseconds.
+
+    Payloads must be small plain values, compact() turns anything else into
+    one so a record never keeps a call or callback alive.
+"""
+
+import time
+import itertools
+import timers
+
+_PAYLOAD_CHARS = 64     # longest string kept in a payload
+
+
+def compact(data):
+    """data as a small plain value for a payload
+    """
+    if data is None or isinstance(data, (bool, int, long, float)):
+        return data
+    if isinstance(data, basestring):
+        return data[:_PAYLOAD_CHARS]
+    if isinstance(data, tuple):
+        return tuple(compact(item) if not isinstance(item, tuple) else type(item).__name__ for item in data)
+    return type(data).__name__
+
+
+class FlightRecorder():
+    """Fixed size ring of event records, record() is safe from any thread
+    """
+    def __init__(self, size=4096):
+        self.size = max(0, size)
+        self._slots = [None] * self.size
+        self._sequence = itertools.count()
+        if not self.size:
+            self.record = self._discard
+
+    def record(self, subsystem, code, payload=None):
+        seq = next(self._sequence)
+        self._slots[seq % self.size] = (seq, timers.monotonic(), subsystem, code, payload)
+
+    def _discard(self, subsystem, code, payload=None):
+        pass
+
+    def snapshot(self):
+        """The records held, oldest first
+        """
+        return sorted(slot for slot in list(self._slots) if slot is not None)
+
+    def total(self):
+        """Records made since startup, including those overwritten
+        """
+        records = [slot for slot in list(self._slots) if slot is not None]
+        return max(records)[0] + 1 if records else 0
+
+    def dump(self, path, reason):
+        """Write the records to path, returns how many were written
+        """
+        records = self.snapshot()
+        wall = time.time()
+        now = timers.monotonic()
+        lines = ["PayPhone flight recorder, {} at {}".format(reason,
+                                                            time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(wall))),
+                 "{} records of {} made, oldest first, seconds before the dump".format(
+                     len(records), records[-1][0] + 1 if records else 0)]
+        for seq, stamp, subsystem, code, payload in records:
+            when = wall - (now - stamp)
+            lines.append("{}.{:06d} {:>11.6f} {:<16} {:<14} {}".format(
+                time.strftime("%H:%M:%S", time.localtime(when)), int(when % 1 * 1000000),
+                stamp - now, subsystem, code, "" if payload is None else repr(payload)))
+        with open(path, 'w') as f:
+            f.write("\n".join(lines) + "\n")
+        return len(records)
@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Nottingham Hackspace payphone client
+# Rotating log file, old segments compressed in the background
+#
+# Auth: Matt Lloyd
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2014 Matt Lloyd
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+"""
+    The log file is moved aside once it reaches a size or crosses an
+    interval boundary in local time (86400 rotates at midnight, 3600 on the
+    hour). Segments are named after the time they were moved aside,
+    PayPhone.log.20140301-000000, so a segment keeps its name while it is
+    compressed and only the newest backup count of them are kept.
+
+    gzip runs on the tLogCompress thread, zlib lets go of the GIL while it
+    works so the threads logging are not held up. Segments left
+    uncompressed by a crash are picked up again at startup.
+
+    Batched, flush() does nothing and the QueueWriter calls flushBatch()
+    once per batch, otherwise every record is flushed as FileHandler does.
+"""
+
+import os
+import time
+import gzip
+import Queue
+import shutil
+import logging
+import threading
+
+_GZIP_LEVEL = 6
+_STOP = None    # put on the queue to end tLogCompress
+
+
+def nextBoundary(stamp, interval):
+    """The first multiple of interval seconds after stamp, in local time
+    """
+    offset = -time.timezone
+    if time.daylight and time.localtime(stamp).tm_isdst > 0:
+        offset = -time.altzone
+    return ((int(stamp) + offset) // interval + 1) * interval - offset
+
+
+class RotatingLogFile(logging.FileHandler):
+    """FileHandler rotated by size and time, old segments gzipped by tLogCompress
+    """
+    def __init__(self, filename, maxBytes=0, interval=0, backupCount=7, compress=True, batched=False,
+                 delay=False):
+        logging.FileHandler.__init__(self, filename, 'a', None, delay)
+        self.maxBytes = maxBytes
+        self.interval = interval
+        self.backupCount = backupCount
+        self.compress = compress
+        self.batched = batched
+        self.rotations = 0
+        self.compressed = 0
+        self._bytes = 0
+        self._rolloverAt = None
+        self._lastName = None   # segment name and number of the last rotation
+        self._lastCount = 0
+        stamp = time.time()
+        if os.path.exists(self.baseFilename):
+            self._bytes = os.path.getsize(self.baseFilename)
+            # a file left from yesterday is rotated by the first record of today
+            stamp = os.path.getmtime(self.baseFilename)
+        if interval:
+            self._rolloverAt = nextBoundary(stamp, interval)
+        self.qCompress = Queue.Queue()
+        self.tLogCompress = None
+        if self.compress:
+            for path in self.segments():
+                if not path.endswith('.gz'):
+                    self._queueCompress(path)
+
+    def segments(self):
+        """Rotated segments, oldest first
+        """
+        directory, prefix = os.path.split(self.baseFilename)
+        prefix += '.'
+        try:
+            names = os.listdir(directory or '.')
+        except OSError:
+            return []
+        segments = []
+        for name in names:
+            if not name.startswith(prefix) or name.endswith('.tmp'):
+                continue
+            # 20140301-000000 then -1, -2 for more in the same second
+            parts = name[len(prefix):].split('.')[0].split('-')
+            if len(parts) in (2, 3) and all(part.isdigit() for part in parts):
+                key = (parts[0], parts[1], int(parts[2]) if len(parts) == 3 else 0)
+                segments.append((key, os.path.join(directory, name)))
+        return [path for key, path in sorted(segments)]
+
+    def emit(self, record):
+        try:
+            msg = self.format(record)
+            if isinstance(msg, unicode):
+                msg = msg.encode('utf-8', 'replace')
+            data = msg + "\n"
+            if ((self._rolloverAt is not None and record.created >= self._rolloverAt) or
+                    (self.maxBytes and self._bytes and self._bytes + len(data) > self.maxBytes)):
+                self.doRollover(record.created)
+            if self.stream is None:
+                self.stream = self._open()
+            self.stream.write(data)
+            self._bytes += len(data)
+            if not self.batched:
+                self.stream.flush()
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except:
+            self.handleError(record)
+
+    def flush(self):
+        if not self.batched:
+            logging.FileHandler.flush(self)
+
+    def flushBatch(self):
+        logging.FileHandler.flush(self)
+
+    def doRollover(self, stamp=None):
+        """Move the current file aside and start a new one, called with the
+           handler lock held
+        """
+        stamp = stamp or time.time()
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+        if os.path.exists(self.baseFilename) and os.path.getsize(self.baseFilename):
+            name = "{}.{}".format(self.baseFilename, time.strftime("%Y%m%d-%H%M%S", time.localtime(stamp)))
+            # numbers only go up within a second, pruning may have freed a lower one
+            count = self._lastCount + 1 if name == self._lastName else 0
+            path = "{}-{}".format(name, count) if count else name
+            while os.path.exists(path) or os.path.exists(path + '.gz'):
+                count += 1
+                path = "{}-{}".format(name, count)
+            self._lastName, self._lastCount = name, count
+            os.rename(self.baseFilename, path)
+            self.rotations += 1
+            if self.compress:
+                self._queueCompress(path)
+            else:
+                self._prune()
+        self._bytes = 0
+        if self.interval:
+            self._rolloverAt = nextBoundary(stamp, self.interval)
+
+    def _queueCompress(self, path):
+        if self.tLogCompress is None:
+            self.tLogCompress = threading.Thread(name='tLogCompress', target=self._compressLoop)
+            self.tLogCompress.daemon = True
+            self.tLogCompress.start()
+        self.qCompress.put(path)
+
+    def _compressLoop(self):
+        while True:
+            path = self.qCompress.get()
+            if path is _STOP:
+                return
+            try:
+                self._gzip(path)
+                self.compressed += 1
+            except (IOError, OSError), e:
+                # leave it as it is, it is still a readable log
+                logging.getLogger('PayPhone').warn("tLogCompress: could not compress {}: {}".format(path, e))
+            self._prune()
+
+    def _gzip(self, path):
+        partial = path + '.gz.tmp'
+        with open(path, 'rb') as source:
+            target = gzip.GzipFile(partial, 'wb', _GZIP_LEVEL)
+            try:
+                shutil.copyfileobj(source, target, 64 * 1024)
+            finally:
+                target.close()
+        os.rename(partial, path + '.gz')
+        os.remove(path)
+
+    def _prune(self):
+        """Remove the oldest segments beyond backupCount
+        """
+        segments = self.segments()
+        for path in segments[:max(0, len(segments) - self.backupCount)]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def close(self):
+        self.acquire()
+        try:
+            if self.stream:
+                self.flushBatch()
+            logging.FileHandler.close(self)
+        finally:
+            self.release()
+        if self.tLogCompress is not None:
+            # finish what is queued, a segment cut short is done again next start
+            self.qCompress.put(_STOP)
+            self.tLogCompress.join(10)
+            self.tLogCompress = None
@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Nottingham Hackspace payphone client
+# Queued logging, records are written from one background thread
+#
+# Auth: Matt Lloyd
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2014 Matt Lloyd
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+"""
+    The serial, pjsua and main threads log through a QueueHandler which
+    only renders the message and puts the record on a bounded queue. The
+    tLogWriter thread takes records off in batches, hands each batch to the
+    real handlers (console, file, syslog) and flushes them once per batch,
+    so a slow SD card holds up that thread and nothing else.
+
+    When the queue is full a record is dropped rather than making the
+    logging thread wait, either the new record or the oldest one queued
+    depending on the policy. Drops are counted by level and the writer logs
+    how many went missing once it catches up.
+"""
+
+import Queue
+import logging
+import threading
+import timers
+
+DROP_NEWEST = "newest"  # keep what is queued, lose the record being logged
+DROP_OLDEST = "oldest"  # make room by losing the record that has waited longest
+DROP_POLICIES = (DROP_NEWEST, DROP_OLDEST)
+
+_STOP = None            # put on the queue to end tLogWriter
+
+_formatter = logging.Formatter()    # for tracebacks, handlers format everything else
+
+
+class QueueHandler(logging.Handler):
+    """Puts records on a bounded queue for a QueueWriter, never blocks
+    """
+    def __init__(self, size=10000, drop=DROP_NEWEST):
+        logging.Handler.__init__(self)
+        if drop not in DROP_POLICIES:
+            raise ValueError("unknown drop policy {}, choose from {}".format(drop, ", ".join(DROP_POLICIES)))
+        self.queue = Queue.Queue(size)
+        self.drop = drop
+        self.queued = 0
+        self.dropped = {}       # level name: records dropped
+        self.maxDepth = 0
+
+    def prepare(self, record):
+        """Render the message now, args may be changed by the time the
+           writer gets to them and tracebacks hold on to every frame
+        """
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = _formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        try:
+            record = self.prepare(record)
+        except Exception:
+            self.handleError(record)
+            return
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            if self.drop == DROP_NEWEST:
+                self._dropped(record)
+                return
+            # the writer may empty the queue between the two calls, either way there is room after
+            try:
+                self._dropped(self.queue.get_nowait())
+            except Queue.Empty:
+                pass
+            try:
+                self.queue.put_nowait(record)
+            except Queue.Full:
+                self._dropped(record)
+                return
+        self.queued += 1
+        depth = self.queue.qsize()
+        if depth > self.maxDepth:
+            self.maxDepth = depth
+
+    def _dropped(self, record):
+        if record is _STOP:
+            # never lose the writer's stop, there is room as it was just taken off
+            self.queue.put(_STOP)
+            return
+        self.dropped[record.levelname] = self.dropped.get(record.levelname, 0) + 1
+
+    def droppedTotal(self):
+        return sum(self.dropped.values())
+
+    def depth(self):
+        return self.queue.qsize()
+
+
+class QueueWriter():
+    """Writes a QueueHandler's records to handlers from the tLogWriter thread
+    """
+    def __init__(self, queueHandler, handlers, batch=200, flushInterval=0.5):
+        self._queueHandler = queueHandler
+        self.handlers = list(handlers)
+        self._batch = max(1, batch)
+        self._flushInterval = flushInterval
+        self.written = 0
+        self.batches = 0
+        self._reportedDrops = 0
+        self.tLogWriter = None
+
+    def level(self):
+        """Lowest level any handler wants, anything under it need not be queued
+        """
+        return min([handler.level for handler in self.handlers] or [logging.NOTSET])
+
+    def start(self):
+        self.tLogWriter = threading.Thread(name='tLogWriter', target=self._run)
+        self.tLogWriter.daemon = True
+        self.tLogWriter.start()
+
+    def stop(self, timeout=5):
+        """Write out everything queued so far then end the thread
+        """
+        if self.tLogWriter is None:
+            return
+        queue = self._queueHandler.queue
+        while True:
+            try:
+                queue.put(_STOP, timeout=timeout)
+                break
+            except Queue.Full:
+                # the writer is stuck, make room rather than hang shutdown
+                try:
+                    self._queueHandler._dropped(queue.get_nowait())
+                except Queue.Empty:
+                    pass
+        self.tLogWriter.join(timeout)
+        self.tLogWriter = None
+
+    def _run(self):
+        queue = self._queueHandler.queue
+        running = True
+        while running:
+            batch = [queue.get()]
+            if batch[0] is _STOP:
+                break
+            # gather more for a while unless something needs to be seen now
+            deadline = timers.monotonic() + self._flushInterval
+            while len(batch) < self._batch and batch[-1].levelno < logging.WARNING:
+                try:
+                    remaining = deadline - timers.monotonic()
+                    if remaining > 0:
+                        record = queue.get(timeout=remaining)
+                    else:
+                        record = queue.get_nowait()
+                except Queue.Empty:
+                    break
+                if record is _STOP:
+                    running = False
+                    break
+                batch.append(record)
+            self._write(batch)
+
+    def _write(self, batch):
+        dropped = self._queueHandler.droppedTotal()
+        if dropped != self._reportedDrops:
+            record = logging.LogRecord(
+                'PayPhone', logging.WARNING, __file__, 0,
+                "tLogWriter: {} log records dropped, the queue was full".format(dropped - self._reportedDrops),
+                None, None)
+            self._reportedDrops = dropped
+            batch.append(record)
+        for record in batch:
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+        for handler in self.handlers:
+            try:
+                getattr(handler, 'flushBatch', handler.flush)()
+            except (IOError, OSError, ValueError):
+                # handleError has already reported write failures for the batch
+                pass
+        self.written += len(batch)
+        self.batches += 1
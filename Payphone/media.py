@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Nottingham Hackspace payphone client
+# Media profile, how pjsua's audio is set up
+#
+# Auth: Matt Lloyd
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2014 Matt Lloyd
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+"""
+    The conference bridge runs at clock_rate and every call is resampled
+    to it, so a bridge rate that matches the codecs in use (8000 for G.711)
+    saves converting every 20ms frame twice. snd_clock_rate lets the sound
+    device run at a rate it supports with pjsua converting at the edge.
+
+    Codec names are matched against pjsua's own (PCMU/8000/1), a name on
+    its own matches every rate and channel count of that codec. Listed
+    codecs are offered in the order given and everything else is disabled.
+
+    Mouth to ear delay is mostly the jitter buffer, the audio frame size
+    and the echo canceller. A preset fills these in for a kind of network,
+    any of them given on their own replace the preset's value.
+"""
+
+import sys
+
+# whole number settings, named as on pj.MediaConfig
+_INT_SETTINGS = (
+                 'clock_rate',
+                 'snd_clock_rate',
+                 'channel_count',
+                 'audio_frame_ptime',   # ms of audio per sound device frame
+                 'ptime',               # ms of audio per RTP packet, 0 codec default
+                 'jb_min',              # ms the jitter buffer fills before playing, -1 auto
+                 'jb_max',              # ms the jitter buffer may grow to, -1 auto
+                 'ec_tail_len',         # ms of echo to cancel, 0 turns it off
+                )
+
+# pjmedia echo canceller backends
+EC_ALGORITHMS = {
+                 'default': 0,
+                 'speex': 1,
+                 'suppressor': 2,       # simple echo suppressor, cheapest
+                 'webrtc': 3,           # needs pjsip built with it
+                }
+
+PRESETS = {
+           # wired LAN, little jitter, a handset with a short echo path
+           'lan-low-latency': {
+                               'audio_frame_ptime': 10,
+                               'ptime': 20,
+                               'jb_min': 10,
+                               'jb_max': 80,
+                               'ec_tail_len': 64,
+                               'ec_algorithm': 'speex',
+                              },
+           # wireless, bursty loss and jitter, latency traded for fewer gaps
+           'wifi-robust': {
+                           'audio_frame_ptime': 20,
+                           'ptime': 20,
+                           'jb_min': 60,
+                           'jb_max': 360,
+                           'ec_tail_len': 128,
+                           'ec_algorithm': 'speex',
+                          },
+           # everything left to pjsua
+           'default': {},
+          }
+
+
+class MediaProfile(object):
+    """[Media] settings, anything left as None keeps pjsua's default. Like
+       the rest of the settings it can not be changed once made
+    """
+    __slots__ = _INT_SETTINGS + ('ec_algorithm', 'codecs', 'preset')
+
+    def __init__(self, options=None):
+        options = options or {}
+        values = dict((name, None) for name in self.__slots__)
+        if sys.platform != 'darwin':
+            # what PayPhone always used before this was configurable
+            values['clock_rate'] = 44100
+        values['codecs'] = ()
+
+        preset = values['preset'] = options.get('preset', "").strip().lower() or None
+        if preset and preset not in PRESETS:
+            raise ValueError("[Media] unknown preset {}, choose from {}".format(preset,
+                                                                             ", ".join(sorted(PRESETS))))
+        if preset:
+            values.update(PRESETS[preset])
+
+        for name in _INT_SETTINGS:
+            value = options.get(name, "").strip()
+            if value:
+                try:
+                    values[name] = int(value)
+                except ValueError:
+                    raise ValueError("[Media] {} must be a whole number, not {!r}".format(name, value))
+        if values['channel_count'] is not None and values['channel_count'] not in (1, 2):
+            raise ValueError("[Media] channel_count must be 1 or 2")
+        if values['jb_min'] is not None and values['jb_max'] is not None and -1 < values['jb_max'] < values['jb_min']:
+            raise ValueError("[Media] jb_max must not be less than jb_min")
+        if options.get('ec_algorithm', "").strip():
+            values['ec_algorithm'] = options['ec_algorithm'].strip().lower()
+        if values['ec_algorithm'] is not None and values['ec_algorithm'] not in EC_ALGORITHMS:
+            raise ValueError("[Media] unknown ec_algorithm {}, choose from {}".format(
+                             values['ec_algorithm'], ", ".join(sorted(EC_ALGORITHMS))))
+        if options.get('codecs', "").strip():
+            values['codecs'] = tuple(codec.strip() for codec in options['codecs'].split(',') if codec.strip())
+
+        for name, value in values.items():
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("MediaProfile is frozen, load new settings instead")
+
+    def __delattr__(self, name):
+        raise AttributeError("MediaProfile is frozen, load new settings instead")
+
+    def changed(self, other):
+        """Settings whose values differ from other's
+        """
+        return [name for name in self.__slots__ if getattr(self, name) != getattr(other, name)]
+
+    def __eq__(self, other):
+        return type(other) is MediaProfile and not self.changed(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "MediaProfile({})".format(", ".join("{}={!r}".format(name, getattr(self, name))
+                                                   for name in self.__slots__))
+
+    def describe(self):
+        return "preset {}, clock {}, sound device {}, {} channel(s), codecs {}".format(
+            self.preset or "none",
+            "{}Hz".format(self.clock_rate) if self.clock_rate else "default",
+            "{}Hz".format(self.snd_clock_rate) if self.snd_clock_rate else "at clock rate",
+            self.channel_count or "default",
+            ", ".join(self.codecs) or "default")
+
+    def apply(self, mediaConfig):
+        """Set our values on a pj.MediaConfig before Lib.init()
+        """
+        for name in _INT_SETTINGS:
+            value = getattr(self, name)
+            if value is not None:
+                setattr(mediaConfig, name, value)
+        if self.ec_algorithm is not None:
+            mediaConfig.ec_options = EC_ALGORITHMS[self.ec_algorithm]
+        return mediaConfig
+
+    @staticmethod
+    def effective(mediaConfig):
+        """The latency related values a pj.MediaConfig ends up with,
+           pjsua's defaults included, for the log
+        """
+        def ms(value):
+            return "auto" if value < 0 else "{}ms".format(value)
+        algorithms = dict((number, name) for name, number in EC_ALGORITHMS.items())
+        echo = "off"
+        if mediaConfig.ec_tail_len:
+            echo = "{} {}ms".format(algorithms.get(mediaConfig.ec_options & 0xFF, mediaConfig.ec_options),
+                                    mediaConfig.ec_tail_len)
+        return "frame {}ms, ptime {}, jitter buffer {} to {}, echo canceller {}".format(
+            mediaConfig.audio_frame_ptime,
+            "{}ms".format(mediaConfig.ptime) if mediaConfig.ptime else "codec default",
+            ms(mediaConfig.jb_min), ms(mediaConfig.jb_max),
+            echo)
+
+    def applyCodecs(self, lib, logger):
+        """Give the listed codecs falling priorities and disable the rest,
+           after Lib.init(). Returns the codec names in the order offered
+        """
+        available = [codec.name for codec in lib.enum_codecs()]
+        if not self.codecs:
+            return available
+        chosen = []
+        for wanted in self.codecs:
+            matches = [name for name in available
+                       if name.lower() == wanted.lower() or name.lower().startswith(wanted.lower() + "/")]
+            if not matches:
+                logger.warn("Codec {} is not available, have {}".format(wanted, ", ".join(available)))
+            chosen.extend(name for name in matches if name not in chosen)
+        if not chosen:
+            logger.error("None of the codecs {} are available, keeping pjsua's defaults".format(
+                         ", ".join(self.codecs)))
+            return available
+        priority = 255
+        for name in chosen:
+            lib.set_codec_priority(name, priority)
+            priority = max(priority - 1, 1)
+        for name in available:
+            if name not in chosen:
+                lib.set_codec_priority(name, 0)
+        return chosen
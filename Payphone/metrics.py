@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Nottingham Hackspace payphone client
+# Latency histograms and the Prometheus metrics endpoint
+#
+# Auth: Matt Lloyd
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2014 Matt Lloyd
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+import os
+import bisect
+import threading
+import SocketServer
+import BaseHTTPServer
+
+# upper bounds in seconds, anything slower lands in the overflow bucket
+LATENCY_BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0)
+
+
+class Histogram():
+    """Fixed bucket histogram, observe() is safe from any thread
+    """
+    def __init__(self, name, help="", buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counts = [0] * (len(self.buckets) + 1)
+            self.count = 0
+            self.sum = 0.0
+            self.max = 0.0
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+            if value > self.max:
+                self.max = value
+
+    def snapshot(self):
+        """Returns (counts, count, sum, max) taken together
+        """
+        with self._lock:
+            return list(self.counts), self.count, self.sum, self.max
+
+    def percentile(self, fraction):
+        """Upper bound of the bucket holding the given fraction of samples,
+           the largest sample seen if it is in the overflow bucket. None when
+           there are no samples
+        """
+        counts, count, total, largest = self.snapshot()
+        if not count:
+            return None
+        wanted = fraction * count
+        seen = 0
+        for index, bucketCount in enumerate(counts):
+            seen += bucketCount
+            if seen >= wanted:
+                if index < len(self.buckets):
+                    return min(self.buckets[index], largest)
+                return largest
+        return largest
+
+    def report(self):
+        """One line summary in milliseconds
+        """
+        counts, count, total, largest = self.snapshot()
+        if not count:
+            return "{:<16} no samples".format(self.name)
+        return "{:<16} n={:<6} mean={:8.1f} p50<={:8.1f} p90<={:8.1f} p99<={:8.1f} max={:8.1f} ms".format(
+            self.name,
+            count,
+            total / count * 1000,
+            self.percentile(0.5) * 1000,
+            self.percentile(0.9) * 1000,
+            self.percentile(0.99) * 1000,
+            largest * 1000)
+
+
+def _formatLabels(labels):
+    if not labels:
+        return ""
+    pairs = []
+    for key in sorted(labels):
+        value = str(labels[key]).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append('{}="{}"'.format(key, value))
+    return "{" + ",".join(pairs) + "}"
+
+
+def _formatValue(value):
+    if value is True or value is False:
+        value = int(value)
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Exposition():
+    """Builds a page in the Prometheus text format, one metric family at a time
+    """
+    CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+    def __init__(self):
+        self._lines = []
+
+    def add(self, name, type, help, samples):
+        """samples is a list of (labels dict, value)
+        """
+        self._lines.append("# HELP {} {}".format(name, help))
+        self._lines.append("# TYPE {} {}".format(name, type))
+        for labels, value in samples:
+            self._lines.append("{}{} {}".format(name, _formatLabels(labels), _formatValue(value)))
+
+    def addHistogram(self, name, help, samples):
+        """samples is a list of (labels dict, Histogram)
+        """
+        self._lines.append("# HELP {} {}".format(name, help))
+        self._lines.append("# TYPE {} histogram".format(name))
+        for labels, histogram in samples:
+            counts, count, total, largest = histogram.snapshot()
+            cumulative = 0
+            for bound, bucketCount in zip(histogram.buckets, counts):
+                cumulative += bucketCount
+                bucketLabels = dict(labels, le=repr(float(bound)))
+                self._lines.append("{}_bucket{} {}".format(name, _formatLabels(bucketLabels), cumulative))
+            self._lines.append("{}_bucket{} {}".format(name, _formatLabels(dict(labels, le="+Inf")), count))
+            self._lines.append("{}_sum{} {}".format(name, _formatLabels(labels), repr(total)))
+            self._lines.append("{}_count{} {}".format(name, _formatLabels(labels), count))
+
+    def text(self):
+        return "\n".join(self._lines) + "\n"
+
+
+class _MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    timeout = 5     # a stalled scraper must not hold the metrics thread
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        try:
+            body = self.server.collect()
+        except Exception, e:
+            self.server.logger.exception("Failed to collect metrics: {}".format(e))
+            self.send_error(500)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", Exposition.CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # unix socket peers have no address
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return "unix"
+
+    def log_message(self, format, *args):
+        self.server.logger.debug("tMetrics: {} {}".format(self.address_string(), format % args))
+
+
+class _TCPMetricsServer(BaseHTTPServer.HTTPServer):
+    allow_reuse_address = True
+
+
+class _UnixMetricsServer(SocketServer.UnixStreamServer):
+    pass
+
+
+class MetricsServer():
+    """Serves collect() over HTTP from its own thread, on a TCP address or a
+       unix socket path
+
+       collect is called on the metrics thread for every scrape so it must
+       only read state, never take locks the serial or pjsua threads hold
+       for long
+    """
+    def __init__(self, collect, logger, address="127.0.0.1", port=9110, path=None):
+        self._collect = collect
+        self.logger = logger
+        self._address = address
+        self._port = port
+        self._path = path
+        self._server = None
+        self.tMetrics = None
+
+    def start(self):
+        if self._path:
+            if os.path.exists(self._path):
+                # left behind by a process that did not clean up
+                os.unlink(self._path)
+            self._server = _UnixMetricsServer(self._path, _MetricsHandler)
+            where = self._path
+        else:
+            self._server = _TCPMetricsServer((self._address, self._port), _MetricsHandler)
+            where = "http://{}:{}/metrics".format(self._address, self._server.server_address[1])
+        self._server.collect = self._collect
+        self._server.logger = self.logger
+        self.tMetrics = threading.Thread(name='tMetrics', target=self._server.serve_forever)
+        self.tMetrics.daemon = True
+        self.tMetrics.start()
+        self.logger.info("Metrics served on {}".format(where))
+
+    def stop(self):
+        if self._server is None:
+            return
+        self._server.shutdown()
+        self._server.server_close()
+        self._server = None
+        if self._path:
+            try:
+                os.unlink(self._path)
+            except OSError:
+                pass
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Nottingham Hackspace payphone client
+# pjsip log routing
+#
+# Auth: Matt Lloyd
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2014 Matt Lloyd
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+"""
+    Every line pjsip passes up costs the GIL and a logging call on one of
+    its threads, so as much as possible is dropped in C. pjsua only formats
+    lines up to LogConfig.level and only calls back for those up to
+    console_level, both are set to the lower of [Debug] pjsip_level and the
+    highest pjsip level whose lines the PayPhone.pjsip logger would keep.
+
+    What does reach us is split into the sender (the source file pjsip
+    logged from) and the message, given a logging level from the pjsip one
+    and passed through a token bucket per sender. Errors are never limited.
+    Over its limit a sender's lines are dropped, or one in sample of them
+    kept, and the count dropped is logged when the sender next gets through.
+"""
+
+import re
+import logging
+import timers
+
+# pjsip level: python level, 0 fatal, 1 error, 2 warning, 3 info, 4 debug, 5 trace, 6 detailed trace
+LEVELS = {
+          0: logging.CRITICAL,
+          1: logging.ERROR,
+          2: logging.WARNING,
+          3: logging.INFO,
+          4: logging.DEBUG,
+          5: logging.DEBUG,
+          6: logging.DEBUG,
+         }
+MAX_LEVEL = 6
+_UNLIMITED = 1          # lines at this pjsip level or below are never rate limited
+
+# [time] sender message, pjsua puts the time first and indents the message with dots
+_LINE = re.compile(r'^\s*(?:\d\d:\d\d:\d\d(?:\.\d+)?\s+)?(\S+)\s+\.*(.*?)\s*$', re.S)
+
+
+def pjLevelFor(pythonLevel):
+    """Highest pjsip level whose lines log at pythonLevel or above, -1 if none do
+    """
+    levels = [level for level in range(MAX_LEVEL + 1) if LEVELS[level] >= pythonLevel]
+    return max(levels) if levels else -1
+
+
+def splitLine(line):
+    """(sender, message) from a pjsip log line
+    """
+    match = _LINE.match(line)
+    if not match:
+        return "pjsip", line.strip()
+    return match.group(1), match.group(2)
+
+
+class _Sender():
+    __slots__ = ('tokens', 'last', 'overLimit', 'unreported', 'lines', 'dropped')
+
+    def __init__(self, tokens, now):
+        self.tokens = tokens
+        self.last = now
+        self.overLimit = 0      # lines over the limit in this run, for sampling
+        self.unreported = 0     # dropped since the last line that got through
+        self.lines = 0
+        self.dropped = 0
+
+
+class PjLogRouter():
+    """LogConfig callback, runs on whichever pjsip thread logged
+    """
+    def __init__(self, logger, rate=20, burst=50, sample=0):
+        self.logger = logger
+        self.setLimits(rate, burst, sample)
+        self.senders = {}       # sender: _Sender, counts are best effort across pjsip's threads
+        self.lines = 0
+
+    def setLimits(self, rate=20, burst=50, sample=0):
+        """Change the limits, senders keep the tokens they have
+        """
+        self._rate = float(rate)
+        self._burst = max(burst, 1)
+        self._sample = sample
+
+    def __call__(self, level, line, length=None):
+        self.lines += 1
+        pythonLevel = LEVELS.get(level, logging.DEBUG)
+        if not self.logger.isEnabledFor(pythonLevel):
+            return
+        sender, message = splitLine(line)
+        if self._rate and level > _UNLIMITED:
+            state = self.senders.get(sender)
+            now = timers.monotonic()
+            if state is None:
+                state = self.senders[sender] = _Sender(self._burst, now)
+            state.tokens = min(self._burst, state.tokens + (now - state.last) * self._rate)
+            state.last = now
+            state.lines += 1
+            if state.tokens < 1:
+                state.overLimit += 1
+                if not self._sample or state.overLimit % self._sample:
+                    state.dropped += 1
+                    state.unreported += 1
+                    return
+                message = "{} (1 of {} over the rate limit)".format(message, self._sample)
+            else:
+                state.tokens -= 1
+                state.overLimit = 0
+                if state.unreported:
+                    self.logger.log(pythonLevel, "{}: dropped {} lines over the rate limit".format(
+                                    sender, state.unreported))
+                    state.unreported = 0
+        self.logger.log(pythonLevel, "{}: {}".format(sender, message))
+
+    def dropped(self):
+        return sum(state.dropped for state in self.senders.values())
@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Nottingham Hackspace payphone client
+# Framed serial protocol spoken with Payphone.ino
+#
+# Auth: Matt Lloyd
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2014 Matt Lloyd
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+import struct
+
+"""
+    The board boots speaking the legacy single character protocol. The host
+    sends PROTOCOL_REQUEST, a character old firmware ignores, and firmware
+    that understands frames answers with a HELLO frame and uses frames from
+    then on. Until a HELLO arrives the host stays with single characters and
+    repeats the request a few times in case the board was not listening.
+
+    Frame layout, multi byte fields are little endian
+        SOF         1   0x7E
+        length      1   bytes from type to the end of payload
+        type        1   HELLO, EVENTS, COMMAND or ACK
+        seq         1   per sender, wraps at 255
+        timestamp   4   senders millis() when the frame was sent
+        payload     length - 6
+        crc         2   CRC-16/CCITT-FALSE over length to the end of payload
+
+    EVENTS payload is one or more of the legacy event characters in the
+    order they happened, COMMAND payload is one or more legacy command
+    characters, ACK payload is the seq of each COMMAND frame being acked and
+    HELLO payload is the protocol version followed by the firmware version
+"""
+
+SOF = '\x7e'
+PROTOCOL_REQUEST = 'P'
+PROTOCOL_VERSION = 1
+
+HELLO = 0x01
+EVENTS = 0x02
+COMMAND = 0x03
+ACK = 0x04
+
+_HEADER = struct.Struct('<BBBI')    # length, type, seq, timestamp
+_CRC = struct.Struct('<H')
+HEADER_SIZE = 6                     # type, seq and timestamp
+MAX_PAYLOAD = 64
+
+
+def _crcTable():
+    table = []
+    for byte in range(256):
+        crc = byte << 8
+        for bit in range(8):
+            if crc & 0x8000:
+                crc = ((crc << 1) ^ 0x1021) & 0xFFFF
+            else:
+                crc = (crc << 1) & 0xFFFF
+        table.append(crc)
+    return table
+
+_CRC_TABLE = _crcTable()
+
+
+def crc16(data, crc=0xFFFF):
+    """CRC-16/CCITT-FALSE, the same as crc16() in Payphone.ino
+    """
+    for char in data:
+        crc = ((crc << 8) & 0xFFFF) ^ _CRC_TABLE[((crc >> 8) ^ ord(char)) & 0xFF]
+    return crc
+
+
+def encodeFrame(type, seq, timestamp, payload=""):
+    """Build the bytes for one frame
+    """
+    if len(payload) > MAX_PAYLOAD:
+        raise ValueError("Frame payload of {} bytes is over {}".format(len(payload), MAX_PAYLOAD))
+    body = _HEADER.pack(HEADER_SIZE + len(payload), type, seq & 0xFF, timestamp & 0xFFFFFFFF) + payload
+    return SOF + body + _CRC.pack(crc16(body))
+
+
+class Frame(object):
+    __slots__ = ('type', 'seq', 'timestamp', 'payload')
+
+    def __init__(self, type, seq, timestamp, payload):
+        self.type = type
+        self.seq = seq
+        self.timestamp = timestamp
+        self.payload = payload
+
+    def __repr__(self):
+        return "Frame(type={}, seq={}, timestamp={}, payload={!r})".format(self.type,
+                                                                         self.seq,
+                                                                         self.timestamp,
+                                                                         self.payload)
+
+
+class FrameDecoder():
+    """Incremental decoder, feed() it whatever the port returns
+
+       Bytes outside of frames are handed back as strings so a board still
+       using the legacy protocol keeps working. A frame that fails its CRC
+       is dropped and decoding restarts one byte after its SOF
+    """
+    def __init__(self):
+        self.crcErrors = 0
+        self.reset()
+
+    def reset(self):
+        self._buffer = ""
+
+    def feed(self, data):
+        """Returns a list of Frame objects and legacy strings in the order
+           they arrived
+        """
+        buf = self._buffer + data
+        out = []
+        pos = 0
+        while pos < len(buf):
+            start = buf.find(SOF, pos)
+            if start < 0:
+                out.append(buf[pos:])
+                pos = len(buf)
+                break
+            if start > pos:
+                out.append(buf[pos:start])
+            if start + 2 > len(buf):
+                # need the length byte
+                pos = start
+                break
+            length = ord(buf[start + 1])
+            if length < HEADER_SIZE or length > HEADER_SIZE + MAX_PAYLOAD:
+                # not a real frame, treat the SOF as noise
+                out.append(buf[start])
+                pos = start + 1
+                continue
+            end = start + 2 + length + _CRC.size
+            if end > len(buf):
+                pos = start
+                break
+            body = buf[start + 1:start + 2 + length]
+            if _CRC.unpack_from(buf, start + 2 + length)[0] != crc16(body):
+                self.crcErrors += 1
+                pos = start + 1
+                continue
+            length, type, seq, timestamp = _HEADER.unpack_from(body)
+            out.append(Frame(type, seq, timestamp, body[_HEADER.size:]))
+            pos = end
+        self._buffer = buf[pos:]
+        return out
+
+
+class BoardClock():
+    """How long frames from the board took to reach us, by their timestamps
+
+       The boards millis() and our monotonic clock are not synced, so the
+       smallest host minus board time seen is taken as the fastest a frame
+       gets here and each frame is measured against that. The board runs off
+       a resonator that can be DRIFT out, the fastest is let slip by that
+       much so a slow board clock does not read as a growing delay. A board
+       that restarts or a millis() that wraps starts the measuring again
+    """
+    DRIFT = 0.005
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self._lastTimestamp = None
+        self._boardTime = 0.0       # seconds of board time since the first frame
+        self._fastest = None        # smallest host minus board time seen
+        self._fastestAt = None      # and when it was seen
+
+    def delay(self, timestamp, arrived):
+        """Seconds a frame stamped timestamp took beyond the fastest, arrived
+           is the monotonic time it was read
+        """
+        if self._lastTimestamp is not None:
+            if timestamp < self._lastTimestamp:
+                # the board restarted or millis() wrapped
+                self.reset()
+            else:
+                self._boardTime += (timestamp - self._lastTimestamp) / 1000.0
+        self._lastTimestamp = timestamp
+        offset = arrived - self._boardTime
+        if self._fastest is not None:
+            fastest = self._fastest + self.DRIFT * (arrived - self._fastestAt)
+            if offset > fastest:
+                return offset - fastest
+        self._fastest = offset
+        self._fastestAt = arrived
+        return 0.0
@@ -0,0 +1,384 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Nottingham Hackspace payphone client
+# Validated, frozen settings read from the config files
+#
+# Auth: Matt Lloyd
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2014 Matt Lloyd
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+"""
+    load() turns PayPhone.cfg and Secret.cfg, already read into a
+    ConfigParser, into a Settings tree of plain typed values. Every option
+    is converted and checked once, a bad one raises ValueError naming the
+    section and option so nothing wrong gets as far as the serial port or
+    pjsua, and missing options take the defaults documented in PayPhone.cfg.
+
+    Settings can not be changed once made. A reload loads a whole new tree
+    and swaps it in as one reference, so a thread reading settings sees
+    either the old ones or the new ones and never half of each. changed()
+    lists the fields that differ between two of them.
+"""
+
+import logging
+import logging.handlers
+import ConfigParser
+import dialplan
+import media
+
+HANDSET_PREFIX = "Handset"
+
+_LOG_LEVELS = ('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL')
+
+
+class Frozen(object):
+    """Base for settings, fields are the __slots__ and are set once by
+       the constructor
+    """
+    __slots__ = ()
+    _hidden = ()    # fields whose values are never shown
+
+    def __init__(self, **values):
+        for name in self.__slots__:
+            object.__setattr__(self, name, values.pop(name))
+        if values:
+            raise TypeError("{} has no {}".format(type(self).__name__, ", ".join(sorted(values))))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("{} is frozen, load new settings instead".format(type(self).__name__))
+
+    def __delattr__(self, name):
+        raise AttributeError("{} is frozen, load new settings instead".format(type(self).__name__))
+
+    def replace(self, **changes):
+        """Copy with some fields changed
+        """
+        values = dict((name, getattr(self, name)) for name in self.__slots__)
+        values.update(changes)
+        return type(self)(**values)
+
+    def changed(self, other):
+        """Fields whose values differ from other's, all of them if other is None
+        """
+        if other is None:
+            return list(self.__slots__)
+        return [name for name in self.__slots__ if getattr(self, name) != getattr(other, name)]
+
+    def __eq__(self, other):
+        return type(self) is type(other) and not self.changed(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "{}({})".format(type(self).__name__, ", ".join(
+            "{}={}".format(name, "***" if name in self._hidden else repr(getattr(self, name)))
+            for name in self.__slots__))
+
+
+class DebugSettings(Frozen):
+    __slots__ = ('console_debug', 'console_level',
+                 'file_debug', 'log_file', 'file_level',
+                 'log_rotate_bytes', 'log_rotate_interval', 'log_backup_count', 'log_compress',
+                 'syslog_debug', 'syslog_address', 'syslog_facility', 'syslog_level',
+                 'log_queue', 'log_queue_size', 'log_queue_drop', 'log_queue_batch', 'log_queue_flush_interval',
+                 'pjsip_level', 'pjsip_log_level', 'pjsip_rate', 'pjsip_burst', 'pjsip_sample',
+                 'latency_file', 'flight_recorder_size', 'flight_file')
+
+
+class SipSettings(Frozen):
+    """Process wide [SIP] settings, the account ones are in HandsetSettings
+    """
+    __slots__ = ('health_interval', 'health_timeout', 'health_fall', 'health_rise',
+                 'poll_interval', 'idle_poll_interval')
+
+
+class MetricsSettings(Frozen):
+    __slots__ = ('enabled', 'address', 'port', 'socket')
+
+
+class MediaSettings(Frozen):
+    __slots__ = ('profile', 'tones', 'tone_dir')
+
+
+class HandsetSettings(Frozen):
+    """One phone, from its [Handset <name>] section over [Serial], [SIP] and [Phone]
+    """
+    __slots__ = ('name',
+                 'port', 'baudrate', 'write_timeout', 'reader', 'protocol',
+                 'servers', 'username', 'secret',
+                 'dial_timeout', 'ring_timeout', 'register_wait', 'dial_plan', 'dial_terminator',
+                 'sound_device')
+    _hidden = ('secret',)
+
+    # which fields need what doing when they change
+    SERIAL = ('port', 'baudrate', 'write_timeout', 'reader', 'protocol')
+    ACCOUNT = ('servers', 'username', 'secret')
+
+    def healthServers(self):
+        """Where each server is checked, the proxy if it has one
+        """
+        return [proxy or registrar for registrar, proxy in self.servers]
+
+
+class Settings(Frozen):
+    __slots__ = ('debug', 'sip', 'metrics', 'media', 'handsets')
+
+
+class _Options():
+    """Typed reads of one section's options, errors name the section each
+       option came from, origins maps those not from section
+    """
+    def __init__(self, section, options, origins=None):
+        self.section = section
+        self._options = options
+        self._origins = origins or {}
+
+    def _fail(self, option, wanted):
+        raise ValueError("[{}] {} must be {}, not {!r}".format(self._origins.get(option, self.section), option,
+                                                              wanted, self._options[option]))
+
+    def text(self, option, default=None):
+        value = self._options.get(option, "").strip()
+        if value:
+            return value
+        if default is None:
+            raise ValueError("[{}] {} is needed".format(self.section, option))
+        return default
+
+    def optional(self, option):
+        return self._options.get(option, "").strip() or None
+
+    def boolean(self, option, default):
+        value = self._options.get(option, "").strip().lower()
+        if not value:
+            return default
+        if value not in ConfigParser.RawConfigParser._boolean_states:
+            self._fail(option, "True or False")
+        return ConfigParser.RawConfigParser._boolean_states[value]
+
+    def integer(self, option, default, minimum=None):
+        value = self._options.get(option, "").strip()
+        if not value:
+            return default
+        try:
+            number = int(value)
+        except ValueError:
+            self._fail(option, "a whole number")
+        if minimum is not None and number < minimum:
+            self._fail(option, "at least {}".format(minimum))
+        return number
+
+    def number(self, option, default, minimum=None):
+        value = self._options.get(option, "").strip()
+        if not value:
+            return default
+        try:
+            number = float(value)
+        except ValueError:
+            self._fail(option, "a number")
+        if minimum is not None and number < minimum:
+            self._fail(option, "at least {}".format(minimum))
+        return number
+
+    def choice(self, option, default, choices):
+        value = self._options.get(option, "").strip().lower()
+        if not value:
+            return default
+        if value not in choices:
+            self._fail(option, "one of {}".format(", ".join(choices)))
+        return value
+
+    def level(self, option, default):
+        """A logging level name as its number
+        """
+        value = self._options.get(option, "").strip().upper() or default
+        if value == 'WARN':
+            value = 'WARNING'
+        if value not in _LOG_LEVELS:
+            self._fail(option, "one of {}".format(", ".join(_LOG_LEVELS)))
+        return getattr(logging, value)
+
+
+def _items(config, section):
+    return dict(config.items(section)) if config.has_section(section) else {}
+
+
+def _debug(config):
+    options = _Options('Debug', _items(config, 'Debug'))
+    address = options.text('syslog_address', "/dev/log")
+    if ':' in address:
+        host, port = address.rsplit(':', 1)
+        try:
+            address = (host, int(port))
+        except ValueError:
+            options._fail('syslog_address', "a unix socket path or host:port")
+    facility = options.text('syslog_facility', "daemon").lower()
+    if facility not in logging.handlers.SysLogHandler.facility_names:
+        options._fail('syslog_facility', "a syslog facility such as daemon or local0")
+    return DebugSettings(console_debug=options.boolean('console_debug', False),
+                         console_level=options.level('console_level', 'DEBUG'),
+                         file_debug=options.boolean('file_debug', False),
+                         log_file=options.text('log_file', "./PayPhone.log"),
+                         file_level=options.level('file_level', 'INFO'),
+                         log_rotate_bytes=options.integer('log_rotate_bytes', 1048576, 0),
+                         log_rotate_interval=options.integer('log_rotate_interval', 86400, 0),
+                         log_backup_count=options.integer('log_backup_count', 7, 0),
+                         log_compress=options.boolean('log_compress', True),
+                         syslog_debug=options.boolean('syslog_debug', False),
+                         syslog_address=address,
+                         syslog_facility=facility,
+                         syslog_level=options.level('syslog_level', 'INFO'),
+                         log_queue=options.boolean('log_queue', True),
+                         log_queue_size=options.integer('log_queue_size', 10000, 1),
+                         log_queue_drop=options.choice('log_queue_drop', "newest", ("newest", "oldest")),
+                         log_queue_batch=options.integer('log_queue_batch', 200, 1),
+                         log_queue_flush_interval=options.number('log_queue_flush_interval', 0.5, 0),
+                         pjsip_level=options.integer('pjsip_level', 3, 0),
+                         pjsip_log_level=options.level('pjsip_log_level', 'INFO'),
+                         pjsip_rate=options.number('pjsip_rate', 20.0, 0),
+                         pjsip_burst=options.integer('pjsip_burst', 50, 1),
+                         pjsip_sample=options.integer('pjsip_sample', 0, 0),
+                         latency_file=options.text('latency_file', "./PayPhone.latency"),
+                         flight_recorder_size=options.integer('flight_recorder_size', 4096, 0),
+                         flight_file=options.text('flight_file', "./PayPhone.flight"))
+
+
+def _sip(config):
+    options = _Options('SIP', _items(config, 'SIP'))
+    return SipSettings(health_interval=options.number('health_interval', 2.0, 0.1),
+                       health_timeout=options.number('health_timeout', 1.0, 0.1),
+                       health_fall=options.integer('health_fall', 2, 1),
+                       health_rise=options.integer('health_rise', 3, 1),
+                       poll_interval=options.number('poll_interval', 0.02, 0.001),
+                       idle_poll_interval=options.number('idle_poll_interval', 0.2, 0.001))
+
+
+def _metrics(config):
+    options = _Options('Metrics', _items(config, 'Metrics'))
+    return MetricsSettings(enabled=options.boolean('enabled', False),
+                           address=options.text('address', "127.0.0.1"),
+                           port=options.integer('port', 9110, 1),
+                           socket=options.optional('socket'))
+
+
+def _media(config):
+    options = _Options('Media', _items(config, 'Media'))
+    # MediaProfile checks its own settings
+    return MediaSettings(profile=media.MediaProfile(_items(config, 'Media')),
+                         tones=options.boolean('tones', True),
+                         tone_dir=options.optional('tone_dir'))
+
+
+def _servers(options):
+    """((registrar, proxy), ...) from the comma separated server and proxy
+       options, proxy n goes with server n and may be left empty
+    """
+    servers = [server.strip() for server in options.text('server').split(',')]
+    proxies = [proxy.strip() for proxy in (options.optional('proxy') or "").split(',')]
+    if not all(servers):
+        options._fail('server', "a comma separated list of servers with no empty entries")
+    if len(proxies) > len(servers):
+        options._fail('proxy', "no longer than the server list")
+    proxies += [""] * (len(servers) - len(proxies))
+    return tuple(zip(servers, proxies))
+
+
+def _handset(name, section, items, origins):
+    options = _Options(section, items, origins)
+    plan = options.optional('dial_plan')
+    try:
+        # the patterns, the handset compiles its own DialPlan from them
+        plan = () if plan is None else dialplan.parse(plan).patterns
+    except ValueError, e:
+        raise ValueError("[{}] dial_plan {}".format(origins.get('dial_plan', section), e))
+    terminator = options.optional('dial_terminator') or ""
+    if terminator and (len(terminator) != 1 or terminator not in dialplan.KEYS):
+        options._fail('dial_terminator', "a single key from 0-9, * and #")
+    soundDevice = options.optional('sound_device')
+    if soundDevice is not None:
+        try:
+            soundDevice = tuple(int(n) for n in soundDevice.split(','))
+        except ValueError:
+            soundDevice = ()
+        if len(soundDevice) != 2:
+            options._fail('sound_device', "capture,playback device numbers")
+    return HandsetSettings(name=name,
+                           port=options.text('port'),
+                           baudrate=options.integer('baudrate', 9600, 1),
+                           write_timeout=options.number('write_timeout', None, 0),
+                           reader=options.choice('reader', "event", ("event", "poll")),
+                           protocol=options.choice('protocol', "auto", ("auto", "legacy")),
+                           servers=_servers(options),
+                           username=options.text('username'),
+                           secret=items.get('secret', ""),
+                           dial_timeout=options.number('dial_timeout', 1.0, 0),
+                           ring_timeout=options.number('ring_timeout', 120.0, 0),
+                           register_wait=options.number('register_wait', 10.0, 0),
+                           dial_plan=plan,
+                           dial_terminator=terminator,
+                           sound_device=soundDevice)
+
+
+def _handsets(config):
+    """A HandsetSettings for each [Handset <name>] section, these take their
+       defaults from [Serial], [SIP] and [Phone]. With no handset sections
+       [Serial] and [SIP] describe a single handset
+    """
+    defaults = {}
+    origins = {}
+    for section in ('Serial', 'SIP', 'Phone'):
+        for option, value in _items(config, section).items():
+            defaults[option] = value
+            origins[option] = section
+    sections = [section for section in config.sections() if section.startswith(HANDSET_PREFIX)]
+    if not sections:
+        return (_handset(defaults.get('username', "phone").strip(), 'SIP', defaults, origins),)
+    handsets = []
+    for section in sections:
+        items = dict(defaults)
+        items.update(config.items(section))
+        handsetOrigins = dict(origins)
+        handsetOrigins.update((option, section) for option in config.options(section))
+        handsets.append(_handset(section[len(HANDSET_PREFIX):].strip(), section, items, handsetOrigins))
+    names = [handset.name for handset in handsets]
+    for name in names:
+        if not name or names.count(name) > 1:
+            raise ValueError("[{}{}] handset names must be given and different".format(HANDSET_PREFIX, name))
+    return tuple(handsets)
+
+
+def load(config):
+    """Settings from a ConfigParser, raises ValueError for a bad option
+    """
+    if not config.sections():
+        raise ValueError("no settings were loaded")
+    return Settings(debug=_debug(config),
+                    sip=_sip(config),
+                    metrics=_metrics(config),
+                    media=_media(config),
+                    handsets=_handsets(config))
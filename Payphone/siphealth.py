@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Nottingham Hackspace payphone client
+# SIP server health checks
+#
+# Auth: Matt Lloyd
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2014 Matt Lloyd
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+"""
+    Every server is sent a SIP OPTIONS request each interval seconds from
+    one thread, over its own connected UDP socket. Any response, even an
+    error, shows the server is there and gives a round trip time. A server
+    is marked down after fall probes in a row go unanswered and up again
+    after rise answers in a row, each change is passed to notify(server, up)
+    from the health thread.
+
+    This runs beside pjsua rather than through it so servers that are not
+    in use are checked too and a handset can move back to its first choice
+    once that recovers.
+"""
+
+import errno
+import random
+import select
+import socket
+import threading
+import timers
+
+DEFAULT_PORT = 5060
+
+
+def splitServer(server):
+    """(host, port) from host[:port]
+    """
+    host, sep, port = server.rpartition(':')
+    if not sep or not port.isdigit():
+        return server, DEFAULT_PORT
+    return host.strip('[]'), int(port)
+
+
+class ServerHealth():
+    """What the probes have found out about one server, written by the
+       health thread, safe to read from anywhere
+    """
+    def __init__(self, server):
+        self.server = server
+        self.host, self.port = splitServer(server)
+        self.up = None          # None until enough probes have been sent to decide
+        self.rtt = None         # smoothed round trip in seconds
+        self.lastRtt = None
+        self.lastStatus = None  # status code of the last answer
+        self.probes = 0
+        self.answered = 0
+        self._streak = 0        # answers in a row when positive, misses when negative
+        self._sock = None
+        self._pending = None    # (call id, sent) of the probe in flight
+        self._cseq = 0
+
+
+class HealthMonitor():
+    """Probes a set of SIP servers from the tSipHealth thread
+    """
+    def __init__(self, servers, notify, logger, interval=2, timeout=1, fall=2, rise=3):
+        self._notify = notify
+        self.logger = logger
+        self._interval = interval
+        self._timeout = min(timeout, interval)
+        self._fall = fall
+        self._rise = rise
+        self.servers = {}
+        for server in servers:
+            self.servers[server] = ServerHealth(server)
+        self.tSipHealth = None
+        self.tSipHealthStop = threading.Event()
+
+    def isUp(self, server):
+        """False once a server has been marked down, servers we know
+           nothing about are given the benefit of the doubt
+        """
+        health = self.servers.get(server)
+        return health is None or health.up is not False
+
+    def start(self):
+        self.tSipHealth = threading.Thread(name='tSipHealth', target=self._run)
+        self.tSipHealth.daemon = True
+        self.tSipHealth.start()
+        self.logger.info("Checking SIP servers {} every {}s".format(", ".join(sorted(self.servers)),
+                                                                    self._interval))
+
+    def stop(self):
+        self.tSipHealthStop.set()
+        if self.tSipHealth:
+            self.tSipHealth.join(self._interval + 1)
+        for health in self.servers.values():
+            self._close(health)
+
+    def _run(self):
+        nextProbe = timers.monotonic()
+        while not self.tSipHealthStop.is_set():
+            now = timers.monotonic()
+            if now >= nextProbe:
+                for health in self.servers.values():
+                    self._probe(health, now)
+                nextProbe = now + self._interval
+
+            deadline = nextProbe
+            socks = {}
+            for health in self.servers.values():
+                if health._pending:
+                    deadline = min(deadline, health._pending[1] + self._timeout)
+                    socks[health._sock] = health
+            try:
+                readable = select.select(socks.keys(), [], [], max(0, deadline - timers.monotonic()))[0]
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            now = timers.monotonic()
+            for sock in readable:
+                self._receive(socks[sock], now)
+            for health in self.servers.values():
+                if health._pending and now - health._pending[1] >= self._timeout:
+                    self._missed(health, "no answer in {}s".format(self._timeout))
+
+    def _probe(self, health, now):
+        if health._pending:
+            self._missed(health, "no answer")
+        try:
+            if health._sock is None:
+                # resolved again each time the socket is remade so DNS changes are picked up
+                address = socket.getaddrinfo(health.host, health.port, 0, socket.SOCK_DGRAM)[0]
+                health._sock = socket.socket(address[0], socket.SOCK_DGRAM)
+                health._sock.connect(address[4])
+            callId = "{:016x}@payphone".format(random.getrandbits(64))
+            health._cseq += 1
+            health._sock.send(self._options(health, callId))
+        except (socket.error, socket.gaierror), e:
+            self._close(health)
+            health.probes += 1
+            self._missed(health, str(e))
+            return
+        health.probes += 1
+        health._pending = (callId, now)
+
+    def _options(self, health, callId):
+        localHost, localPort = health._sock.getsockname()[:2]
+        if ':' in localHost:
+            localHost = "[{}]".format(localHost)
+        return "\r\n".join([
+                            "OPTIONS sip:{} SIP/2.0".format(health.server),
+                            "Via: SIP/2.0/UDP {}:{};branch=z9hG4bK{:08x};rport".format(localHost, localPort,
+                                                                                     random.getrandbits(32)),
+                            "Max-Forwards: 70",
+                            "From: <sip:payphone@{}>;tag={:08x}".format(localHost, random.getrandbits(32)),
+                            "To: <sip:{}>".format(health.server),
+                            "Call-ID: {}".format(callId),
+                            "CSeq: {} OPTIONS".format(health._cseq),
+                            "User-Agent: PayPhone",
+                            "Accept: application/sdp",
+                            "Content-Length: 0",
+                            "", ""])
+
+    def _receive(self, health, now):
+        try:
+            data = health._sock.recv(65535)
+        except socket.error, e:
+            # ICMP port unreachable comes back as ECONNREFUSED on a connected socket
+            self._close(health)
+            self._missed(health, str(e))
+            return
+        lines = data.split("\r\n")
+        parts = lines[0].split(None, 2)
+        if len(parts) < 2 or not parts[0].startswith("SIP/") or not parts[1].isdigit():
+            return
+        callId = None
+        for line in lines[1:]:
+            name, sep, value = line.partition(':')
+            if sep and name.strip().lower() in ('call-id', 'i'):
+                callId = value.strip()
+                break
+        if health._pending is None or callId != health._pending[0]:
+            # answer to a probe we already gave up on
+            return
+        rtt = now - health._pending[1]
+        health._pending = None
+        health.answered += 1
+        health.lastStatus = int(parts[1])
+        health.lastRtt = rtt
+        # smoothed like TCP's SRTT
+        health.rtt = rtt if health.rtt is None else health.rtt + (rtt - health.rtt) / 8
+        health._streak = max(health._streak, 0) + 1
+        if health.up is not True and (health._streak >= self._rise or health.up is None):
+            self._change(health, True, "answered in {:.1f}ms".format(rtt * 1000))
+
+    def _missed(self, health, why):
+        health._pending = None
+        health._streak = min(health._streak, 0) - 1
+        self.logger.debug("tSipHealth: {} missed a probe, {}".format(health.server, why))
+        if health.up is not False and -health._streak >= self._fall:
+            self._change(health, False, why)
+
+    def _change(self, health, up, why):
+        health.up = up
+        self.logger.warn("tSipHealth: {} is {}, {}".format(health.server, "up" if up else "down", why))
+        self._notify(health.server, up)
+
+    def _close(self, health):
+        if health._sock is not None:
+            health._sock.close()
+            health._sock = None
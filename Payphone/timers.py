@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Nottingham Hackspace payphone client
+# Monotonic clock and deadline timers for the main thread
+#
+# Auth: Matt Lloyd
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2014 Matt Lloyd
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+import sys
+import time
+import heapq
+import itertools
+import ctypes
+import ctypes.util
+
+"""
+    python 2 has no time.monotonic() so go to the OS for a clock that NTP
+    can not step, falling back to time.time() where we don't know how
+"""
+
+def _linuxMonotonic():
+    CLOCK_MONOTONIC = 1
+
+    class timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    librt = ctypes.CDLL(ctypes.util.find_library('rt') or 'librt.so.1', use_errno=True)
+    clock_gettime = librt.clock_gettime
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+    ts = timespec()
+    tsp = ctypes.pointer(ts)
+
+    def monotonic():
+        if clock_gettime(CLOCK_MONOTONIC, tsp) != 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, "clock_gettime failed")
+        return ts.tv_sec + ts.tv_nsec * 1e-9
+    return monotonic
+
+def _darwinMonotonic():
+    class timebase(ctypes.Structure):
+        _fields_ = [('numer', ctypes.c_uint32), ('denom', ctypes.c_uint32)]
+
+    libc = ctypes.CDLL(ctypes.util.find_library('c'))
+    mach_absolute_time = libc.mach_absolute_time
+    mach_absolute_time.restype = ctypes.c_uint64
+    info = timebase()
+    libc.mach_timebase_info(ctypes.byref(info))
+    scale = float(info.numer) / info.denom * 1e-9
+
+    def monotonic():
+        return mach_absolute_time() * scale
+    return monotonic
+
+try:
+    if sys.platform.startswith('linux'):
+        monotonic = _linuxMonotonic()
+    elif sys.platform == 'darwin':
+        monotonic = _darwinMonotonic()
+    else:
+        monotonic = time.time
+except (OSError, AttributeError):
+    monotonic = time.time
+
+
+class Timer(object):
+    """Handle returned by TimerScheduler.schedule(), pass it back to cancel or
+       reschedule
+    """
+    __slots__ = ('deadline', 'callback', 'args', 'active', '_seq')
+
+    def __init__(self, deadline, callback, args, seq):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.active = True
+        self._seq = seq
+
+    def __repr__(self):
+        return "Timer({!r}, deadline={:.3f}, active={})".format(self.callback, self.deadline, self.active)
+
+
+class TimerScheduler():
+    """Heap of deadlines on the monotonic clock
+
+       Not thread safe, timers are scheduled and run from the main thread.
+       The main loop waits at most timeout() seconds then calls runDue().
+       With a logger a callback that raises is logged and the rest still run
+    """
+    def __init__(self, clock=monotonic, logger=None):
+        self._clock = clock
+        self.logger = logger
+        self._heap = []
+        self._seq = itertools.count()
+
+    def __len__(self):
+        return sum(1 for entry in self._heap if self._live(entry))
+
+    def schedule(self, delay, callback, *args):
+        """Run callback(*args) delay seconds from now, returns a Timer
+        """
+        seq = next(self._seq)
+        timer = Timer(self._clock() + delay, callback, args, seq)
+        heapq.heappush(self._heap, (timer.deadline, seq, timer))
+        return timer
+
+    def cancel(self, timer):
+        """Stop a timer from firing, harmless if it already has
+        """
+        if timer is not None:
+            timer.active = False
+
+    def reschedule(self, timer, delay):
+        """Move a timer to delay seconds from now, reviving it if it had fired
+           or been cancelled. Returns the timer
+        """
+        timer._seq = next(self._seq)
+        timer.deadline = self._clock() + delay
+        timer.active = True
+        heapq.heappush(self._heap, (timer.deadline, timer._seq, timer))
+        return timer
+
+    def timeout(self):
+        """Seconds until the next timer is due, 0 if one is overdue, None if
+           there are none
+        """
+        self._discardStale()
+        if not self._heap:
+            return None
+        return max(0, self._heap[0][0] - self._clock())
+
+    def runDue(self):
+        """Fire every timer whose deadline has passed, returns how many ran
+        """
+        ran = 0
+        now = self._clock()
+        while self._heap and self._heap[0][0] <= now:
+            deadline, seq, timer = heapq.heappop(self._heap)
+            if not (timer.active and timer._seq == seq):
+                continue
+            timer.active = False
+            try:
+                timer.callback(*timer.args)
+            except Exception:
+                if self.logger is None:
+                    raise
+                self.logger.exception("Timer {!r} failed".format(timer))
+            ran += 1
+        return ran
+
+    def _live(self, entry):
+        timer = entry[2]
+        return timer.active and timer._seq == entry[1]
+
+    def _discardStale(self):
+        # cancelled and rescheduled timers leave old entries behind
+        while self._heap and not self._live(self._heap[0]):
+            heapq.heappop(self._heap)
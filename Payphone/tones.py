@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Nottingham Hackspace payphone client
+# Call progress tones
+#
+# Auth: Matt Lloyd
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2014 Matt Lloyd
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+"""
+    UK tones as BT SIN 350 gives them. One cycle of each is synthesised
+    once at startup at the conference bridge's clock rate so pjsua never
+    resamples them. pjsua's python API can only play files, so at startup
+    each cycle is written out as a WAV and given a looping player whose port
+    stays on the conference bridge, then the file is removed as the player
+    keeps it open. Starting a tone only connects its port to the sound
+    device and stopping it disconnects the port, nothing is opened, written
+    or rewound during a call. The bridge does not take frames from a port
+    nobody listens to, so a cadenced tone picks up where it last stopped.
+"""
+
+import os
+import sys
+import math
+import fractions
+import array
+import wave
+import shutil
+import tempfile
+
+DIAL = "dial"
+RINGBACK = "ringback"
+BUSY = "busy"
+CONGESTION = "congestion"
+UNOBTAINABLE = "unobtainable"
+
+# name: (frequencies in Hz, cadence of (seconds on, seconds off) or None for continuous)
+UK_TONES = {
+            DIAL: ((350, 440), None),
+            RINGBACK: ((400, 450), ((0.4, 0.2), (0.4, 2.0))),
+            BUSY: ((400,), ((0.375, 0.375),)),
+            CONGESTION: ((400,), ((0.4, 0.35), (0.225, 0.525))),
+            UNOBTAINABLE: ((400,), None),
+           }
+
+_CONTINUOUS_SECONDS = 1.0   # loop length for continuous tones, whole cycles of every frequency
+_RAMP_SECONDS = 0.005       # fade in and out so the cadence does not click
+_LEVEL = 0.25               # peak of each frequency as a fraction of full scale
+
+
+def synthesise(frequencies, cadence, rate, level=_LEVEL):
+    """One cycle of a tone as 16 bit mono PCM
+    """
+    if cadence is None:
+        cadence = ((_CONTINUOUS_SECONDS, 0),)
+    ramp = int(rate * _RAMP_SECONDS)
+    peak = 32767 * level
+    # the frequencies together repeat every rate / gcd samples, work that out once
+    period = rate
+    for frequency in frequencies:
+        period = fractions.gcd(period, frequency)
+    period = rate // period
+    cycle = [peak * sum(math.sin(2 * math.pi * frequency * n / rate) for frequency in frequencies)
+            for n in xrange(period)]
+    samples = array.array('h')
+    for on, off in cadence:
+        count = int(round(on * rate))
+        if off and ramp:
+            # continuous tones loop on a whole cycle and need no ramp
+            samples.extend(int(cycle[n % period] * min(1.0, (n + 1.0) / ramp, float(count - n) / ramp))
+                           for n in xrange(count))
+        else:
+            samples.extend(int(cycle[n % period]) for n in xrange(count))
+        samples.extend([0] * int(round(off * rate)))
+    return samples
+
+
+class ToneSet():
+    """Every tone ready on the conference bridge, only one plays at a time
+    """
+    def __init__(self, lib, logger, rate=8000, directory=None, tones=UK_TONES):
+        self._lib = lib
+        self.logger = logger
+        self.rate = rate
+        self._ownDirectory = directory is None
+        self._directory = directory or tempfile.mkdtemp(prefix='payphone-tones-')
+        self._players = {}      # name: (player id, conf slot)
+        self.pcm = {}           # name: array of samples, kept for anything that wants them
+        self.playing = None
+        for name, (frequencies, cadence) in tones.items():
+            self.pcm[name] = synthesise(frequencies, cadence, rate)
+
+    def create(self):
+        """Write the tones out and give each a looping player, after Lib.start().
+           The files are removed once the players have them open
+        """
+        if not os.path.isdir(self._directory):
+            os.makedirs(self._directory)
+        paths = []
+        for name, samples in self.pcm.items():
+            path = os.path.join(self._directory, "{}-{}.wav".format(name, self.rate))
+            out = wave.open(path, 'wb')
+            try:
+                out.setnchannels(1)
+                out.setsampwidth(2)
+                out.setframerate(self.rate)
+                if sys.byteorder == 'big':
+                    # WAV is little endian
+                    samples = array.array('h', samples)
+                    samples.byteswap()
+                out.writeframes(samples.tostring())
+            finally:
+                out.close()
+            paths.append(path)
+            player = self._lib.create_player(path, loop=True)
+            self._players[name] = (player, self._lib.player_get_slot(player))
+        self._removeFiles(paths)
+        self.logger.info("Tones ready at {}Hz: {}".format(self.rate, ", ".join(sorted(self._players))))
+
+    def start(self, name):
+        if self.playing == name:
+            return
+        self.stop()
+        self._lib.conf_connect(self._players[name][1], 0)
+        self.playing = name
+
+    def stop(self):
+        if self.playing is None:
+            return
+        self._lib.conf_disconnect(self._players[self.playing][1], 0)
+        self.playing = None
+
+    def _removeFiles(self, paths):
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError, e:
+                # windows will not remove a file that is open
+                self.logger.debug("Could not remove {}: {}".format(path, e))
+        if self._ownDirectory:
+            shutil.rmtree(self._directory, ignore_errors=True)
+
+    def destroy(self):
+        self.playing = None
+        players, self._players = self._players, {}
+        try:
+            for player, slot in players.values():
+                self._lib.player_destroy(player)
+        finally:
+            if self._ownDirectory:
+                shutil.rmtree(self._directory, ignore_errors=True)